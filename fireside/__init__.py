@@ -4,10 +4,12 @@ import sys
 from jythonlib import dict_builder
 
 from clamp import clamp_base
-from javax.servlet import Filter
+from javax.servlet import Filter, ServletException
 from javax.servlet.http import HttpServlet
 
 from .servlet import ServletBase, FilterBase, WSGICall
+from .swap import HotSwap
+from .warmup import Warmup
 
 
 ToolBase = clamp_base("org.python.tools")
@@ -17,17 +19,70 @@ class WSGIServlet(ToolBase, HttpServlet, ServletBase):
 
     def init(self, config):
         self.do_init(config)
+        # Only return, so the container routes requests here, once warm
+        self.warmup = Warmup.from_config(config, self.err_log)
+        if self.warmup is not None and not self.warmup.run(self.call_wsgi):
+            if self.warmup.required:
+                self.do_destroy()
+                raise ServletException("Warm-up of %s failed" % (config.getInitParameter("wsgi.handler"),))
+            self.err_log.write("Warm-up failed, so serving cold\n")
+        self.hot_swap = HotSwap.from_config(config, self)
+
+    def destroy(self):
+        self.do_destroy()
 
     def service(self, req, resp):
-        bridge = self.get_bridge(req)
-        environ = dict_builder(bridge.asMap)()
-        self.do_wsgi_call(WSGICall(environ, req, resp))
+        if self.dispatcher is not None and req.isAsyncSupported():
+            self.dispatcher.dispatch(req, resp, self.admit)
+        else:
+            self.admit(req, resp)
+
+    def admit(self, req, resp):
+        # Applies any concurrency limit before calling the application
+        if self.admission is not None:
+            context = None
+            if self.dispatcher is not None and req.isAsyncStarted():
+                context = req.getAsyncContext()
+            return self.admission.run(req, resp, self.call_wsgi, context)
+        return self.call_wsgi(req, resp)
+
+    def call_wsgi(self, req, resp):
+        bridge = self.get_shared_bridge(req)
+        if bridge is not None:
+            # Set up by a WSGIFilter in front of this servlet, which
+            # also owns the input
+            if self.app_pool is not None:
+                # Overlaid for this call only, leaving the filter's
+                # environ unchanged
+                environ = dict_builder(lambda: bridge.asMap(False))()
+            else:
+                environ = dict_builder(bridge.asMap)()
+            call = WSGICall(environ, req, resp, self.flush_policy)
+            return self.do_wsgi_call(call)
+
+        wsgi_input = self.get_input(req)
+        pending = False
+        try:
+            bridge = self.get_bridge(req, wsgi_input)
+            environ, lazy = self.environ_policy.build(bridge)
+            call = WSGICall(environ, req, resp, self.flush_policy)
+            call.input = wsgi_input
+            pending = self.do_wsgi_call(call)
+            if lazy:
+                self.environ_policy.observe(bridge)
+            return pending
+        finally:
+            if not pending:
+                wsgi_input.close()
 
 
 class WSGIFilter(ToolBase, Filter, FilterBase):
 
     def init(self, config):
         self.do_init(config)
-    
+
+    def destroy(self):
+        self.do_destroy()
+
     def doFilter(self, req, resp, chain):
         self.filter_wsgi_call(req, resp, chain)
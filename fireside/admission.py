@@ -0,0 +1,182 @@
+"""Admission control for WSGI calls
+
+A servlet given a concurrency limit only calls its application for that
+many requests at once. Further requests wait, in a bounded queue and
+for a bounded time, for one of them to complete; otherwise they are
+shed at once with 503 Service Unavailable and Retry-After, so that under
+overload clients get a fast answer instead of everyone's latency
+climbing. Optionally the limit adapts to the latency of the calls,
+AIMD style, between 1 and the configured maximum. Requests for paths
+with one of the configured prefixes, such as health checks, bypass the
+limit.
+"""
+
+import threading
+
+from java.lang import System
+from java.util.concurrent.atomic import AtomicBoolean, AtomicLong
+from javax.servlet import AsyncListener
+from javax.servlet.http import HttpServletResponse
+
+from .config import init_param
+
+
+def reject(resp, retry_after):
+    """Sheds a request with 503 Service Unavailable, telling the client when to retry"""
+    resp.setHeader("Retry-After", str(retry_after))
+    resp.sendError(HttpServletResponse.SC_SERVICE_UNAVAILABLE)
+
+
+def path_prefixes(value):
+    return tuple(prefix.strip().rstrip("/") for prefix in value.split(",") if prefix.strip())
+
+
+class Admission(AsyncListener):
+
+    """One admitted request, released once, when its call completes
+
+    Which for an async request may be after the handler returned, such
+    as with non-blocking output, so it is also released on completion
+    of its async context.
+    """
+
+    def __init__(self, control):
+        self.control = control
+        self.start = System.nanoTime()
+        self.released = AtomicBoolean()
+
+    def __repr__(self):
+        return "Admission(released=%s)" % (self.released,)
+
+    def release(self):
+        if self.released.compareAndSet(False, True):
+            self.control.release(System.nanoTime() - self.start)
+
+    def onComplete(self, event):
+        self.release()
+
+    def onError(self, event):
+        pass
+
+    def onStartAsync(self, event):
+        pass
+
+    def onTimeout(self, event):
+        pass
+
+
+class AdmissionControl(object):
+
+    """Limits the number of requests concurrently calling the application
+
+    With a latency target, the limit is cut by backoff each time a call
+    takes longer than the target, and otherwise grows by one for each
+    limit's worth of calls that do not.
+    """
+
+    def __init__(self, limit, queue=0, timeout=0, retry_after=1, latency_target=0,
+                 backoff=0.9, bypass=()):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.queue = queue
+        self.timeout = timeout / 1000.0
+        self.retry_after = retry_after
+        self.latency_target = latency_target * 1000000   # in ns
+        self.backoff = backoff
+        self.bypass = bypass
+        self.in_flight = 0
+        self.waiting = 0
+        self.available = threading.Condition()
+        self.rejected = AtomicLong()
+
+    def __repr__(self):
+        return "AdmissionControl(limit=%s, in_flight=%s, waiting=%s, rejected=%s)" % (
+            int(self.limit), self.in_flight, self.waiting, self.rejected)
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns admission control if fireside.max_concurrency is set, otherwise None"""
+        limit = init_param(config, "fireside.max_concurrency", 0, int)
+        if limit <= 0:
+            return None
+        queue = init_param(config, "fireside.admission_queue", 0, int)
+        timeout = init_param(config, "fireside.admission_timeout", 0, int)
+        if (queue > 0) != (timeout > 0):
+            # Either on its own would never let a request wait
+            # FIXME better exception class
+            raise Exception(
+                "fireside.admission_queue and fireside.admission_timeout must be set together",
+                queue, timeout)
+        return cls(
+            limit, queue, timeout,
+            init_param(config, "fireside.retry_after", 1, int),
+            init_param(config, "fireside.latency_target", 0, int),
+            bypass=init_param(config, "fireside.admission_bypass", (), path_prefixes))
+
+    def run(self, req, resp, handler, context=None):
+        """Calls handler(req, resp) once admitted, or rejects the request
+
+        Returns what handler returns, or False if rejected. If handler
+        returns True, the call is still pending, and so stays admitted
+        until context, the request's AsyncContext, completes.
+        """
+        if self.bypass and self.bypasses(req):
+            return handler(req, resp)
+        if not self.acquire():
+            self.reject(resp)
+            return False
+        admission = Admission(self)
+        if context is not None:
+            # Added beforehand, since the context may complete before
+            # handler returns
+            context.addListener(admission)
+        pending = False
+        try:
+            pending = handler(req, resp)
+            return pending
+        finally:
+            if not pending:
+                admission.release()
+
+    def bypasses(self, req):
+        # Prefixes only match whole path segments
+        path = (req.getServletPath() or "") + (req.getPathInfo() or "")
+        for prefix in self.bypass:
+            if path == prefix or path.startswith(prefix + "/"):
+                return True
+        return False
+
+    def acquire(self):
+        with self.available:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            if self.waiting >= self.queue or self.timeout <= 0:
+                return False
+            self.waiting += 1
+            try:
+                deadline = System.nanoTime() + int(self.timeout * 1000000000)
+                while self.in_flight >= int(self.limit):
+                    remaining = deadline - System.nanoTime()
+                    if remaining <= 0:
+                        return False
+                    self.available.wait(remaining / 1000000000.0)
+                self.in_flight += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, latency):
+        with self.available:
+            self.in_flight -= 1
+            if self.latency_target > 0:
+                if latency > self.latency_target:
+                    self.limit = max(1.0, self.limit * self.backoff)
+                else:
+                    self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            # The limit may have grown, freeing up more than this slot
+            self.available.notify_all()
+
+    def reject(self, resp):
+        self.rejected.incrementAndGet()
+        reject(resp, self.retry_after)
@@ -0,0 +1,32 @@
+"""Helpers for reading fireside settings from servlet/filter init parameters"""
+
+
+def boolean(value):
+    """Converts an init parameter value such as "true" or "off" to a bool"""
+    lowered = value.lower()
+    if lowered in ("true", "yes", "on", "1"):
+        return True
+    if lowered in ("false", "no", "off", "0"):
+        return False
+    raise ValueError(value)
+
+
+def handler_name(application_name):
+    """Splits a wsgi.handler such as "package.module.app" into its module and attribute names"""
+    parts = (application_name or "").split(".")
+    if len(parts) < 2 or not all(parts):
+        # FIXME better exception class
+        raise Exception("wsgi.handler not configured properly", application_name)
+    return ".".join(parts[:-1]), parts[-1]
+
+
+def init_param(config, name, default=None, convert=str):
+    """Returns the init parameter name from config, or default if not set"""
+    value = config.getInitParameter(name)
+    if value is None:
+        return default
+    try:
+        return convert(value.strip())
+    except ValueError:
+        # FIXME better exception class
+        raise Exception("%s not configured properly" % (name,), value)
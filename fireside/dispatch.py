@@ -0,0 +1,330 @@
+"""Dispatching of WSGI calls off the servlet container's request threads
+
+With Servlet 3.x async support, a request can be started in async mode
+and completed later, on some other thread. So the number of connector
+threads is not tied to the number of Jython threads running WSGI apps,
+which are instead managed by fireside in a bounded pool. Optionally,
+request input and response output can also be non-blocking, so slow
+clients do not hold any thread at all while they send or read.
+"""
+
+import sys
+import traceback
+
+import jarray
+from com.google.common.util.concurrent import ThreadFactoryBuilder
+from java.io import ByteArrayOutputStream, IOException
+from java.util.concurrent import (
+    ArrayBlockingQueue, RejectedExecutionException, SynchronousQueue, ThreadPoolExecutor, TimeUnit)
+from java.util.concurrent.atomic import AtomicBoolean
+from javax.servlet import AsyncListener, ReadListener, WriteListener
+from javax.servlet.http import HttpServletRequestWrapper, HttpServletResponse
+from org.python.tools.fireside import ByteArrayServletInputStream
+
+from .config import boolean, init_param
+
+
+def has_body(req):
+    return req.getContentLength() > 0 or (
+        req.getContentLength() == -1 and req.getHeader("Transfer-Encoding") is not None)
+
+
+class AsyncDispatcher(object):
+
+    """Runs WSGI calls on a bounded pool of fireside worker threads
+
+    Requests that cannot be queued because the pool and its queue are
+    full are rejected with 503 Service Unavailable.
+    """
+
+    def __init__(self, err_log, threads=16, queue=64, timeout=0, nonblocking_output=False, input_limit=0):
+        self.err_log = err_log
+        self.timeout = timeout
+        self.nonblocking_output = nonblocking_output
+        self.input_limit = input_limit
+        if queue > 0:
+            work_queue = ArrayBlockingQueue(queue)
+        else:
+            work_queue = SynchronousQueue()
+        self.executor = ThreadPoolExecutor(
+            threads, threads, 60, TimeUnit.SECONDS, work_queue,
+            ThreadFactoryBuilder().setNameFormat("fireside-worker-%d").setDaemon(True).build())
+
+    def __repr__(self):
+        return "AsyncDispatcher(executor=%s, timeout=%s)" % (self.executor, self.timeout)
+
+    @classmethod
+    def from_config(cls, config, err_log):
+        """Returns a dispatcher if fireside.async is enabled, otherwise None"""
+        if not init_param(config, "fireside.async", False, boolean):
+            return None
+        return cls(
+            err_log,
+            init_param(config, "fireside.async_threads", 16, int),
+            init_param(config, "fireside.async_queue", 64, int),
+            init_param(config, "fireside.async_timeout", 0, int),
+            init_param(config, "fireside.nonblocking_output", False, boolean),
+            init_param(config, "fireside.nonblocking_input", 0, int))
+
+    def dispatch(self, req, resp, handler):
+        """Calls handler(req, resp) on a worker thread, completing the request afterwards
+
+        Unless handler returns True, meaning that it has arranged for
+        the request to be completed later, eg by non-blocking output.
+        With non-blocking input, any request body is read before
+        handler is called.
+        """
+        context = req.startAsync(req, resp)
+        context.setTimeout(self.timeout)
+        if self.input_limit > 0 and has_body(req) and req.getContentLength() <= self.input_limit:
+            BodyIntake(self, context, req, resp, handler).start()
+        else:
+            self.submit(context, req, resp, handler)
+
+    def submit(self, context, req, resp, handler):
+        def task():
+            pending = False
+            try:
+                pending = handler(req, resp)
+            except:
+                self.failed(resp, sys.exc_info())
+            finally:
+                if not pending:
+                    context.complete()
+
+        try:
+            self.executor.execute(task)
+        except RejectedExecutionException:
+            try:
+                resp.sendError(HttpServletResponse.SC_SERVICE_UNAVAILABLE)
+            finally:
+                context.complete()
+
+    def stream(self, call, result, aborts=None):
+        """Writes result for call with non-blocking output, then completes the request
+
+        If the client goes away meanwhile, this is counted in aborts,
+        an AtomicLong, if given.
+        """
+        if call.writer is not None:
+            # the write callable was used while the application was
+            # called, so output so far was blocking
+            call.writer.finish()
+            call.writer = None
+        call.nonblocking = True
+        call.measure(result)
+        OutputPump(self, call, result, call.req.getAsyncContext(), aborts).start()
+
+    def execute(self, task):
+        # Continuations of non-blocking I/O should run on the pool, but
+        # rather than lose them, run them on the calling container
+        # thread if the pool is saturated
+        try:
+            self.executor.execute(task)
+        except RejectedExecutionException:
+            task()
+
+    def failed(self, resp, exc_info):
+        # There is no longer a container thread to propagate this
+        # exception to, so log it and fail the response if possible
+        try:
+            self.err_log.writelines(traceback.format_exception(*exc_info))
+            if not resp.isCommitted():
+                resp.sendError(HttpServletResponse.SC_INTERNAL_SERVER_ERROR)
+        finally:
+            exc_info = None     # avoid dangling circular ref
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class OutputPump(WriteListener):
+
+    """Writes the chunks of a WSGI result as the output stream is ready for them
+
+    The next chunk is only pulled from the result when isReady() is
+    true, and each is written with one write. Otherwise the pump stops
+    until the container calls onWritePossible, so a slow client does
+    not hold a blocked thread. Iteration itself always runs on the
+    dispatcher's pool, not on container I/O threads.
+    """
+
+    def __init__(self, dispatcher, call, result, context, aborts=None):
+        self.dispatcher = dispatcher
+        self.call = call
+        self.result = result
+        self.chunks = iter(result)
+        self.context = context
+        self.aborts = aborts
+        self.out = call.resp.getOutputStream()
+        self.closed = AtomicBoolean()
+
+    def __repr__(self):
+        return "OutputPump(call=%s, result=%s, closed=%s)" % (self.call, self.result, self.closed)
+
+    def start(self):
+        # The container will call onWritePossible once it is ready
+        self.out.setWriteListener(self)
+
+    def onWritePossible(self):
+        self.dispatcher.execute(self.pump)
+
+    def onError(self, t):
+        self.dispatcher.err_log.write("Non-blocking output failed: %s\n" % (t,))
+        self.close()
+
+    def pump(self):
+        try:
+            # NB once isReady() is false, the container will call
+            # onWritePossible again, so nothing may be done after that
+            while self.out.isReady():
+                try:
+                    data = next(self.chunks)
+                except StopIteration:
+                    if not self.call.headers_sent:
+                        self.call.write("")   # send headers now if body was empty
+                    self.call.finish()
+                    self.close()
+                    return
+                if data:    # don't send headers until body appears
+                    self.call.write(data)
+        except IOException:
+            # The client has gone away, as for a failed write
+            self.call.abort()
+            self.disconnected()
+        except:
+            if self.call.aborted:
+                self.disconnected()
+            else:
+                try:
+                    self.dispatcher.failed(self.call.resp, sys.exc_info())
+                finally:
+                    self.close()
+
+    def disconnected(self):
+        # Not a failure of the application, so counted rather than logged
+        try:
+            if self.aborts is not None:
+                self.aborts.incrementAndGet()
+        finally:
+            self.close()
+
+    def close(self):
+        # may race between onError and the pump itself
+        if not self.closed.compareAndSet(False, True):
+            return
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            try:
+                self.call.close_input()
+            finally:
+                self.context.complete()
+
+
+class DisconnectListener(AsyncListener):
+
+    """Marks a WSGI call as aborted once its async request fails or times out
+
+    Such as when the container sees the client go away, so the call
+    stops iterating its application's result before its next write.
+    """
+
+    def __init__(self, call):
+        self.call = call
+
+    def __repr__(self):
+        return "DisconnectListener(call=%s)" % (self.call,)
+
+    def onComplete(self, event):
+        pass
+
+    def onError(self, event):
+        self.call.abort()
+
+    def onStartAsync(self, event):
+        pass
+
+    def onTimeout(self, event):
+        self.call.abort()
+
+
+class BufferedRequest(HttpServletRequestWrapper):
+
+    """A request whose body has already been read into memory"""
+
+    def __init__(self, req, body):
+        super(BufferedRequest, self).__init__(req)
+        self.body = body
+        self.input_stream = ByteArrayServletInputStream(body)
+
+    def getInputStream(self):
+        return self.input_stream
+
+    def getContentLength(self):
+        return len(self.body)
+
+    def getContentLengthLong(self):
+        return len(self.body)
+
+
+class BodyIntake(ReadListener):
+
+    """Reads a request body with non-blocking input, then dispatches the request
+
+    Reading happens on container I/O threads, as data arrives, so a
+    slow uploader does not hold a worker thread blocked in the WSGI
+    application. Bodies that turn out to exceed the dispatcher's
+    input limit - possible if the request is chunked - are rejected
+    with 413 Request Entity Too Large.
+    """
+
+    def __init__(self, dispatcher, context, req, resp, handler):
+        self.dispatcher = dispatcher
+        self.context = context
+        self.req = req
+        self.resp = resp
+        self.handler = handler
+        self.input = req.getInputStream()
+        length = req.getContentLength()
+        self.body = ByteArrayOutputStream(length if length > 0 else 8192)
+        self.buffer = jarray.zeros(8192, "b")
+        self.done = AtomicBoolean()
+
+    def __repr__(self):
+        return "BodyIntake(req=%s, size=%s)" % (self.req, self.body.size())
+
+    def start(self):
+        # The container will call onDataAvailable once there is data
+        self.input.setReadListener(self)
+
+    def onDataAvailable(self):
+        # NB once isReady() is false, the container will call
+        # onDataAvailable again, so nothing may be done after that
+        while not self.done.get() and self.input.isReady():
+            n = self.input.read(self.buffer)
+            if n == -1:
+                return   # onAllDataRead follows
+            self.body.write(self.buffer, 0, n)
+            if self.body.size() > self.dispatcher.input_limit:
+                self.finish(HttpServletResponse.SC_REQUEST_ENTITY_TOO_LARGE)
+                return
+
+    def onAllDataRead(self):
+        if self.done.compareAndSet(False, True):
+            self.dispatcher.submit(
+                self.context, BufferedRequest(self.req, self.body.toByteArray()), self.resp, self.handler)
+
+    def onError(self, t):
+        self.dispatcher.err_log.write("Non-blocking input failed: %s\n" % (t,))
+        self.finish(HttpServletResponse.SC_BAD_REQUEST)
+
+    def finish(self, status):
+        if not self.done.compareAndSet(False, True):
+            return
+        try:
+            if not self.resp.isCommitted():
+                self.resp.sendError(status)
+        finally:
+            self.context.complete()
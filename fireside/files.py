@@ -0,0 +1,200 @@
+"""Support for wsgi.file_wrapper, per PEP 3333
+
+Iterating a FileWrapper reads blocks from the wrapped file-like object,
+as usual. But if that object is a file backed by a FileChannel, the
+servlet instead transfers the rest of the file directly from the
+channel (see FileTransfer), so the file is never read into Python
+strings. Such responses also support byte range requests, including
+multiple ranges.
+"""
+
+import os
+import uuid
+
+from java.nio.channels import FileChannel
+
+
+# Minimum block size used when a file has to be read into the heap
+TRANSFER_BLOCK_SIZE = 65536
+
+
+def get_channel(filelike):
+    """Returns the FileChannel backing filelike, or None"""
+    # On Jython, fileno() returns the underlying raw I/O object,
+    # which provides the channel
+    try:
+        raw = filelike.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+    if isinstance(raw, FileChannel):
+        return raw
+    getter = getattr(raw, "getChannel", None)
+    if getter is None:
+        return None
+    channel = getter()
+    if isinstance(channel, FileChannel):
+        return channel
+    return None
+
+
+class FileWrapper(object):
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+        self.channel = get_channel(filelike)
+        name = getattr(filelike, "name", None)
+        if self.channel is not None and isinstance(name, basestring) and os.path.isfile(name):
+            self.path = os.path.abspath(name)
+        else:
+            self.path = None
+
+    def __repr__(self):
+        return "FileWrapper(filelike=%s, blksize=%s, channel=%s)" % (self.filelike, self.blksize, self.channel)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+    __next__ = next   # a nod to Python 3
+
+    def transferable(self):
+        return self.channel is not None
+
+    def region(self):
+        """Returns (position, count) of the rest of the file to be sent"""
+        if hasattr(self.filelike, "tell"):
+            position = self.filelike.tell()
+        else:
+            position = self.channel.position()
+        return position, max(self.channel.size() - position, 0)
+
+
+# More ranges than this in one request are not worth honoring, and
+# may well be abusive, so the whole file is sent instead
+MAX_RANGES = 16
+
+
+def parse_ranges(header, size):
+    """Returns the satisfiable (first, last) byte ranges in a Range header
+
+    Per RFC 7233, returns None if the header is missing or invalid,
+    and so is to be ignored; and an empty list if no range overlaps a
+    representation of size bytes. Overlapping or adjacent ranges are
+    coalesced.
+    """
+    if not header:
+        return None
+    unit, sep, specs = header.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition("-")
+        first = first.strip()
+        last = last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # suffix range, ie the last so many bytes
+            if not last:
+                return None
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size - 1))
+        else:
+            first = int(first)
+            if not last:
+                last = size - 1
+            elif int(last) < first:
+                return None
+            else:
+                last = int(last)
+            if first < size:
+                ranges.append((first, min(last, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    coalesced = []
+    for first, last in sorted(ranges):
+        if coalesced and first <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(last, coalesced[-1][1]))
+        else:
+            coalesced.append((first, last))
+    # preserve the requested order, unless ranges were in fact coalesced
+    return coalesced if len(coalesced) < len(ranges) else ranges
+
+
+def if_range_matches(if_range, headers):
+    """Returns True if a Range request should be honored per If-Range
+
+    headers is a dict of the lowercased response headers, which must
+    provide a matching strong ETag or Last-Modified date.
+    """
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        etag = headers.get("etag")
+        return etag is not None and not etag.startswith("W/") and etag == if_range
+    return headers.get("last-modified") == if_range
+
+
+class ByteRanges(object):
+
+    """The ranges of a file to be sent in a 206 Partial Content response
+
+    A single range is sent as is, with Content-Range describing it;
+    multiple ranges as multipart/byteranges parts.
+    """
+
+    def __init__(self, ranges, size, content_type):
+        self.ranges = ranges
+        self.size = size
+        self.content_type = content_type
+        if len(ranges) > 1:
+            self.boundary = uuid.uuid4().hex
+        else:
+            self.boundary = None
+
+    def __repr__(self):
+        return "ByteRanges(ranges=%s, size=%s)" % (self.ranges, self.size)
+
+    def content_range(self, first, last):
+        return "bytes %d-%d/%d" % (first, last, self.size)
+
+    def headers(self):
+        """Returns the headers describing the partial content"""
+        if self.boundary is None:
+            return [("Content-Range", self.content_range(*self.ranges[0]))]
+        else:
+            return [("Content-Type", "multipart/byteranges; boundary=%s" % (self.boundary,))]
+
+    def parts(self):
+        """Yields (prefix, first, last) for each range, then the epilogue as (prefix, None, None)"""
+        if not self.ranges:
+            return   # unsatisfiable, so there is no body
+        if self.boundary is None:
+            first, last = self.ranges[0]
+            yield "", first, last
+            return
+        for first, last in self.ranges:
+            prefix = ["\r\n--%s\r\n" % (self.boundary,)]
+            if self.content_type:
+                prefix.append("Content-Type: %s\r\n" % (self.content_type,))
+            prefix.append("Content-Range: %s\r\n\r\n" % (self.content_range(first, last),))
+            yield "".join(prefix), first, last
+        yield "\r\n--%s--\r\n" % (self.boundary,), None, None
+
+    def content_length(self):
+        return sum(len(prefix) + (last - first + 1 if first is not None else 0)
+                   for prefix, first, last in self.parts())
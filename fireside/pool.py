@@ -0,0 +1,108 @@
+"""Pooled application instances, for WSGI apps that are not thread safe
+
+Each instance is the application loaded in its own PythonInterpreter,
+with its own PySystemState, so each has its own sys.modules and thus
+its own module globals. A request checks out an instance for the whole
+of its WSGI call, including iterating over and closing the result,
+during which the calling thread uses the instance's PySystemState. So
+no instance is ever called by more than one thread at a time, and the
+environ reports wsgi.multithread as False, while a servlet still
+handles as many requests concurrently as it has instances.
+"""
+
+import sys
+from Queue import Empty, Queue
+
+from java.util.concurrent.atomic import AtomicLong
+from org.python.core import Py, PySystemState
+from org.python.util import PythonInterpreter
+
+from .admission import reject
+from .config import handler_name
+
+
+class IsolatedApplication(object):
+
+    """A WSGI application loaded in an interpreter of its own
+
+    Use as a context manager while calling the application, so that
+    anything it imports then is also imported into its interpreter.
+    Switching the thread's PySystemState goes through Py.setSystemState,
+    which is synchronized, so entering and exiting each take a global
+    lock, briefly; that is the cost of isolation, per call.
+    """
+
+    def __init__(self, application_name, path):
+        module_name, name = handler_name(application_name)
+        self.state = PySystemState()
+        for entry in path:
+            if entry not in self.state.path:
+                self.state.path.append(entry)
+        # Creating and using the interpreter switches this thread to its
+        # system state, which must not outlive loading the application
+        saved = Py.getSystemState()
+        try:
+            self.interpreter = PythonInterpreter(None, self.state)
+            module = self.interpreter.eval("__import__(%r, None, None, [%r])" % (module_name, name))
+        finally:
+            Py.setSystemState(saved)
+        self.application = getattr(module, name)
+        self.saved = None
+
+    def __repr__(self):
+        return "IsolatedApplication(application=%s)" % (self.application,)
+
+    def __enter__(self):
+        self.saved = Py.setSystemState(self.state)
+        return self.application
+
+    def __exit__(self, *exc_info):
+        Py.setSystemState(self.saved)
+        self.saved = None
+
+    def close(self):
+        self.interpreter.cleanup()
+
+
+class ApplicationPool(object):
+
+    """A fixed number of isolated instances of an application
+
+    Instances are checked out in turn; when all are in use, requests
+    wait for one to be checked back in, for up to timeout ms, or
+    without limit if timeout is not positive. Requests that time out
+    are shed, as by admission control, so that instances stuck in the
+    application do not pile up the threads waiting for them.
+    """
+
+    def __init__(self, application_name, size, timeout=30000, retry_after=1):
+        self.size = size
+        self.timeout = timeout / 1000.0 if timeout > 0 else None
+        self.retry_after = retry_after
+        self.rejected = AtomicLong()
+        self.instances = Queue()
+        for i in xrange(size):
+            self.instances.put(IsolatedApplication(application_name, sys.path))
+
+    def __repr__(self):
+        return "ApplicationPool(size=%s, available=%s, rejected=%s)" % (
+            self.size, self.instances.qsize(), self.rejected)
+
+    def checkout(self):
+        """Returns an instance, or None if none was checked back in in time"""
+        try:
+            return self.instances.get(timeout=self.timeout)
+        except Empty:
+            return None
+
+    def reject(self, resp):
+        self.rejected.incrementAndGet()
+        reject(resp, self.retry_after)
+
+    def checkin(self, instance):
+        self.instances.put(instance)
+
+    def close(self):
+        # Any instance still checked out is left to be collected
+        while not self.instances.empty():
+            self.instances.get_nowait().close()
@@ -6,35 +6,253 @@
 """FIXME
 Implement the following from PEP 3333
 
-If a call to len(iterable) succeeds, the server must be able to rely on the result being accurate. That is, if the iterable returned by the application provides a working __len__() method, it must return an accurate result. (See the Handling the Content-Length Header section for information on how this would normally be used.)
-
-And, if the server and client both support HTTP/1.1 "chunked encoding" [3] , then the server may use chunked encoding to send a chunk for each write() call or bytestring yielded by the iterable, thus generating a Content-Length header for each chunk. This allows the server to keep the client connection alive, if it wishes to do so. Note that the server must comply fully with RFC 2616 when doing this, or else fall back to one of the other strategies for dealing with the absence of Content-Length .
+If the server and client both support HTTP/1.1 "chunked encoding" [3] , then the server may use chunked encoding to send a chunk for each write() call or bytestring yielded by the iterable, thus generating a Content-Length header for each chunk. This allows the server to keep the client connection alive, if it wishes to do so. Note that the server must comply fully with RFC 2616 when doing this, or else fall back to one of the other strategies for dealing with the absence of Content-Length .
 
 Also ensure that the connection is closed properly
 """
 
-import array
 import itertools
 import sys
+import threading
+from collections import deque
+from Queue import Queue
 from wsgiref.validate import validator
 
 from jythonlib import dict_builder
-from org.python.tools.fireside import RequestBridge, CaptureHttpServletResponse
+from java.lang import Long
+from java.io import File, IOException
+from java.util.concurrent import (
+    FutureTask, LinkedBlockingQueue, RejectedExecutionException, Semaphore, SynchronousQueue,
+    ThreadPoolExecutor, TimeUnit)
+from java.util.concurrent.atomic import AtomicInteger, AtomicLong
+from javax.servlet import DispatcherType
+from com.google.common.util.concurrent import ThreadFactoryBuilder
+from org.python.tools.fireside import (
+    BufferPool, RequestBridge, RequestSpool, CaptureHttpServletResponse, ChunkPipe, ChunkWriter,
+    FileTransfer, PassThroughHttpServletResponse, ResponseHeaders, WSGIInputStream)
+
+from .admission import AdmissionControl
+from .config import boolean, handler_name, init_param
+from .dispatch import AsyncDispatcher, DisconnectListener
+from .files import ByteRanges, FileWrapper, TRANSFER_BLOCK_SIZE, if_range_matches, parse_ranges
+from .pool import ApplicationPool
 
 
 # FIXME perform additional verifications; see
 # https://github.com/Pylons/waitress/blob/master/waitress/task.py#L143 for some guidance here
 
 
+# Request attribute under which the number of flushes caused by a
+# response is published, eg for use by access logging
+FLUSHES_ATTRIBUTE = "org.python.tools.fireside.flushes"
+
+# Request attribute under which a WSGIFilter publishes its RequestBridge
+# while running the rest of the chain, so that a fireside servlet further
+# down reuses it and its environ
+BRIDGE_ATTRIBUTE = "org.python.tools.fireside.bridge"
+
+class ClientDisconnected(IOError):
+    """Raised on further output once the client has gone away"""
+
+
+# Request attributes for Tomcat's sendfile support
+SENDFILE_SUPPORT = "org.apache.tomcat.sendfile.support"
+SENDFILE_FILENAME = "org.apache.tomcat.sendfile.filename"
+SENDFILE_START = "org.apache.tomcat.sendfile.start"
+SENDFILE_END = "org.apache.tomcat.sendfile.end"
+
+
+class FlushPolicy(object):
+
+    """When a ResponseWriter flushes the servlet output stream
+
+    always - flush after every chunk; this is the default, and the
+        behavior PEP 3333 asks for by not delaying any block
+    threshold - coalesce chunks, flushing once at least threshold
+        bytes are pending
+    end - coalesce chunks, flushing only at the end of iteration
+
+    In every mode, an empty bytestring yielded by the application
+    after the body has started is a hint to flush immediately.
+    """
+
+    ALWAYS = "always"
+    THRESHOLD = "threshold"
+    END = "end"
+    MODES = (ALWAYS, THRESHOLD, END)
+
+    def __init__(self, mode=ALWAYS, threshold=8192):
+        if mode not in self.MODES:
+            # FIXME better exception class
+            raise Exception("fireside.flush_policy must be one of %s" % (", ".join(self.MODES),), mode)
+        if threshold <= 0:
+            raise Exception("fireside.flush_threshold must be positive", threshold)
+        self.mode = mode
+        self.threshold = threshold
+
+    def __repr__(self):
+        return "FlushPolicy(mode=%s, threshold=%s)" % (self.mode, self.threshold)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            init_param(config, "fireside.flush_policy", cls.ALWAYS),
+            init_param(config, "fireside.flush_threshold", 8192, int))
+
+
+class EnvironPolicy(object):
+
+    """How WSGIServlet builds the environ for each request
+
+    lazy - a dict backed by the request, whose values are only
+        converted when looked up; best for applications that look at a
+        few keys
+    eager - a plain dict, built in one pass; best for frameworks that
+        copy or iterate over all of the environ anyway
+    adaptive - the default; starts lazy, but switches to eager once
+        most requests turn out to use all of the environ. Every
+        probe_interval-th request is still built lazily, so that it
+        switches back to lazy if that stops being the case
+    """
+
+    ADAPTIVE = "adaptive"
+    LAZY = "lazy"
+    EAGER = "eager"
+    MODES = (ADAPTIVE, LAZY, EAGER)
+
+    def __init__(self, mode=ADAPTIVE, window=32, probe_interval=16):
+        if mode not in self.MODES:
+            # FIXME better exception class
+            raise Exception("fireside.environ must be one of %s" % (", ".join(self.MODES),), mode)
+        self.mode = mode
+        self.window = window
+        self.probe_interval = probe_interval
+        self.eager = mode == self.EAGER
+        # Rises by one for each observed request that used all of the
+        # environ, falls by one otherwise; switches at either end of the
+        # window, so the mode does not flap
+        self.score = AtomicInteger(0)
+        self.requests = AtomicLong(0)
+
+    def __repr__(self):
+        return "EnvironPolicy(mode=%s, eager=%s)" % (self.mode, self.eager)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(init_param(config, "fireside.environ", cls.ADAPTIVE))
+
+    def build(self, bridge):
+        """Returns the environ for bridge, and whether it is lazy"""
+        if self.eager and (
+                self.mode == self.EAGER or self.requests.incrementAndGet() % self.probe_interval):
+            return bridge.asDict(), False
+        return dict_builder(bridge.asMap)(), True
+
+    def observe(self, bridge):
+        """Records whether a lazy environ was used whole by the application"""
+        if self.mode != self.ADAPTIVE:
+            return
+        if bridge.isLoadedAll():
+            if self.score.get() < self.window and self.score.incrementAndGet() >= self.window:
+                self.eager = True
+        elif self.score.get() > 0 and self.score.decrementAndGet() <= 0:
+            self.eager = False
+
+
+class ResponseWriter(object):
+
+    """Writes body chunks to a servlet output stream per a FlushPolicy
+
+    Chunks are copied, or for buffer protocol objects written
+    directly, by a ChunkWriter using one reusable buffer of the
+    threshold size. Except with the always policy, small chunks are
+    coalesced there, so they do not each cause a write and flush of
+    the underlying socket.
+    """
+
+    def __init__(self, out, policy):
+        self.out = out
+        self.policy = policy
+        self.pending = 0
+        self.flushes = 0
+        self.chunks = ChunkWriter(out, policy.threshold)
+
+    def write(self, data):
+        self.pending += self.chunks.write(data)
+        mode = self.policy.mode
+        if mode == FlushPolicy.ALWAYS or (
+                mode == FlushPolicy.THRESHOLD and self.pending >= self.policy.threshold):
+            self.flush()
+
+    def flush(self):
+        self.chunks.flush()
+        self.pending = 0
+        self.flushes += 1
+
+    def transfer(self, channel, position, count, blksize):
+        # Any coalesced output precedes the file
+        self.chunks.drain()
+        transferred = FileTransfer.transfer(
+            channel, position, count, self.out, max(blksize, TRANSFER_BLOCK_SIZE))
+        if transferred < count:
+            # The file shrank, but its length has been sent, so the
+            # response must fail rather than end short
+            raise IOError("File truncated: transferred %d of %d bytes" % (transferred, count))
+        self.flush()
+
+    def finish(self):
+        # Flush anything coalesced; also ensures that an empty body
+        # commits the response
+        if self.pending or not self.flushes:
+            self.flush()
+
+
+class NonBlockingWriter(object):
+
+    """Writes body chunks to a servlet output stream in non-blocking mode
+
+    Each chunk is written with exactly one write, because any further
+    write must wait for isReady(); and there is no explicit flushing,
+    given that the container completes non-blocking writes itself.
+    """
+
+    def __init__(self, out, policy):
+        self.out = out
+        self.policy = policy
+        self.flushes = 0
+        self.chunks = ChunkWriter(out, policy.threshold)
+
+    def write(self, data):
+        self.chunks.writeWhole(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        pass
+
+
 class WSGICall(object):
 
-    def __init__(self, environ, req, resp):
+    def __init__(self, environ, req, resp, flush_policy=None):
         self.environ = environ
         self.req = req
         self.resp = resp
         self.headers_set = []
         self.headers_sent = []
         self.wrapped_resp = None
+        self.flush_policy = flush_policy or FlushPolicy()
+        self.writer = None
+        self.content_length = None
+        self.held = None
+        self.held_size = 0
+        self.hold_limit = None
+        self.nonblocking = False
+        self.input = None
+        self.base_status = None
+        self.base_headers = None    # ResponseHeaders already on resp
+        self.prefetcher = None
+        self.aborted = False        # client has gone away
 
     def __repr__(self):
         return "WSGICall(id=%s, environ=%s, req=%s, resp=%s, set=%s, sent=%s, wrapped_resp=%s)" % (
@@ -51,21 +269,231 @@ class WSGICall(object):
         # sometimes things are wrongly deprecated!
         self.resp.setStatus(int(code), msg)
 
+    def may_set_content_length(self, status, response_headers):
+        # Only computed lengths need this check; whatever the
+        # application itself sets is always respected
+        if self.req.getMethod() == "HEAD":
+            return False
+        code = int(status[:3])
+        if code < 200 or code in (204, 304):
+            return False
+        for name, value in response_headers:
+            if name.lower() in ("content-length", "transfer-encoding"):
+                return False
+        return True
+
+    def may_sendfile(self, status, response_headers, length):
+        # As for a computed length, except that the application may
+        # have set Content-Length itself, as long as it is this length
+        other_headers = []
+        for name, value in response_headers:
+            if name.lower() != "content-length":
+                other_headers.append((name, value))
+            elif not value.strip().isdigit() or int(value) != length:
+                return False
+        return self.may_set_content_length(status, other_headers)
+
+    def measure(self, result, prebuffer=0):
+        """Arranges for Content-Length to be set from result, if possible
+
+        Per PEP 3333, the length of a list or tuple result is that of
+        its chunks, and a result whose len() is 1 has a body that is
+        its first chunk, so it is held until iteration completes.
+        Otherwise, given a positive prebuffer, up to that many bytes
+        are held before committing headers, so any body that fits has
+        its exact length sent.
+        """
+        if self.headers_sent:
+            return   # the write callable was already used
+        if isinstance(result, FileWrapper) and result.transferable():
+            self.content_length = result.region()[1]
+            return
+        if isinstance(result, (list, tuple)):
+            self.content_length = sum(len(data) for data in result)
+            return
+        if self.nonblocking:
+            return   # releasing held output would need more than one write
+        try:
+            single = len(result) == 1
+        except TypeError:
+            single = False
+        if single:
+            self.hold(None)
+        elif prebuffer > 0:
+            self.hold(prebuffer)
+
+    def hold(self, limit):
+        # Hold writes, including through the write callable, until
+        # more than limit bytes have been written (or indefinitely if
+        # None) or iteration completes, whichever is first
+        self.held = []
+        self.held_size = 0
+        self.hold_limit = limit
+
+    def release(self):
+        held, self.held = self.held, None
+        for data in held:
+            self.write_now(data)
+
+    def send_headers(self):
+        # Before the first output, send the stored headers
+        status, response_headers = self.headers_sent[:] = self.headers_set
+        if self.base_headers is not None:
+            # Only write back what was changed from the headers of a
+            # filter chain, which the response already has
+            self.base_headers.update(response_headers)
+            if status != self.base_status:
+                self.set_status(status)
+        else:
+            self.set_status(status)
+            for name, value in response_headers:
+                self.resp.addHeader(name, value.encode("latin1"))
+        if self.content_length is not None and self.may_set_content_length(status, response_headers):
+            self.resp.setContentLengthLong(self.content_length)
+
     def write(self, data):
+        if self.prefetcher is not None:
+            # Output is being written on another thread, so the write
+            # callable's output must follow the chunks before it
+            self.prefetcher.put(data)
+        else:
+            self.write_now(data)
+
+    def write_now(self, data):
         if not self.headers_set:
              raise AssertionError("write() before start_response()")
+        self.check_aborted()
+
+        if self.held is not None:
+            self.held.append(data)
+            self.held_size += len(data)
+            if self.hold_limit is not None and self.held_size > self.hold_limit:
+                self.release()
+            return
 
         if not self.headers_sent:
-             # Before the first output, send the stored headers
-             status, response_headers = self.headers_sent[:] = self.headers_set
-             self.set_status(status)
-             for name, value in response_headers:
-                 self.resp.addHeader(name, value.encode("latin1"))
+            self.send_headers()
 
-        out = self.resp.getOutputStream()
+        if self.writer is None:
+            writer_class = NonBlockingWriter if self.nonblocking else ResponseWriter
+            self.writer = writer_class(self.resp.getOutputStream(), self.flush_policy)
         # print >> sys.stderr, "Writing data %r to output stream" % (data,)
-        out.write(array.array("b", data))
-        out.flush()
+        try:
+            self.writer.write(data)
+        except IOException:
+            self.abort()
+            raise
+
+    def select_ranges(self, size):
+        """Applies any Range request to a file response of size bytes
+
+        Returns the ByteRanges to send, having rewritten the status
+        and headers for a 206 or 416 response; or None if the whole
+        file is to be sent.
+        """
+        status, response_headers = self.headers_set
+        if not status.startswith("200") or self.req.getMethod() != "GET":
+            return None
+        headers = dict((name.lower(), value) for name, value in response_headers)
+        if "content-range" in headers:
+            return None
+        ranges = parse_ranges(self.req.getHeader("Range"), size)
+        if ranges is None or not if_range_matches(self.req.getHeader("If-Range"), headers):
+            if "accept-ranges" not in headers:
+                self.headers_set[:] = [status, list(response_headers) + [("Accept-Ranges", "bytes")]]
+            return None
+        if not ranges:
+            self.headers_set[:] = ["416 Range Not Satisfiable", [
+                (name, value) for name, value in response_headers if name.lower() != "content-length"] + [
+                ("Content-Range", "bytes */%d" % (size,))]]
+            self.content_length = 0
+            return ByteRanges([], size, None)
+        byte_ranges = ByteRanges(ranges, size, headers.get("content-type"))
+        replaced = byte_ranges.headers()
+        replaced_names = set(name.lower() for name, value in replaced) | set(["content-length"])
+        self.headers_set[:] = ["206 Partial Content", [
+            (name, value) for name, value in response_headers if name.lower() not in replaced_names] + replaced]
+        self.content_length = byte_ranges.content_length()
+        return byte_ranges
+
+    def write_file(self, wrapper, byte_ranges=True):
+        """Sends the rest of the file wrapped by wrapper, without reading it into Python"""
+        position, count = wrapper.region()
+        selected = None
+        if byte_ranges and not self.headers_sent:
+            selected = self.select_ranges(count)
+        if selected is None:
+            parts = [("", 0, count - 1)]
+        else:
+            parts = list(selected.parts())
+
+        if (not self.headers_sent and len(parts) == 1 and wrapper.path and
+                self.req.getAttribute(SENDFILE_SUPPORT)):
+            status, response_headers = self.headers_set
+            prefix, first, last = parts[0]
+            if self.may_sendfile(status, response_headers, last - first + 1):
+                # Tomcat sends the file itself once this request completes
+                self.req.setAttribute(SENDFILE_FILENAME, wrapper.path)
+                self.req.setAttribute(SENDFILE_START, Long(position + first))
+                self.req.setAttribute(SENDFILE_END, Long(position + last + 1))
+                self.send_headers()
+                return
+
+        if self.writer is None:
+            self.write("")   # send headers now
+        for prefix, first, last in parts:
+            if prefix:
+                self.write(prefix)
+            if first is not None and last >= first:
+                try:
+                    self.writer.transfer(wrapper.channel, position + first, last - first + 1, wrapper.blksize)
+                except IOException:
+                    self.abort()
+                    raise
+
+    def flush(self):
+        # Only meaningful once the body has started, given that we
+        # don't send headers until then
+        if self.writer is not None:
+            try:
+                self.writer.flush()
+            except IOException:
+                self.abort()
+                raise
+
+    def finish(self):
+        # Any output still held is the complete body, so its length
+        # is known. Then flush any coalesced output at the end of
+        # iteration, and report how many flushes this response caused
+        self.check_aborted()
+        if self.held is not None:
+            self.content_length = self.held_size
+            self.release()
+        if self.writer is not None:
+            try:
+                self.writer.finish()
+            except IOException:
+                self.abort()
+                raise
+            self.req.setAttribute(FLUSHES_ATTRIBUTE, self.writer.flushes)
+
+    def abort(self):
+        # Any IOException from the response's output stream means the
+        # client has gone away - Tomcat's ClientAbortException and
+        # Jetty's EofException are both IOExceptions - as does an error
+        # or timeout of an async request
+        self.aborted = True
+
+    def check_aborted(self):
+        # So output fails fast, even where a filter chain or middleware
+        # swallowed the original exception
+        if self.aborted:
+            raise ClientDisconnected("Client disconnected")
+
+    def close_input(self):
+        # Releases any spooled request body
+        if self.input is not None:
+            self.input.close()
 
     def close(self):
         # print >> sys.stderr, "Would close output stream... FIXME"
@@ -76,9 +504,15 @@ class WSGICall(object):
             try:
                 if self.headers_sent:
                     # Re-raise original exception if headers sent
-                    raise exc_info[1].with_traceback(exc_info[2])
+                    raise exc_info[0], exc_info[1], exc_info[2]
             finally:
                 exc_info = None     # avoid dangling circular ref
+            # Body output only held back is replaced, along with the
+            # status and headers, so its length no longer applies
+            if self.held is not None:
+                self.held = []
+                self.held_size = 0
+            self.content_length = None
         elif self.headers_set:
             raise AssertionError("Headers already set!")
 
@@ -98,37 +532,141 @@ class WSGICall(object):
 
 def get_application(config):
     # FIXME add more error checking on application setup
-    application_name = config.getInitParameter("wsgi.handler")
-    parts = application_name.split(".")
-    if len(parts) < 2 or not all(parts):
-        # FIXME better exception class
-        raise Exception("wsgi.handler not configured properly", application_name)
-    module_name = ".".join(parts[:-1])
+    module_name, name = handler_name(config.getInitParameter("wsgi.handler"))
     module = __import__(module_name)
-    return getattr(module, parts[-1])
+    return getattr(module, name)
 
 
 class ServletBase(object):
 
     def do_init(self, config):
-        self.application = get_application(config)
+        pool_size = init_param(config, "fireside.app_pool", 0, int)
+        if pool_size > 0:
+            # Each request instead calls one of the pooled instances
+            self.application = None
+            self.app_pool = ApplicationPool(
+                config.getInitParameter("wsgi.handler"), pool_size,
+                init_param(config, "fireside.app_pool_timeout", 30000, int),
+                init_param(config, "fireside.retry_after", 1, int))
+        else:
+            self.application = get_application(config)
+            self.app_pool = None
+        self.flush_policy = FlushPolicy.from_config(config)
+        self.environ_policy = EnvironPolicy.from_config(config)
+        self.prebuffer = init_param(config, "fireside.prebuffer", 0, int)
+        self.byte_ranges = init_param(config, "fireside.byte_ranges", True, boolean)
+        self.spool_threshold = init_param(config, "fireside.spool_threshold", 0, int)
+        self.spool_directory = init_param(config, "fireside.spool_directory", None, File)
         self.err_log = AdaptedErrLog(self)
+        self.dispatcher = AsyncDispatcher.from_config(config, self.err_log)
+        self.aborts = AtomicLong()   # responses stopped because the client went away
+        self.admission = AdmissionControl.from_config(config)
+        self.hot_swap = None   # set up by WSGIServlet, once warmed up
+        self.prefetch = init_param(config, "fireside.prefetch", 0, int)
+        if self.prefetch > 0:
+            threads = init_param(config, "fireside.prefetch_threads", 16, int)
+            self.prefetch_executor = ThreadPoolExecutor(
+                0, threads, 60, TimeUnit.SECONDS, SynchronousQueue(),
+                ThreadFactoryBuilder().setNameFormat("fireside-writer-%d").setDaemon(True).build())
+        else:
+            self.prefetch_executor = None
+
+    def do_destroy(self):
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+        if self.prefetch_executor is not None:
+            self.prefetch_executor.shutdown()
+        if self.app_pool is not None:
+            self.app_pool.close()
+        if self.hot_swap is not None:
+            self.hot_swap.shutdown()
+
+    def get_input(self, req):
+        # With spooling, the body can be read more than once, by
+        # seeking, without holding all of a large body in memory
+        if self.spool_threshold > 0:
+            return WSGIInputStream(
+                RequestSpool(req.getInputStream(), self.spool_threshold, self.spool_directory))
+        return WSGIInputStream(req.getInputStream())
+
+    def get_shared_bridge(self, req):
+        # Only the bridge of a filter in front of this servlet, for the
+        # same request; not one left over from before a forward or
+        # include to another path
+        bridge = req.getAttribute(BRIDGE_ATTRIBUTE)
+        if (isinstance(bridge, RequestBridge) and
+                req.getDispatcherType() == DispatcherType.REQUEST and
+                req.getServletPath() == bridge.asWrapper().getServletPath()):
+            return bridge
+        return None
 
-    def get_bridge(self, req):
-        return RequestBridge(req, self.err_log, AdaptedInputStream(req.getInputStream()))
+    def get_bridge(self, req, wsgi_input=None):
+        if wsgi_input is None:
+            wsgi_input = self.get_input(req)
+        bridge = RequestBridge(req, self.err_log, wsgi_input, FileWrapper)
+        if self.app_pool is not None:
+            bridge.multithread = False
+        return bridge
 
     def do_wsgi_call(self, call):
-        # print >> sys.stderr, "About to make call WSGI app=%s" % (self.application,)
-        result = self.application(call.environ, call.start_response)
+        """Calls the application, then writes its result
+
+        Returns True if the result is instead being written by
+        non-blocking output, which will complete the async request.
+        """
+        if self.hot_swap is not None:
+            return self.hot_swap.call(call, self.call_application)
+        if self.app_pool is None:
+            return self.call_application(self.application, call)
+        # The instance is only checked back in once its result is
+        # closed, so non-blocking output, which would iterate it
+        # later on another thread, is not used; likewise with hot
+        # swapping, where it is released once its requests complete
+        instance = self.app_pool.checkout()
+        if instance is None:
+            self.app_pool.reject(call.resp)
+            return False
+        try:
+            with instance as application:
+                return self.call_application(application, call)
+        finally:
+            self.app_pool.checkin(instance)
+
+    def call_application(self, application, call):
+        # print >> sys.stderr, "About to make call WSGI app=%s" % (application,)
+        result = application(call.environ, call.start_response)
+
+        if (self.dispatcher is not None and self.dispatcher.nonblocking_output and
+                self.app_pool is None and self.hot_swap is None and call.req.isAsyncStarted()):
+            try:
+                self.dispatcher.stream(call, result, self.aborts)
+            except:
+                if hasattr(result, "close"):
+                    result.close()
+                raise
+            return True
+
+        if self.dispatcher is not None and call.req.isAsyncStarted():
+            call.req.getAsyncContext().addListener(DisconnectListener(call))
 
         # print >> sys.stderr, "result=%s" % (result,)
         try:
-            for data in result:
-                if data:    # don't send headers until body appears
-                    # print >> sys.stderr, "Writing data %r" % (data,)
-                    call.write(data)
+            call.measure(result, self.prebuffer)
+            if isinstance(result, FileWrapper) and result.transferable():
+                call.write_file(result, self.byte_ranges)
+            elif self.prefetch_executor is not None and not isinstance(result, (list, tuple)):
+                Prefetcher(call, self.prefetch_executor, self.prefetch).run(result)
+            else:
+                write_result(call, result)
             if not call.headers_sent:
                 call.write("")   # send headers now if body was empty
+            call.finish()
+        except (IOException, ClientDisconnected):
+            # Nothing more can be sent, so just stop, closing the
+            # result right away
+            if not call.aborted:
+                raise
+            self.aborts.incrementAndGet()
         finally:
             #print >> sys.stderr, "Closing call %s" % (call,)
             #call.close()
@@ -138,181 +676,434 @@ class ServletBase(object):
                 result.close()
             
 
-class FilterBase(object):
-
-    def do_init(self, config):
-        self.application = get_application(config)
-        self.err_log = AdaptedErrLog(self)
-
-    def filter_wsgi_call(self, req, resp, chain):
-        bridge = RequestBridge(req, self.err_log, AdaptedInputStream(req.getInputStream()))
-        environ = dict_builder(bridge.asMap)()
-        # Can only set up the actual wrapped response once the filter coroutine is set up
-        wrapped_req = bridge.asWrapper()
-        call = WSGICall(environ, req, resp)
-
-        progress = []  # FIXME currently we are using three states - [], [False], [True] - which is pretty awful
-        # FIXME instead something like [PROBING], [INCREMENTAL], [BATCH] probably would work better
-        call_filter = None
-
-        def setup_coupler():
-            (yield)
-
-            # @validator
-            def null_app(environ, start_response):
-                # print "null_app environ=%s start_response=%s" % (environ, start_response)
-                #for name in call.wrapped_resp.getHeaders():
-                #    ...
-                response_headers = []
-                for name in call.wrapped_resp.getHeaderNames():
-                    for value in call.wrapped_resp.getHeaders(name):
-                        response_headers.append((str(name), value.encode("latin1")))
-
-                # Is it possible to get the underlying status from the response?
-                status = "%s FIXME" % (call.wrapped_resp.getStatus(),)
-
-                # Reset the underlying response so we can re-write headers/status;
-                # otherwise we will get duplicated headers
-                call.wrapped_resp.reset()
-
-                start_response(status, response_headers)
-                output_stream = call.wrapped_resp.getOutputStream()
-                for i, chunk in enumerate(output_stream):
-                    # print >> sys.stderr, "Got this chunk %d %r (%r)" % (i, chunk, progress)
-
-                    # check if stalled (is there no progress in the below while loop?)
-                    # if stalled, we have to wait until the filter chain is complete before
-                    # we can return another chunk
-
-                    yield chunk
-
-                    if not progress:
-                        progress[:] = [False]  # need three states! FIXME
-
-                        def f(s):
-                            pass
-                            # print "null_app stalled value %r" % (s,)
-
-                        output_stream.callback = f
-                        call_filter()
-                        # print >> sys.stderr, "Filter chain completed"
-                        for chunk in output_stream.getChunks():
-                            yield chunk
-                        return
-
-                    if i > 100:
-                        raise AssertionError("Stopping, obviously we are broken!!!!!")
-
-            wsgi_filter = self.application(null_app)
-            result = wsgi_filter(call.environ, call.start_response)
-            # print >> sys.stderr, "got result from wsgi_filter %s" % (result,)
-            it = iter(result)
-            while True:
-                try:
-                    # print >> sys.stderr, "waiting on yield"
-                    if not progress or progress[0] != False:
-                        data = (yield)
-                    else:
-                        data = None
-                    # print >> sys.stderr, "completed yield, waiting on next of %s" % (it,)
-                    filtered = next(it)
-                    progress[:] = [True]
-                    # print >> sys.stderr, "%r -> %r" % (data, filtered)
-                    # print >> sys.stderr, "call %r" % (call,)
-                    call.write(filtered)
-                except StopIteration:
-                    break
-            if not call.headers_sent:
-                call.write("")   # send headers now if body was empty
-
-        coupler = setup_coupler()
-        # fill in the wrapping servlet response
-        call.wrapped_resp = CaptureHttpServletResponse(resp, coupler.send)
-        call_filter = lambda: chain.doFilter(wrapped_req, call.wrapped_resp)  # FIXME maybe name "complete_filter_chain"?
-        coupler.send(None)  # advance the coroutine to before filtering
-        coupler.send(None)  # advance one more time to after sending the response
-        if not progress or progress[0] != False:
-            # print >> sys.stderr, "Calling filter"
-            call_filter()
+def write_result(call, result):
+    for data in result:
+        if data:    # don't send headers until body appears
+            # print >> sys.stderr, "Writing data %r" % (data,)
+            call.write(data)
         else:
-            pass
-            # print >> sys.stderr, "Not calling filter, should be done in null_app"
+            call.flush()   # empty bytestring is a hint to flush
+        call.check_aborted()   # before producing the next chunk
 
-        # print >> sys.stderr, "Closing coupler"
-        coupler.close() # put in a try-finally context
 
+class Prefetcher(object):
 
-class AdaptedInputStream(object):
+    """Writes a WSGI result on another thread, as it is iterated
 
-    # FIXME can we use available to be smarter/more responsive? related to supporting async ops
+    So an application can produce its next chunk - rendering a
+    template, reading rows - while the previous one is being written
+    to the client. The application is still iterated, and closed, on
+    the request thread, so any thread-local state it uses is as usual.
+    Chunks, including those passed to the write callable, are handed
+    over in order through a queue of at most depth chunks.
 
-    def __init__(self, input_stream):
-        self.input_stream = input_stream
+    If writing fails, eg because the client went away, iteration stops
+    with that exception as soon as the next chunk is handed over; if
+    iteration fails, the chunks before are written first.
+    """
 
-    def _read_chunk(self, size):
-        # Read a chunk of data from input, or None
-        chunk = bytearray(size)
-        result = self.input_stream.read(chunk)
-        if result > 0:
-            if result < size:
-                chunk = buffer(chunk, 0, result)
-            return chunk
-        return None
+    END = object()
 
-    def read(self, size=None):
-        if size is None:
-            chunks = []
+    def __init__(self, call, executor, depth):
+        self.call = call
+        self.executor = executor
+        self.queue = Queue(depth)
+        self.written = threading.Event()
+        self.failure = None
+
+    def run(self, result):
+        try:
+            self.executor.execute(self.write_all)
+        except RejectedExecutionException:
+            # all writer threads are busy, so just write as usual
+            write_result(self.call, result)
+            return
+        self.call.prefetcher = self
+        try:
+            for data in result:
+                self.put(data)
+        finally:
+            self.call.prefetcher = None
+            self.queue.put(self.END)
+            self.written.wait()
+        self.check()
+
+    def put(self, data):
+        self.check()
+        self.queue.put(data)
+        self.check()
+
+    def check(self):
+        if self.failure is not None:
+            exc_info = self.failure
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.call.check_aborted()
+
+    def write_all(self):
+        # Runs on a writer thread; once writing has failed, the rest of
+        # the queue is just drained, so the request thread never waits
+        try:
             while True:
-                chunk = self._read_chunk(8192)
-                if chunk is None:
+                data = self.queue.get()
+                if data is self.END:
                     break
-                chunks.append(chunk)
-            return "".join((str(chunk) for chunk in chunks))
+                if self.failure is None:
+                    try:
+                        if data:
+                            self.call.write_now(data)
+                        else:
+                            self.call.flush()
+                    except:
+                        self.failure = sys.exc_info()
+        finally:
+            self.written.set()
+
+
+class FilterCoupling(object):
+
+    """Couples a Java filter chain to the WSGI middleware wrapping it
+
+    The chain pushes its output by writing to the captured response;
+    the middleware pulls it by iterating over the application it wraps,
+    which is `application` here. The two are run on the request thread
+    without holding the response: each chunk the chain writes is queued,
+    then the middleware is advanced until it has taken the chunk,
+    writing whatever it yields. So the chain's writes block until the
+    middleware catches up, and at most one chunk is pending.
+
+    This relies on the middleware pulling at most one chunk for each
+    value it yields, as PEP 3333 requires; when no chunk is pending, it
+    is given an empty bytestring. So before the chain runs, the
+    middleware is advanced once, given an empty bytestring: middleware
+    that then pulls again - collecting or compressing all of the
+    output, say - or that consumes the whole application in its
+    __call__, like WebOb's Request.get_response, has the chain run to
+    completion at that point, holding its output, since it needs all
+    of it anyway.
+
+    Middleware that returns the application's iterable unchanged, like
+    most that only deal with headers, cannot change the body. Unless
+    passthrough is False, the chain's output then goes straight to the
+    response, and only the middleware's changes to the status and
+    headers are applied, just before the response is committed.
+    """
+
+    def __init__(self, call, bridge, chain, buffers=None, passthrough=True):
+        self.call = call
+        self.bridge = bridge
+        self.chain = chain
+        self.wrapped_req = bridge.asWrapper()
+        self.pending = deque()
+        self.chain_started = False
+        self.chain_done = False
+        self.holding = False     # chain output is held until the chain completes
+        self.starved = False     # middleware was given an empty bytestring this step
+        self.probing = False     # middleware is advanced before the chain runs
+        self.iterator = None     # over the middleware's result
+        self.finished = False    # middleware has no more output
+        self.passthrough = passthrough
+        self.app_iter = None     # as returned by application
+        self.start_response = None
+        # Given a BufferPool, small writes downstream are coalesced into
+        # chunks of its buffer size
+        if buffers is None:
+            call.wrapped_resp = CaptureHttpServletResponse(call.resp, self.sink())
         else:
-            chunk = self._read_chunk(size)
-            if chunk is None:
-                return ""
+            call.wrapped_resp = CaptureHttpServletResponse(call.resp, self.sink(), buffers)
+
+    def sink(self):
+        # Receives each chunk of the chain's output
+        return self.push
+
+    def run(self, middleware):
+        result = middleware(self.application)(self.call.environ, self.call.start_response)
+        if self.passes_through(result):
+            self.run_passthrough()
+            return
+        try:
+            self.iterator = iter(result)
+            if not self.chain_started:
+                # Middleware that pulls more than it yields has to be
+                # found out now, while the chain can still run to
+                # completion under it
+                self.probing = True
+                try:
+                    self.step()
+                finally:
+                    self.probing = False
+            if not self.chain_started:
+                self.run_chain()
+            # Then whatever the middleware has left, including
+            # everything if the chain's output was held
+            while self.step():
+                pass
+            if not self.call.headers_sent:
+                self.call.write("")   # send headers now if body was empty
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    def passes_through(self, result):
+        return (self.passthrough and result is self.app_iter and
+                not self.chain_started and not self.call.headers_sent)
+
+    def run_passthrough(self):
+        self.call.wrapped_resp = PassThroughHttpServletResponse(self.call.resp, self.commit_headers)
+        self.run_chain()
+
+    def commit_headers(self):
+        # Passes the chain's status and headers through the middleware,
+        # then applies any changes it made
+        self.replay_headers(self.start_response, self.snapshot_headers(body_replaced=False))
+        if not self.call.headers_set:
+            raise AssertionError("WSGI middleware did not call start_response")
+        self.call.send_headers()
+
+    def run_chain(self):
+        self.chain_started = True
+        req = self.call.req
+        # A downstream fireside servlet then shares this environ,
+        # including any changes the middleware made to it
+        req.setAttribute(BRIDGE_ATTRIBUTE, self.bridge)
+        try:
+            self.chain.doFilter(self.wrapped_req, self.call.wrapped_resp)
+            self.call.wrapped_resp.finish()
+        finally:
+            req.removeAttribute(BRIDGE_ATTRIBUTE)
+            self.chain_done = True
+
+    def push(self, chunk):
+        # Called by the captured output stream for each chunk written
+        if not chunk or self.finished:
+            return   # discarded if the middleware stopped iterating
+        self.pending.append(chunk)
+        if self.holding or self.iterator is None:
+            return
+        while self.pending and self.step():
+            pass
+
+    def step(self):
+        """Advances the middleware by one value, writing it
+
+        Returns False once the middleware is exhausted.
+        """
+        self.starved = False
+        self.call.check_aborted()
+        try:
+            data = next(self.iterator)
+        except StopIteration:
+            self.finished = True
+            self.pending.clear()
+            return False
+        if data:
+            self.call.write(data)
+        return True
+
+    def snapshot_headers(self, body_replaced=True):
+        # The chain's status and headers. They stay on the response, so
+        # only what the middleware changes is written back
+        resp = self.call.resp
+        # Is it possible to get the underlying status from the response?
+        return "%s FIXME" % (resp.getStatus(),), ResponseHeaders(resp, body_replaced)
+
+    def replay_headers(self, start_response, snapshot=None):
+        # Passes the chain's status and headers on to the middleware
+        call = self.call
+        call.base_status, call.base_headers = snapshot or self.snapshot_headers()
+        start_response(call.base_status, call.base_headers.asList())
+
+    def application(self, environ, start_response):
+        # The application seen by the middleware
+        self.start_response = start_response
+        self.app_iter = self.iterate(environ, start_response)
+        return self.app_iter
+
+    def iterate(self, environ, start_response):
+        # Replays the chain's status and headers, then yields its output
+        while not self.chain_started:
+            if self.probing and not self.starved:
+                self.starved = True
+                yield ""
             else:
-                return str(chunk)
-
-    def readline(self, size=None):
-        if size is not None:
-            chunk = bytearray(size)
-            result = self.input_stream.readLine(chunk, 0, size)
-            if result == -1:
-                return ""
+                self.holding = True
+                self.run_chain()
+        self.replay_headers(start_response)
+        while True:
+            if self.pending:
+                yield self.pending.popleft()
+            elif self.chain_done:
+                return
+            elif self.starved:
+                # More output is only available once this step returns
+                # to the chain, which the middleware is not allowing;
+                # unlike when probing, the chain cannot be completed
+                # from here, since it is the caller of this step
+                raise AssertionError(
+                    "WSGI middleware must yield a value for each one it takes "
+                    "from the filter chain (PEP 3333)")
             else:
-                return str(buffer(chunk, 0, result))
-        else:
-            chunks = []
-            while True:
-                # just assume relatively long lines, although there's
-                # a probably a better heuristic amount to allocate
-                chunk = bytearray(512)
-                result = self.input_stream.readLine(chunk, 0, 512)
-                if result == -1:
-                    break
-                chunks.append(chunk)
-                if result < 512 or chunk[511] == "\n":
-                    break
-            return "".join((str(chunk) for chunk in chunks))
+                self.starved = True
+                yield ""
+
+
+class PipedFilterCoupling(FilterCoupling):
+
+    """Runs the filter chain on a worker thread, piping its output
+
+    The chain writes into a bounded ChunkPipe, waiting while it is
+    full, as the request thread runs the middleware over the chunks in
+    the pipe. So rendering downstream and processing in Python overlap,
+    and middleware need not follow PEP 3333's rules on yielding for
+    its output to be streamed.
+
+    The chain is started once the middleware iterates over the
+    application's result, or otherwise returns. It sees the changes
+    the middleware made to the environ until then; later changes, made
+    while both run, are only seen if made before the chain reads that
+    value (see RequestBridge). If the middleware stops iterating or fails, the pipe is
+    cancelled, failing the chain's further writes; if the chain fails,
+    the middleware gets its exception at the end of the pipe, or if it
+    never reaches the end, once it returns.
+
+    The chain's status and headers are taken on the worker thread, as
+    the chain first writes or otherwise completes, so the request thread
+    never reads the response while the chain may still be changing it.
+    As with a committed response, later changes are not seen.
+    """
+
+    def __init__(self, call, bridge, chain, buffers, passthrough, executor, permits, capacity):
+        self.pipe = ChunkPipe(capacity)
+        self.headers = None   # snapshot of the chain's status and headers
+        FilterCoupling.__init__(self, call, bridge, chain, buffers, passthrough)
+        self.executor = executor
+        self.permits = permits
+        self.task = None
+        self.failure = None   # of the chain, until raised
+        self.abandoned = False   # chain wrote after the middleware stopped reading
+
+    def sink(self):
+        return self.put
+
+    def put(self, chunk):
+        # Runs on the worker thread; the pipe then publishes the snapshot
+        # to the request thread
+        if self.headers is None:
+            self.headers = self.snapshot_headers()
+        if self.pipe.isCancelled():
+            self.abandoned = True   # so this put fails
+        self.pipe.put(chunk)
+
+    def produce(self):
+        # Runs on a worker thread
+        try:
+            self.run_chain()
+        except:
+            # Unless the chain only failed because the middleware
+            # stopped reading its output
+            if not self.abandoned:
+                self.failure = sys.exc_info()
+        finally:
+            try:
+                if self.headers is None:
+                    self.headers = self.snapshot_headers()
+            finally:
+                self.pipe.close()
+                self.permits.release()
+
+    def start(self):
+        if not self.chain_started:
+            self.chain_started = True
+            task = FutureTask(self.produce, None)
+            self.executor.execute(task)
+            self.task = task
+
+    def run(self, middleware):
+        try:
+            result = middleware(self.application)(self.call.environ, self.call.start_response)
+            if self.passes_through(result):
+                # There is nothing to pipe, so the chain is run here
+                self.run_passthrough()
+                return
+            try:
+                self.start()
+                for data in result:
+                    if data:
+                        self.call.write(data)
+                if not self.call.headers_sent:
+                    self.call.write("")   # send headers now if body was empty
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        finally:
+            # The chain can only still be writing if the middleware did
+            # not read all of its output, so stop it
+            self.pipe.cancel()
+            if self.task is None:
+                self.permits.release()   # the chain never ran
+            else:
+                self.task.get()
+        if self.failure is not None:
+            # Not yet raised to the middleware, so raised here, as if
+            # the chain had run on this thread
+            self.raise_failure()
+
+    def iterate(self, environ, start_response):
+        self.start()
+        self.pipe.hasNext()   # waits for the chain to write, or complete
+        self.replay_headers(start_response, self.headers)
+        for chunk in self.pipe:
+            yield chunk
+        if self.failure is not None:
+            self.raise_failure()
+
+    def raise_failure(self):
+        exc_info, self.failure = self.failure, None
+        raise exc_info[0], exc_info[1], exc_info[2]
+
 
-    def readlines(self, hint=None):
-        # According to WSGI spec, can just ignore hint, so this will
-        # suffice
-        return [self.readline()]
+class FilterBase(object):
 
-    def next(self):
-        line = self.readline()
-        if line is "":
-            raise StopIteration
+    def do_init(self, config):
+        self.application = get_application(config)
+        self.flush_policy = FlushPolicy.from_config(config)
+        self.err_log = AdaptedErrLog(self)
+        self.aborts = AtomicLong()
+        threads = init_param(config, "fireside.filter_threads", 0, int)
+        self.pipe_capacity = init_param(config, "fireside.filter_pipe", 16, int)
+        chunk_size = init_param(config, "fireside.filter_chunk_size", 0, int)
+        # Shared by this filter's responses, so each does not allocate its own
+        self.buffers = BufferPool(chunk_size) if chunk_size > 0 else None
+        self.passthrough = init_param(config, "fireside.filter_passthrough", True, boolean)
+        if threads > 0:
+            self.chain_executor = ThreadPoolExecutor(
+                threads, threads, 60, TimeUnit.SECONDS, LinkedBlockingQueue(),
+                ThreadFactoryBuilder().setNameFormat("fireside-filter-%d").setDaemon(True).build())
+            # Requests only use a worker if one is free, rather than wait
+            self.chain_permits = Semaphore(threads)
         else:
-            return line
+            self.chain_executor = None
 
-    __next__ = next   # a nod to Python 3
+    def do_destroy(self):
+        if self.chain_executor is not None:
+            self.chain_executor.shutdown()
 
-    def __iter__(self):
-        return self
+    def filter_wsgi_call(self, req, resp, chain):
+        bridge = RequestBridge(req, self.err_log, WSGIInputStream(req.getInputStream()), FileWrapper)
+        environ = dict_builder(bridge.asMap)()
+        call = WSGICall(environ, req, resp, self.flush_policy)
+        if self.chain_executor is not None and self.chain_permits.tryAcquire():
+            coupling = PipedFilterCoupling(
+                call, bridge, chain, self.buffers, self.passthrough,
+                self.chain_executor, self.chain_permits, self.pipe_capacity)
+        else:
+            coupling = FilterCoupling(call, bridge, chain, self.buffers, self.passthrough)
+        try:
+            coupling.run(self.application)
+            call.finish()
+        except (IOException, ClientDisconnected):
+            if not call.aborted:
+                raise
+            self.aborts.incrementAndGet()
 
 
 class AdaptedErrLog(object):
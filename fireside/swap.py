@@ -0,0 +1,225 @@
+"""Hot swapping of a servlet's WSGI application
+
+So a change to only Python code can be deployed without redeploying
+the webapp, and so without losing the JIT's work and the caches of
+every servlet in it. On request - over JMX, or by touching a watched
+file - the application is loaded anew, in its own PythonInterpreter
+and PySystemState (see pool.IsolatedApplication), so its modules are
+imported afresh. It is then warmed up, if the servlet has a warm-up,
+and only then replaces the current application. Requests already
+using the replaced application complete with it; it is released once
+the last of them does.
+"""
+
+import sys
+import threading
+import time
+import traceback
+
+from com.google.common.util.concurrent import ThreadFactoryBuilder
+from java.io import File
+from java.lang.management import ManagementFactory
+from java.util.concurrent import Executors, TimeUnit
+from java.util.concurrent.atomic import AtomicBoolean, AtomicInteger
+from javax.management import ObjectName, StandardMBean
+from org.python.core import Py
+from org.python.tools.fireside import ApplicationSwapMBean
+
+from .config import boolean, init_param
+from .pool import IsolatedApplication
+
+
+class Generation(object):
+
+    """One loaded application, counting the requests using it"""
+
+    def __init__(self, number, application, instance=None):
+        self.number = number
+        self.application = application
+        self.instance = instance   # IsolatedApplication, or None if loaded by init
+        self.in_flight = AtomicInteger()
+        self.retired = False
+        self.closed = AtomicBoolean()
+
+    def __repr__(self):
+        return "Generation(number=%s, in_flight=%s, retired=%s)" % (
+            self.number, self.in_flight, self.retired)
+
+    def run(self, handler, call):
+        # Unlike IsolatedApplication's context manager, safe for
+        # concurrent requests. For a swapped in generation, this takes
+        # Py.setSystemState's global lock twice per request
+        if self.instance is None:
+            return handler(self.application, call)
+        saved = Py.setSystemState(self.instance.state)
+        try:
+            return handler(self.application, call)
+        finally:
+            Py.setSystemState(saved)
+
+    def leave(self):
+        if self.in_flight.decrementAndGet() == 0 and self.retired:
+            self.close()
+
+    def retire(self):
+        self.retired = True
+        if self.in_flight.get() == 0:
+            self.close()
+
+    def close(self):
+        # May race between retire and the last request leaving
+        if self.closed.compareAndSet(False, True) and self.instance is not None:
+            self.instance.close()
+
+
+class SwapControl(ApplicationSwapMBean):
+
+    def __init__(self, hot_swap):
+        self.hot_swap = hot_swap
+
+    def swap(self):
+        self.hot_swap.swap()
+
+    def getGeneration(self):
+        return self.hot_swap.current.number
+
+    def getInFlight(self):
+        return self.hot_swap.current.in_flight.get()
+
+    def getDraining(self):
+        return self.hot_swap.draining()
+
+
+class HotSwap(object):
+
+    """Replaces a servlet's application with a newly loaded, warmed up one
+
+    The swap itself is a single assignment of the current generation;
+    requests pin the generation they start with until they complete.
+    Swaps are serialized, and one that fails, in loading or warming up
+    the new application, leaves the current one in place.
+    """
+
+    def __init__(self, servlet, application_name, name=None, watched=None, poll=2000):
+        self.servlet = servlet
+        self.application_name = application_name
+        self.current = Generation(0, servlet.application)
+        self.retired = []
+        self.lock = threading.Lock()
+        self.pinned = threading.local()   # generation being warmed up by this thread
+        self.mbean_name = None
+        self.scheduler = None
+        if name is not None:
+            self.register(name)
+        if watched is not None:
+            self.watch(watched, poll)
+
+    def __repr__(self):
+        return "HotSwap(application=%s, current=%s, draining=%s)" % (
+            self.application_name, self.current, self.draining())
+
+    @classmethod
+    def from_config(cls, config, servlet):
+        """Returns a hot swap if fireside.hot_swap is enabled, otherwise None"""
+        if not init_param(config, "fireside.hot_swap", False, boolean):
+            return None
+        if servlet.app_pool is not None:
+            # FIXME better exception class
+            raise Exception("fireside.hot_swap cannot be used with fireside.app_pool")
+        name = None
+        if init_param(config, "fireside.swap_jmx", True, boolean):
+            name = init_param(config, "fireside.swap_name", None) or config.getServletName()
+        return cls(
+            servlet, config.getInitParameter("wsgi.handler"), name,
+            init_param(config, "fireside.swap_file", None, File),
+            init_param(config, "fireside.swap_poll", 2000, int))
+
+    def register(self, name):
+        mbean_name = ObjectName("org.python.tools.fireside:type=ApplicationSwap,name=%s" % (
+            ObjectName.quote(name),))
+        try:
+            ManagementFactory.getPlatformMBeanServer().registerMBean(
+                StandardMBean(SwapControl(self), ApplicationSwapMBean), mbean_name)
+            self.mbean_name = mbean_name
+        except:
+            # eg another servlet of the same name, in another webapp;
+            # a watched file can still be used
+            self.servlet.err_log.writelines(traceback.format_exception(*sys.exc_info()))
+
+    def watch(self, watched, poll):
+        self.watched = watched
+        self.modified = watched.lastModified()   # 0 if it does not exist
+        self.scheduler = Executors.newSingleThreadScheduledExecutor(
+            ThreadFactoryBuilder().setNameFormat("fireside-swap-%d").setDaemon(True).build())
+        self.scheduler.scheduleWithFixedDelay(self.poll, poll, poll, TimeUnit.MILLISECONDS)
+
+    def poll(self):
+        # Runs on the scheduler; creating or touching the file swaps
+        try:
+            modified = self.watched.lastModified()
+            if modified != self.modified:
+                self.modified = modified
+                if modified != 0:
+                    self.swap()
+        except:
+            self.servlet.err_log.writelines(traceback.format_exception(*sys.exc_info()))
+
+    def enter(self):
+        """Returns the generation a request is to use, counting it as in flight"""
+        generation = getattr(self.pinned, "generation", None)
+        if generation is not None:
+            generation.in_flight.incrementAndGet()
+            return generation
+        while True:
+            generation = self.current
+            generation.in_flight.incrementAndGet()
+            if generation is self.current:
+                return generation
+            generation.leave()   # swapped in the meantime, so retry
+
+    def call(self, call, handler):
+        """Calls handler(application, call) with the current application"""
+        generation = self.enter()
+        try:
+            return generation.run(handler, call)
+        finally:
+            generation.leave()
+
+    def swap(self):
+        with self.lock:
+            start = time.time()
+            instance = IsolatedApplication(self.application_name, sys.path)
+            candidate = Generation(self.current.number + 1, instance.application, instance)
+            warmup = getattr(self.servlet, "warmup", None)
+            if warmup is not None:
+                # So that warm-up imports also go into the candidate's
+                # interpreter, not the servlet's
+                self.pinned.generation = candidate
+                saved = Py.setSystemState(instance.state)
+                try:
+                    warmed = warmup.run(self.servlet.call_wsgi)
+                finally:
+                    Py.setSystemState(saved)
+                    del self.pinned.generation
+                if not warmed:
+                    candidate.close()
+                    # FIXME better exception class
+                    raise Exception("Warm-up of %s failed, keeping generation %d" % (
+                        self.application_name, self.current.number))
+            previous, self.current = self.current, candidate
+            self.servlet.application = candidate.application
+            previous.retire()
+            self.retired = [generation for generation in self.retired if not generation.closed.get()]
+            self.retired.append(previous)
+            self.servlet.err_log.write("Swapped in generation %d of %s in %.1f ms\n" % (
+                candidate.number, self.application_name, (time.time() - start) * 1000))
+
+    def draining(self):
+        return len([generation for generation in self.retired if not generation.closed.get()])
+
+    def shutdown(self):
+        if self.scheduler is not None:
+            self.scheduler.shutdownNow()
+        if self.mbean_name is not None:
+            ManagementFactory.getPlatformMBeanServer().unregisterMBean(self.mbean_name)
+        self.current.retire()
@@ -0,0 +1,405 @@
+"""Warming up a WSGI application before the servlet accepts traffic
+
+Otherwise the first requests after a deploy pay for Jython compiling
+code as it is first used, for the JVM's JIT, and for whatever the
+application and its framework import lazily. Given the paths of some
+representative requests, the servlet instead replays them in memory,
+through the usual WSGI call, from its init: for a number of
+iterations, or until the time an iteration takes settles. Modules can
+also be imported up front.
+
+Warm-up requests have an X-Fireside-Warmup header, so applications can
+tell them apart, eg to skip side effects.
+"""
+
+import sys
+import time
+import traceback
+from urllib import unquote_plus
+
+import jarray
+from java.io import BufferedReader, StringReader
+from java.lang import IllegalStateException, String, StringBuffer
+from java.util import Collections, HashMap, Locale
+from javax.servlet import DispatcherType, ServletException
+from javax.servlet.http import HttpServletRequest, HttpServletResponse
+from org.python.tools.fireside import ByteArrayServletInputStream, CaptureServletOutputStream
+
+from .config import boolean, init_param
+
+
+WARMUP_HEADER = "X-Fireside-Warmup"
+
+
+def comma_separated(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class WarmupRequest(HttpServletRequest):
+
+    """An in-memory GET request
+
+    Complete enough for the environ, and for applications and
+    frameworks that look at the request through a wrapper, but with
+    no session, user, or async support.
+    """
+
+    def __init__(self, path):
+        path, _, query = path.partition("?")
+        self.path = path
+        self.query = query or None
+        self.attributes = {}
+        self.headers = {WARMUP_HEADER: "1", "Host": "localhost"}
+        self.encoding = None
+        self.parameters = {}
+        for pair in (query or "").split("&"):
+            if pair:
+                name, _, value = pair.partition("=")
+                self.parameters.setdefault(unquote_plus(name), []).append(unquote_plus(value))
+
+    def __repr__(self):
+        return "WarmupRequest(path=%s, query=%s)" % (self.path, self.query)
+
+    # ServletRequest
+
+    def getAttribute(self, name):
+        return self.attributes.get(name)
+
+    def getAttributeNames(self):
+        return Collections.enumeration(list(self.attributes.keys()))
+
+    def setAttribute(self, name, value):
+        self.attributes[name] = value
+
+    def removeAttribute(self, name):
+        self.attributes.pop(name, None)
+
+    def getCharacterEncoding(self):
+        return self.encoding
+
+    def setCharacterEncoding(self, encoding):
+        self.encoding = encoding
+
+    def getContentLength(self):
+        return -1
+
+    def getContentLengthLong(self):
+        return -1
+
+    def getContentType(self):
+        return None
+
+    def getInputStream(self):
+        return ByteArrayServletInputStream(jarray.zeros(0, "b"))
+
+    def getReader(self):
+        return BufferedReader(StringReader(""))
+
+    def getParameter(self, name):
+        values = self.parameters.get(name)
+        return values[0] if values else None
+
+    def getParameterNames(self):
+        return Collections.enumeration(list(self.parameters.keys()))
+
+    def getParameterValues(self, name):
+        values = self.parameters.get(name)
+        return jarray.array(values, String) if values else None
+
+    def getParameterMap(self):
+        parameters = HashMap()
+        for name, values in self.parameters.iteritems():
+            parameters.put(name, jarray.array(values, String))
+        return Collections.unmodifiableMap(parameters)
+
+    def getProtocol(self):
+        return "HTTP/1.1"
+
+    def getScheme(self):
+        return "http"
+
+    def getServerName(self):
+        return "localhost"
+
+    def getServerPort(self):
+        return 80
+
+    def getRemoteAddr(self):
+        return "127.0.0.1"
+
+    def getRemoteHost(self):
+        return "localhost"
+
+    def getRemotePort(self):
+        return 0
+
+    def getLocalName(self):
+        return "localhost"
+
+    def getLocalAddr(self):
+        return "127.0.0.1"
+
+    def getLocalPort(self):
+        return 80
+
+    def getLocale(self):
+        return Locale.getDefault()
+
+    def getLocales(self):
+        return Collections.enumeration([Locale.getDefault()])
+
+    def isSecure(self):
+        return False
+
+    def getRequestDispatcher(self, path):
+        return None
+
+    def getRealPath(self, path):
+        return None
+
+    def getServletContext(self):
+        return None
+
+    def isAsyncSupported(self):
+        return False
+
+    def isAsyncStarted(self):
+        return False
+
+    def startAsync(self, *args):
+        raise IllegalStateException("Warm-up requests do not support async")
+
+    def getAsyncContext(self):
+        raise IllegalStateException("Warm-up requests do not support async")
+
+    def getDispatcherType(self):
+        return DispatcherType.REQUEST
+
+    # HttpServletRequest
+
+    def getAuthType(self):
+        return None
+
+    def getCookies(self):
+        return None
+
+    def getHeaderNames(self):
+        return Collections.enumeration(list(self.headers.keys()))
+
+    def getHeaders(self, name):
+        value = self.getHeader(name)
+        return Collections.enumeration([] if value is None else [value])
+
+    def getHeader(self, name):
+        for key, value in self.headers.iteritems():
+            if key.lower() == name.lower():
+                return value
+        return None
+
+    def getDateHeader(self, name):
+        return -1
+
+    def getIntHeader(self, name):
+        value = self.getHeader(name)
+        return -1 if value is None else int(value)
+
+    def getMethod(self):
+        return "GET"
+
+    def getContextPath(self):
+        return ""
+
+    def getServletPath(self):
+        return ""
+
+    def getPathInfo(self):
+        return self.path
+
+    def getPathTranslated(self):
+        return None
+
+    def getQueryString(self):
+        return self.query
+
+    def getRequestURI(self):
+        return self.path
+
+    def getRequestURL(self):
+        return StringBuffer("http://localhost" + self.path)
+
+    def getRemoteUser(self):
+        return None
+
+    def getUserPrincipal(self):
+        return None
+
+    def isUserInRole(self, role):
+        return False
+
+    def authenticate(self, response):
+        return False
+
+    def login(self, username, password):
+        raise ServletException("Warm-up requests cannot log in")
+
+    def logout(self):
+        pass
+
+    def getSession(self, create=True):
+        # Warm-up must not create sessions
+        return None
+
+    def getRequestedSessionId(self):
+        return None
+
+    def changeSessionId(self):
+        raise IllegalStateException("Warm-up requests have no session")
+
+    def isRequestedSessionIdValid(self):
+        return False
+
+    def isRequestedSessionIdFromCookie(self):
+        return False
+
+    def isRequestedSessionIdFromURL(self):
+        return False
+
+    isRequestedSessionIdFromUrl = isRequestedSessionIdFromURL
+
+    def getParts(self):
+        return Collections.emptyList()
+
+    def getPart(self, name):
+        return None
+
+    def upgrade(self, handler_class):
+        raise ServletException("Warm-up requests cannot be upgraded")
+
+
+class WarmupResponse(HttpServletResponse):
+
+    """An in-memory response, discarding its body"""
+
+    def __init__(self):
+        self.status = 200
+        self.headers = []
+        self.stream = CaptureServletOutputStream(lambda chunk: None, False)
+
+    def __repr__(self):
+        return "WarmupResponse(status=%s)" % (self.status,)
+
+    def getOutputStream(self):
+        return self.stream
+
+    def setStatus(self, code, msg=None):
+        self.status = code
+
+    def getStatus(self):
+        return self.status
+
+    def sendError(self, code, msg=None):
+        self.status = code
+
+    def isCommitted(self):
+        return False
+
+    def addHeader(self, name, value):
+        self.headers.append((name, value))
+
+    def setHeader(self, name, value):
+        self.headers = [(n, v) for n, v in self.headers if n.lower() != name.lower()]
+        self.headers.append((name, value))
+
+    def setContentLengthLong(self, length):
+        self.setHeader("Content-Length", str(length))
+
+    setContentLength = setContentLengthLong
+
+    def getCharacterEncoding(self):
+        return "ISO-8859-1"
+
+
+class Warmup(object):
+
+    """Replays synthetic requests through a servlet until it is warm
+
+    Each iteration requests every path once. Warm-up stops after
+    iterations iterations, or earlier, once at least three have run and
+    the last took within tolerance percent of the time of the one
+    before. Timings are reported to err_log.
+    """
+
+    def __init__(self, err_log, paths=(), imports=(), iterations=20, tolerance=10, required=False):
+        self.err_log = err_log
+        self.required = required   # whether the servlet must not start cold
+        self.paths = paths
+        self.imports = imports
+        self.iterations = iterations
+        self.tolerance = tolerance
+        self.timings = []   # of each iteration, in seconds
+
+    def __repr__(self):
+        return "Warmup(paths=%s, imports=%s, iterations=%s, tolerance=%s)" % (
+            self.paths, self.imports, self.iterations, self.tolerance)
+
+    @classmethod
+    def from_config(cls, config, err_log):
+        """Returns a warm-up if any warm-up paths or imports are configured, otherwise None"""
+        paths = init_param(config, "fireside.warmup_paths", [], comma_separated)
+        imports = init_param(config, "fireside.warmup_imports", [], comma_separated)
+        if not paths and not imports:
+            return None
+        return cls(
+            err_log, paths, imports,
+            init_param(config, "fireside.warmup_iterations", 20, int),
+            init_param(config, "fireside.warmup_tolerance", 10, int),
+            init_param(config, "fireside.warmup_required", False, boolean))
+
+    def run(self, handler):
+        """Warms up handler(req, resp), such as WSGIServlet.call_wsgi
+
+        Returns False if an import or a warm-up request failed,
+        including with a 5xx status.
+        """
+        self.timings = []
+        warmed = True
+        start = imported = time.time()
+        try:
+            for name in self.imports:
+                __import__(name)
+            imported = time.time()
+            for i in xrange(self.iterations if self.paths else 0):
+                self.timings.append(self.iterate(handler))
+                if self.settled():
+                    break
+        except:
+            # A warm-up that fails is reported, but does not stop the
+            # servlet from starting
+            self.err_log.writelines(traceback.format_exception(*sys.exc_info()))
+            warmed = False
+        self.report(imported - start, time.time() - imported)
+        return warmed
+
+    def iterate(self, handler):
+        start = time.time()
+        for path in self.paths:
+            resp = WarmupResponse()
+            handler(WarmupRequest(path), resp)
+            if resp.status >= 500:
+                # FIXME better exception class
+                raise Exception("Warm-up request failed", path, resp.status)
+        return time.time() - start
+
+    def settled(self):
+        if len(self.timings) < 3 or self.tolerance <= 0:
+            return False
+        before, last = self.timings[-2:]
+        return abs(last - before) <= before * self.tolerance / 100.0
+
+    def report(self, import_time, request_time):
+        msg = "Warm-up imported %d modules in %.1f ms" % (len(self.imports), import_time * 1000)
+        if self.timings:
+            msg += "; ran %d iterations of %d requests in %.1f ms, first %.1f ms, last %.1f ms" % (
+                len(self.timings), len(self.paths), request_time * 1000,
+                self.timings[0] * 1000, self.timings[-1] * 1000)
+        self.err_log.write(msg + "\n")
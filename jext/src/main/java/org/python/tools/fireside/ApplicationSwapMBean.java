@@ -0,0 +1,26 @@
+package org.python.tools.fireside;
+
+
+// Management interface for hot swapping the WSGI application of a servlet,
+// registered with the platform MBean server as
+// org.python.tools.fireside:type=ApplicationSwap,name=<servlet name>.
+//
+// swap() loads the application anew, in an interpreter of its own, warms it
+// up, then replaces the current application with it; the replaced one is
+// released once the requests still using it complete. It only returns once
+// the new application is taking requests, or fails, leaving the current one
+// in place.
+
+public interface ApplicationSwapMBean {
+    void swap();
+
+    // Incremented by each swap, starting from 0 for the application loaded
+    // by init
+    int getGeneration();
+
+    // Number of requests currently using the current application
+    int getInFlight();
+
+    // Number of replaced applications still draining their requests
+    int getDraining();
+}
@@ -0,0 +1,58 @@
+package org.python.tools.fireside;
+
+import java.util.Queue;
+import java.util.concurrent.ConcurrentLinkedQueue;
+import java.util.concurrent.atomic.AtomicInteger;
+
+
+// A pool of byte buffers of one size, such as those a WSGIFilter coalesces
+// the output of its filter chain into, so that each response does not
+// allocate its own. At most maxPooled buffers are kept - as many as there
+// would be for a modest number of concurrent responses - and any more
+// released are left to be collected.
+
+public class BufferPool {
+    private final int bufferSize;
+    private final int maxPooled;
+    private final Queue<byte[]> pool = new ConcurrentLinkedQueue<>();
+    private final AtomicInteger pooled = new AtomicInteger();
+
+    public BufferPool(int bufferSize) {
+        this(bufferSize, 256);
+    }
+
+    public BufferPool(int bufferSize, int maxPooled) {
+        if (bufferSize <= 0) {
+            throw new IllegalArgumentException("Buffer size must be positive: " + bufferSize);
+        }
+        this.bufferSize = bufferSize;
+        this.maxPooled = maxPooled;
+    }
+
+    public int getBufferSize() {
+        return bufferSize;
+    }
+
+    public int getPooled() {
+        return pooled.get();
+    }
+
+    public byte[] acquire() {
+        byte[] buffer = pool.poll();
+        if (buffer != null) {
+            pooled.decrementAndGet();
+            return buffer;
+        }
+        return new byte[bufferSize];
+    }
+
+    public void release(byte[] buffer) {
+        if (buffer.length == bufferSize) {
+            if (pooled.incrementAndGet() <= maxPooled) {
+                pool.offer(buffer);
+            } else {
+                pooled.decrementAndGet();
+            }
+        }
+    }
+}
@@ -0,0 +1,77 @@
+package org.python.tools.fireside;
+
+import java.io.IOException;
+
+import javax.servlet.ReadListener;
+import javax.servlet.ServletInputStream;
+
+
+// A request body that has already been read into memory, eg by non-blocking
+// input, presented again as a ServletInputStream.
+
+public class ByteArrayServletInputStream extends ServletInputStream {
+    private final byte[] buf;
+    private final int count;
+    private int pos;
+
+    public ByteArrayServletInputStream(byte[] buf) {
+        this(buf, 0, buf.length);
+    }
+
+    public ByteArrayServletInputStream(byte[] buf, int offset, int length) {
+        this.buf = buf;
+        this.pos = offset;
+        this.count = Math.min(offset + length, buf.length);
+    }
+
+    @Override
+    public int read() {
+        return (pos < count) ? (buf[pos++] & 0xff) : -1;
+    }
+
+    @Override
+    public int read(byte b[], int off, int len) {
+        if (pos >= count) {
+            return -1;
+        }
+        int n = Math.min(len, count - pos);
+        System.arraycopy(buf, pos, b, off, n);
+        pos += n;
+        return n;
+    }
+
+    @Override
+    public long skip(long n) {
+        long k = Math.max(Math.min(n, count - pos), 0);
+        pos += k;
+        return k;
+    }
+
+    @Override
+    public int available() {
+        return count - pos;
+    }
+
+    @Override
+    public boolean isFinished() {
+        return pos >= count;
+    }
+
+    @Override
+    public boolean isReady() {
+        // all data is always available without blocking
+        return true;
+    }
+
+    @Override
+    public void setReadListener(ReadListener listener) {
+        try {
+            if (!isFinished()) {
+                listener.onDataAvailable();
+            }
+            listener.onAllDataRead();
+        } catch (IOException ioe) {
+            listener.onError(ioe);
+        }
+    }
+}
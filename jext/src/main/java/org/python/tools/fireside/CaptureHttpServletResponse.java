@@ -16,10 +16,21 @@ import javax.servlet.http.HttpServletResponseWrapper;
 
 public class CaptureHttpServletResponse extends HttpServletResponseWrapper {
     private final CaptureServletOutputStream stream;
+    private PrintWriter writer;
 
     public CaptureHttpServletResponse(HttpServletResponse response, PyObject callback) {
+        this(response, callback, 0);
+    }
+
+    public CaptureHttpServletResponse(HttpServletResponse response, PyObject callback, int chunkSize) {
+        super(response);
+        stream = new CaptureServletOutputStream(callback, false, chunkSize);
+    }
+
+    // Coalesces the output into chunks using buffers from a pool
+    public CaptureHttpServletResponse(HttpServletResponse response, PyObject callback, BufferPool buffers) {
         super(response);
-        stream = new CaptureServletOutputStream(callback);
+        stream = new CaptureServletOutputStream(callback, false, buffers);
     }
 
     @Override
@@ -27,9 +38,30 @@ public class CaptureHttpServletResponse extends HttpServletResponseWrapper {
         return stream;
     }
 
+    // One writer per response, as for the container's own responses, using
+    // the response's character encoding (ISO-8859-1 unless set otherwise)
     @Override
     public PrintWriter getWriter() throws IOException {
-        return new PrintWriter(new OutputStreamWriter(stream, "UTF-8"));
+        if (writer == null) {
+            writer = new PrintWriter(new OutputStreamWriter(stream, getCharacterEncoding()));
+        }
+        return writer;
+    }
+
+    // Output is only flushed to the capture, since the wrapped response
+    // is written once the captured output has been filtered
+    @Override
+    public void flushBuffer() throws IOException {
+        if (writer != null) {
+            writer.flush();
+        }
+        stream.flush();
+    }
+
+    // Emits any output still pending, once the chain has completed
+    public void finish() throws IOException {
+        flushBuffer();
+        stream.close();
     }
 
 }
@@ -5,7 +5,6 @@ import org.python.core.PyObject;
 import org.python.core.PyString;
 
 import java.io.IOException;
-import java.util.Collection;
 import java.util.Deque;
 import java.util.Iterator;
 import java.util.concurrent.ConcurrentLinkedDeque;
@@ -13,13 +12,57 @@ import java.util.concurrent.ConcurrentLinkedDeque;
 import javax.servlet.ServletOutputStream;
 import javax.servlet.WriteListener;
 
+
+// Captures the output of a servlet or filter chain as PyString chunks.
+//
+// Given a chunk size, writes are coalesced into a buffer of that size, taken
+// from a BufferPool if given one, and a chunk is only emitted when the buffer
+// fills, on flush or on close; writes at least as large as a chunk are emitted as they
+// are, after any pending bytes. Otherwise each write is a chunk. Either way,
+// bytes are copied in bulk, directly into the chunk's string.
+
 public class CaptureServletOutputStream extends ServletOutputStream implements Iterator<PyString> {
     private volatile boolean closed = false;
     private final Deque<PyString> chunks = new ConcurrentLinkedDeque<>();
+    private final boolean queued;
+    private final int chunkSize;
+    private final BufferPool buffers;   // or null, to allocate each buffer
     private PyObject callback;
+    private byte[] buffer;
+    private int count = 0;
+
+    private static final PyString[] BYTES = new PyString[256];
+
+    static {
+        for (int i = 0; i < BYTES.length; i++) {
+            BYTES[i] = Py.newString((char) i);
+        }
+    }
 
     public CaptureServletOutputStream(PyObject callback) {
+        this(callback, true);
+    }
+
+    // Unless queued, chunks are only passed to the callback, so that no
+    // output accumulates here; next() then only reports whether the
+    // stream is closed
+    public CaptureServletOutputStream(PyObject callback, boolean queued) {
+        this(callback, queued, 0);
+    }
+
+    public CaptureServletOutputStream(PyObject callback, boolean queued, int chunkSize) {
         this.callback = callback;
+        this.queued = queued;
+        this.chunkSize = chunkSize;
+        this.buffers = null;
+    }
+
+    // Coalesces into chunks of the pool's buffer size
+    public CaptureServletOutputStream(PyObject callback, boolean queued, BufferPool buffers) {
+        this.callback = callback;
+        this.queued = queued;
+        this.chunkSize = buffers.getBufferSize();
+        this.buffers = buffers;
     }
 
     public void setCallback(PyObject callback) {
@@ -30,28 +73,65 @@ public class CaptureServletOutputStream extends ServletOutputStream implements I
         return chunks.iterator();
     }
 
+    private byte[] acquire() {
+        return buffers != null ? buffers.acquire() : new byte[chunkSize];
+    }
+
+    private void release(byte[] buffer) {
+        if (buffers != null) {
+            buffers.release(buffer);
+        }
+    }
+
     @Override
-    public void close() {
-        closed = true;
+    public void close() throws IOException {
+        if (!closed) {
+            try {
+                flush();
+            } finally {
+                closed = true;
+                if (buffer != null) {
+                    release(buffer);
+                    buffer = null;
+                }
+            }
+        }
     }
 
     private void checkClosed() throws IOException {
         if (closed) {
             throw new IOException("Output stream is closed");
-        };
+        }
     }
 
-    private void write(PyString s) throws IOException {
-        chunks.addLast(s);
+    private void emit(PyString s) throws IOException {
+        if (queued) {
+            chunks.addLast(s);
+        }
         callback.__call__(s);
     }
 
+    @SuppressWarnings("deprecation")
+    private static PyString chunk(byte[] b, int off, int len) {
+        // Deliberately the deprecated constructor: it makes each byte
+        // the low byte of a char, which is exactly how PyString
+        // represents bytes
+        return Py.newString(new String(b, 0, off, len));
+    }
+
     @Override
     public void write(int b) throws IOException {
         checkClosed();
-        // Writing one byte at a time is going to be inefficient.
-        // Of course it will be. :)
-        write(Py.newString((char) (b & 0x7ff)));
+        if (chunkSize > 0) {
+            if (buffer == null) {
+                buffer = acquire();
+            } else if (count == buffer.length) {
+                drain();
+            }
+            buffer[count++] = (byte) b;
+        } else {
+            emit(BYTES[b & 0xff]);
+        }
     }
 
     @Override
@@ -62,11 +142,50 @@ public class CaptureServletOutputStream extends ServletOutputStream implements I
     @Override
     public void write(byte b[], int off, int len) throws IOException {
         checkClosed();
-        StringBuilder builder = new StringBuilder(len - off);
-        for (int i = off; i < len; i++) {
-            builder.append((char)b[i]);
+        if (off < 0 || len < 0 || off + len > b.length) {
+            throw new IndexOutOfBoundsException();
+        }
+        if (len == 0) {
+            return;
+        }
+        if (chunkSize <= 0) {
+            emit(chunk(b, off, len));
+        } else if (len >= chunkSize) {
+            drain();
+            emit(chunk(b, off, len));
+        } else {
+            if (buffer == null) {
+                buffer = acquire();
+            }
+            int n = Math.min(len, buffer.length - count);
+            System.arraycopy(b, off, buffer, count, n);
+            count += n;
+            if (n < len) {
+                drain();
+                System.arraycopy(b, off + n, buffer, 0, len - n);
+                count = len - n;
+            }
         }
-        write(Py.newString(builder.toString()));
+    }
+
+    // Emits any pending bytes as a chunk
+    private void drain() throws IOException {
+        if (count > 0) {
+            PyString s = chunk(buffer, 0, count);
+            count = 0;
+            emit(s);
+        }
+    }
+
+    @Override
+    public void flush() throws IOException {
+        if (!closed) {
+            drain();
+        }
+    }
+
+    public int getBuffered() {
+        return count;
     }
 
     @Override
@@ -77,8 +196,8 @@ public class CaptureServletOutputStream extends ServletOutputStream implements I
     @Override
     public void setWriteListener(WriteListener listener) {
         try {
-            // writes are immediately and always possible due to the
-            // use of the chunks deque
+            // writes are immediately and always possible, since they
+            // are either queued or passed synchronously to the callback
             listener.onWritePossible();
         } catch (IOException ioe) {
             // doesn't make sense to do anything but ignore if
@@ -0,0 +1,149 @@
+package org.python.tools.fireside;
+
+import org.python.core.Py;
+import org.python.core.PyString;
+
+import java.io.IOException;
+import java.io.InterruptedIOException;
+import java.util.Iterator;
+import java.util.NoSuchElementException;
+import java.util.concurrent.atomic.AtomicLong;
+import java.util.concurrent.atomic.AtomicReferenceArray;
+import java.util.concurrent.locks.LockSupport;
+
+
+// A bounded pipe of chunks from exactly one writer thread to exactly one
+// reader thread, such as a filter chain running on a worker thread and the
+// WSGI middleware consuming its output on the request thread.
+//
+// The chunks are kept in a ring indexed by two counters, each only advanced
+// by its own side, so no locks are needed. A side that has to wait - the
+// writer when the ring is full, the reader when it is empty - parks until
+// the other side makes progress.
+//
+// Either side can end the pipe: the writer by closing it once its output is
+// complete, the reader by cancelling it, after which the writer's next put
+// fails with an IOException, as if the client had gone away.
+
+public class ChunkPipe implements Iterator<PyString> {
+    private final AtomicReferenceArray<PyString> ring;
+    private final int mask;
+    private final AtomicLong head = new AtomicLong();   // next chunk to take
+    private final AtomicLong tail = new AtomicLong();   // next chunk to put
+    private volatile boolean closed = false;
+    private volatile boolean cancelled = false;
+    private volatile Thread waitingReader;
+    private volatile Thread waitingWriter;
+
+    public ChunkPipe(int capacity) {
+        if (capacity <= 0) {
+            throw new IllegalArgumentException("Capacity must be positive: " + capacity);
+        }
+        // round up to a power of two, so positions can be masked
+        int size = Integer.highestOneBit(capacity);
+        if (size < capacity) {
+            size <<= 1;
+        }
+        ring = new AtomicReferenceArray<>(size);
+        mask = size - 1;
+    }
+
+    public int capacity() {
+        return ring.length();
+    }
+
+    // Writer side
+
+    public void put(PyString chunk) throws IOException {
+        if (chunk.__len__() == 0) {
+            return;
+        }
+        long t = tail.get();
+        while (t - head.get() >= ring.length()) {
+            checkCancelled();
+            waitingWriter = Thread.currentThread();
+            if (t - head.get() >= ring.length() && !cancelled) {
+                LockSupport.park(this);
+            }
+            waitingWriter = null;
+        }
+        checkCancelled();
+        ring.lazySet((int) (t & mask), chunk);
+        tail.set(t + 1);
+        wake(waitingReader);
+    }
+
+    public void close() {
+        closed = true;
+        wake(waitingReader);
+    }
+
+    public boolean isCancelled() {
+        return cancelled;
+    }
+
+    private void checkCancelled() throws IOException {
+        if (cancelled) {
+            throw new IOException("Reader of filter chain output has gone away");
+        }
+    }
+
+    // Reader side
+
+    // Waits until a chunk is available, returning false if there are none
+    // and the pipe is closed
+    @Override
+    public boolean hasNext() {
+        long h = head.get();
+        while (h == tail.get()) {
+            if (closed) {
+                // a put may have completed just before closing
+                return h != tail.get();
+            }
+            waitingReader = Thread.currentThread();
+            if (h == tail.get() && !closed) {
+                LockSupport.park(this);
+            }
+            waitingReader = null;
+            if (Thread.currentThread().isInterrupted()) {
+                cancel();
+                throw Py.IOError(new InterruptedIOException("Interrupted while waiting for filter chain output"));
+            }
+        }
+        return true;
+    }
+
+    @Override
+    public PyString next() {
+        if (!hasNext()) {
+            throw new NoSuchElementException();
+        }
+        long h = head.get();
+        int i = (int) (h & mask);
+        PyString chunk = ring.get(i);
+        ring.lazySet(i, null);
+        head.set(h + 1);
+        wake(waitingWriter);
+        return chunk;
+    }
+
+    public void cancel() {
+        cancelled = true;
+        wake(waitingWriter);
+    }
+
+    public boolean isClosed() {
+        return closed;
+    }
+
+    private static void wake(Thread thread) {
+        if (thread != null) {
+            LockSupport.unpark(thread);
+        }
+    }
+
+    @Override
+    public void remove() {
+        throw new UnsupportedOperationException();
+    }
+}
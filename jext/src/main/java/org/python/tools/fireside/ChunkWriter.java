@@ -0,0 +1,150 @@
+package org.python.tools.fireside;
+
+import org.python.core.BufferProtocol;
+import org.python.core.Py;
+import org.python.core.PyBUF;
+import org.python.core.PyBuffer;
+import org.python.core.PyObject;
+import org.python.core.PyString;
+import org.python.core.PyUnicode;
+
+import java.io.IOException;
+import java.io.OutputStream;
+
+
+// Writes WSGI body chunks to an output stream without first converting them
+// to a fresh byte[] on the Python side (eg with array.array("b", data)).
+//
+// PyString stores its bytes as the low byte of each char of a Java String,
+// so these are copied straight into one reusable buffer per response. Objects
+// supporting the buffer protocol - bytearray, buffer, memoryview, array - are
+// written directly from their backing storage, unless they are small enough
+// to be coalesced with other pending chunks.
+
+public class ChunkWriter {
+    private final OutputStream out;
+    private final byte[] buffer;
+    private int count = 0;
+
+    public ChunkWriter(OutputStream out, int bufferSize) {
+        this.out = out;
+        this.buffer = new byte[bufferSize];
+    }
+
+    private static void checkChunk(PyObject chunk) {
+        if (chunk instanceof PyUnicode) {
+            throw Py.TypeError("WSGI response chunks must be bytestrings, not unicode");
+        } else if (!(chunk instanceof PyString) && !(chunk instanceof BufferProtocol)) {
+            throw Py.TypeError("WSGI response chunks must be bytestrings, not " +
+                    chunk.getType().fastGetName());
+        }
+    }
+
+    // Returns the number of bytes in chunk
+    public int write(PyObject chunk) throws IOException {
+        checkChunk(chunk);
+        if (chunk instanceof PyString) {
+            return write(((PyString) chunk).getString());
+        } else {
+            return write((BufferProtocol) chunk);
+        }
+    }
+
+    // Writes all of chunk with exactly one write to the underlying stream,
+    // as non-blocking output requires after isReady() has returned true.
+    // Returns the number of bytes in chunk
+    @SuppressWarnings("deprecation")
+    public int writeWhole(PyObject chunk) throws IOException {
+        checkChunk(chunk);
+        if (count > 0) {
+            throw new IllegalStateException("Buffered output must be drained first");
+        }
+        if (chunk instanceof PyString) {
+            String s = ((PyString) chunk).getString();
+            int len = s.length();
+            if (len > 0) {
+                byte[] bytes = len <= buffer.length ? buffer : new byte[len];
+                s.getBytes(0, len, bytes, 0);
+                out.write(bytes, 0, len);
+            }
+            return len;
+        }
+        PyBuffer view = ((BufferProtocol) chunk).getBuffer(PyBUF.FULL_RO);
+        try {
+            int len = view.getLen();
+            if (len == 0) {
+                return 0;
+            } else if (view.isContiguous('A')) {
+                PyBuffer.Pointer storage = view.getBuf();
+                out.write(storage.storage, storage.offset, len);
+            } else {
+                byte[] bytes = len <= buffer.length ? buffer : new byte[len];
+                view.copyTo(bytes, 0);
+                out.write(bytes, 0, len);
+            }
+            return len;
+        } finally {
+            view.release();
+        }
+    }
+
+    @SuppressWarnings("deprecation")
+    private int write(String s) throws IOException {
+        int len = s.length();
+        int pos = 0;
+        while (pos < len) {
+            if (count == buffer.length) {
+                drain();
+            }
+            int n = Math.min(len - pos, buffer.length - count);
+            // Deliberately the deprecated method: it takes the low byte of
+            // each char, which is exactly how PyString represents bytes
+            s.getBytes(pos, pos + n, buffer, count);
+            count += n;
+            pos += n;
+        }
+        return len;
+    }
+
+    private int write(BufferProtocol chunk) throws IOException {
+        PyBuffer view = chunk.getBuffer(PyBUF.FULL_RO);
+        try {
+            int len = view.getLen();
+            if (len <= buffer.length - count && len < buffer.length / 2) {
+                // coalesce small chunks with any pending output
+                view.copyTo(buffer, count);
+                count += len;
+            } else if (view.isContiguous('A')) {
+                drain();
+                PyBuffer.Pointer storage = view.getBuf();
+                out.write(storage.storage, storage.offset, len);
+            } else {
+                // strided views have no single backing array to write from
+                drain();
+                byte[] copy = new byte[len];
+                view.copyTo(copy, 0);
+                out.write(copy, 0, len);
+            }
+            return len;
+        } finally {
+            view.release();
+        }
+    }
+
+    // Writes any buffered bytes to the underlying stream, without flushing it
+    public void drain() throws IOException {
+        if (count > 0) {
+            out.write(buffer, 0, count);
+            count = 0;
+        }
+    }
+
+    public void flush() throws IOException {
+        drain();
+        out.flush();
+    }
+
+    public int getBuffered() {
+        return count;
+    }
+}
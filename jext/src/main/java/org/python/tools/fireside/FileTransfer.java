@@ -0,0 +1,101 @@
+package org.python.tools.fireside;
+
+import java.io.IOException;
+import java.io.OutputStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.ByteBuffer;
+import java.nio.MappedByteBuffer;
+import java.nio.channels.FileChannel;
+import java.nio.channels.WritableByteChannel;
+
+
+// Transfers a region of a file to a servlet output stream, for wsgi.file_wrapper
+// responses, using the cheapest mechanism the stream allows:
+//
+// 1. Streams that are themselves channels get FileChannel.transferTo, which
+//    can use sendfile.
+// 2. Streams with a write(ByteBuffer) method - Jetty's HttpOutput, or any
+//    container implementing the Servlet 6.1 API - are written memory-mapped
+//    regions of the file, so the file contents never enter the heap.
+// 3. Otherwise the file is read in large blocks into one reused buffer.
+//
+// In all cases heap usage is constant, regardless of file size.
+
+public class FileTransfer {
+    private static final long MAP_REGION = 8 * 1024 * 1024;
+
+    public static long transfer(FileChannel channel, long position, long count, OutputStream out, int blockSize)
+            throws IOException {
+        if (out instanceof WritableByteChannel) {
+            return transferTo(channel, position, count, (WritableByteChannel) out);
+        }
+        Method write = getByteBufferWrite(out);
+        if (write != null) {
+            return transferMapped(channel, position, count, out, write);
+        }
+        return transferBlocks(channel, position, count, out, blockSize);
+    }
+
+    private static Method getByteBufferWrite(OutputStream out) {
+        try {
+            return out.getClass().getMethod("write", ByteBuffer.class);
+        } catch (NoSuchMethodException e) {
+            return null;
+        }
+    }
+
+    private static long transferTo(FileChannel channel, long position, long count, WritableByteChannel target)
+            throws IOException {
+        long done = 0;
+        while (done < count) {
+            long n = channel.transferTo(position + done, count - done, target);
+            if (n <= 0) {
+                break;  // file was truncated
+            }
+            done += n;
+        }
+        return done;
+    }
+
+    private static long transferMapped(FileChannel channel, long position, long count, OutputStream out,
+                                       Method write) throws IOException {
+        long done = 0;
+        count = Math.min(count, channel.size() - position);
+        while (done < count) {
+            long size = Math.min(MAP_REGION, count - done);
+            MappedByteBuffer region = channel.map(FileChannel.MapMode.READ_ONLY, position + done, size);
+            try {
+                write.invoke(out, region);
+            } catch (InvocationTargetException e) {
+                Throwable cause = e.getCause();
+                if (cause instanceof IOException) {
+                    throw (IOException) cause;
+                }
+                throw new IOException(cause);
+            } catch (IllegalAccessException e) {
+                throw new IOException(e);
+            }
+            done += size;
+        }
+        return done;
+    }
+
+    private static long transferBlocks(FileChannel channel, long position, long count, OutputStream out,
+                                       int blockSize) throws IOException {
+        ByteBuffer buffer = ByteBuffer.allocate(blockSize);
+        byte[] array = buffer.array();
+        long done = 0;
+        while (done < count) {
+            buffer.clear();
+            buffer.limit((int) Math.min(blockSize, count - done));
+            int n = channel.read(buffer, position + done);
+            if (n <= 0) {
+                break;  // file was truncated
+            }
+            out.write(array, 0, n);
+            done += n;
+        }
+        return done;
+    }
+}
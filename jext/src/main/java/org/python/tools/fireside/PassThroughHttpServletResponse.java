@@ -0,0 +1,134 @@
+package org.python.tools.fireside;
+
+import org.python.core.PyObject;
+
+import java.io.IOException;
+import java.io.OutputStreamWriter;
+import java.io.PrintWriter;
+
+import javax.servlet.ServletOutputStream;
+import javax.servlet.WriteListener;
+import javax.servlet.http.HttpServletResponse;
+import javax.servlet.http.HttpServletResponseWrapper;
+
+
+// Passes the output of the rest of a filter chain straight through to the
+// response, for WSGI middleware that returns the body of the application it
+// wraps unchanged, and so only looks at status and headers.
+//
+// The hook is called once, before anything could commit the response - the
+// first write or flush, sendError, sendRedirect, or the end of the chain -
+// so that the middleware can still change the status and headers.
+
+public class PassThroughHttpServletResponse extends HttpServletResponseWrapper {
+    private final PyObject hook;
+    private boolean hooked = false;
+    private HookedOutputStream stream;
+    private PrintWriter writer;
+
+    public PassThroughHttpServletResponse(HttpServletResponse response, PyObject hook) {
+        super(response);
+        this.hook = hook;
+    }
+
+    private void beforeCommit() {
+        if (!hooked) {
+            hooked = true;
+            hook.__call__();
+        }
+    }
+
+    @Override
+    public ServletOutputStream getOutputStream() throws IOException {
+        if (stream == null) {
+            stream = new HookedOutputStream(super.getOutputStream());
+        }
+        return stream;
+    }
+
+    @Override
+    public PrintWriter getWriter() throws IOException {
+        if (writer == null) {
+            writer = new PrintWriter(new OutputStreamWriter(getOutputStream(), getCharacterEncoding()));
+        }
+        return writer;
+    }
+
+    @Override
+    public void flushBuffer() throws IOException {
+        beforeCommit();
+        if (writer != null) {
+            writer.flush();
+        }
+        super.flushBuffer();
+    }
+
+    @Override
+    public void sendError(int sc) throws IOException {
+        beforeCommit();
+        super.sendError(sc);
+    }
+
+    @Override
+    public void sendError(int sc, String msg) throws IOException {
+        beforeCommit();
+        super.sendError(sc, msg);
+    }
+
+    @Override
+    public void sendRedirect(String location) throws IOException {
+        beforeCommit();
+        super.sendRedirect(location);
+    }
+
+    // Once the chain has completed; the response itself is left for the
+    // container to complete
+    public void finish() throws IOException {
+        beforeCommit();
+        if (writer != null) {
+            writer.flush();
+        }
+    }
+
+    private class HookedOutputStream extends ServletOutputStream {
+        private final ServletOutputStream out;
+
+        HookedOutputStream(ServletOutputStream out) {
+            this.out = out;
+        }
+
+        @Override
+        public void write(int b) throws IOException {
+            beforeCommit();
+            out.write(b);
+        }
+
+        @Override
+        public void write(byte b[], int off, int len) throws IOException {
+            beforeCommit();
+            out.write(b, off, len);
+        }
+
+        @Override
+        public void flush() throws IOException {
+            beforeCommit();
+            out.flush();
+        }
+
+        @Override
+        public void close() throws IOException {
+            beforeCommit();
+            out.close();
+        }
+
+        @Override
+        public boolean isReady() {
+            return out.isReady();
+        }
+
+        @Override
+        public void setWriteListener(WriteListener listener) {
+            out.setWriteListener(listener);
+        }
+    }
+}
@@ -1,32 +1,39 @@
-// FIXME audit for any concurrency issues. It seems highly likely that the
-// invalidation implied by the changed dict is robust, but need to verify
-// via scenario analysis.
-// However, current structures should be resilient against corruption.
+// A bridge may be used by two threads at once: a WSGIFilter's middleware on
+// the request thread, and the rest of its filter chain on a worker thread,
+// reading it through asWrapper() or sharing it with a downstream servlet. All
+// of its state is therefore held in atomic or concurrent structures. A change
+// to a value is seen by the other thread from its next read of that value;
+// which of the changes made while both threads run are seen is up to timing.
 
 // FIXME replace commented-out prints with appropriate logging, or remove
 
 package org.python.tools.fireside;
 
+import java.util.AbstractMap;
+import java.util.AbstractSet;
 import java.util.ArrayList;
 import java.util.Arrays;
 import java.util.Collections;
 import java.util.Enumeration;
+import java.util.HashSet;
+import java.util.Iterator;
 import java.util.LinkedHashMap;
 import java.util.List;
+import java.util.Locale;
 import java.util.Map;
 import java.util.Set;
-import java.util.concurrent.ConcurrentMap;
 import java.util.concurrent.ConcurrentHashMap;
-import java.util.concurrent.ExecutionException;
+import java.util.concurrent.ConcurrentMap;
+import java.util.concurrent.atomic.AtomicInteger;
+import java.util.concurrent.atomic.AtomicReferenceArray;
 import javax.servlet.http.HttpServletRequest;
 import javax.servlet.http.HttpServletRequestWrapper;
 
 import com.google.common.base.CharMatcher;
+import com.google.common.cache.Cache;
 import com.google.common.cache.CacheBuilder;
-import com.google.common.cache.CacheLoader;
-import com.google.common.cache.LoadingCache;
-import com.google.common.collect.ForwardingConcurrentMap;
 import org.python.core.Py;
+import org.python.core.PyDict;
 import org.python.core.PyObject;
 import org.python.core.PyString;
 import org.python.core.PyTuple;
@@ -35,9 +42,27 @@ import org.python.core.codecs;
 
 public class RequestBridge {
     private final HttpServletRequest request;
-    private final LoadingCache<PyObject, PyObject> cache;
-    private final Set<PyObject> changed = Collections.newSetFromMap(new ConcurrentHashMap());
-    private final Map<String, String> mapCGI;
+    private final PyObject errLog;
+    private final PyObject wsgiInputStream;
+    private final PyObject fileWrapper;
+    private boolean multithread = true;
+    private volatile Map<String, HeaderName> mapCGI;   // enumerated on demand
+
+    // The environ is built up lazily. Values for the fixed CGI/WSGI keys are
+    // kept in a slot array, indexed by key id; any other keys - HTTP_* headers,
+    // or keys added by the app - are kept in a small overflow map.
+    //
+    // This reduces overhead if not all keys are used, because of rewrites to/from latin1
+    // encoding and other conversions and especially if not all keys are rewritten
+    // in a servlet filter.
+    private final AtomicReferenceArray<PyObject> values = new AtomicReferenceArray<>(KEYS.length);   // null if not yet loaded
+    private final AtomicInteger changed = new AtomicInteger();   // bitmask of key ids changed by the app, for the request wrapper
+    private final ConcurrentMap<PyObject, PyObject> extras = new ConcurrentHashMap<>();
+    private final Set<PyObject> changedExtras = Collections.newSetFromMap(new ConcurrentHashMap<PyObject, Boolean>());
+    private volatile boolean loadedAll = false;   // whether all of the environ was needed
+
+    // Marks a key that has no value, eg CONTENT_LENGTH if not known, or that was removed
+    private static final PyObject ABSENT = new PyObject();
 
     // keys
     private static final String WSGI_VERSION = "wsgi.version";
@@ -46,100 +71,272 @@ public class RequestBridge {
     private static final String WSGI_RUN_ONCE = "wsgi.run_once";
     private static final String WSGI_ERRORS = "wsgi.errors";
     private static final String WSGI_INPUT = "wsgi.input";
-
+    private static final String WSGI_FILE_WRAPPER = "wsgi.file_wrapper";
     private static final String WSGI_URL_SCHEME = "wsgi.url_scheme";
-    private static final PyString PY_WSGI_URL_SCHEME = Py.newString(WSGI_URL_SCHEME);
-
     private static final String REQUEST_METHOD = "REQUEST_METHOD";
-    private static final PyString PY_REQUEST_METHOD = Py.newString(REQUEST_METHOD);
     private static final String SCRIPT_NAME = "SCRIPT_NAME";
-    private static final PyString PY_SCRIPT_NAME = Py.newString(SCRIPT_NAME);
     private static final String PATH_INFO = "PATH_INFO";
-    private static final PyString PY_PATH_INFO = Py.newString(PATH_INFO);
     private static final String QUERY_STRING = "QUERY_STRING";
-    private static final PyString PY_QUERY_STRING = Py.newString(QUERY_STRING);
     private static final String CONTENT_TYPE = "CONTENT_TYPE";
-    private static final PyString PY_CONTENT_TYPE = Py.newString(CONTENT_TYPE);
     private static final String REMOTE_ADDR = "REMOTE_ADDR";
-    private static final PyString PY_REMOTE_ADDR = Py.newString(REMOTE_ADDR);
     private static final String REMOTE_HOST = "REMOTE_HOST";
-    private static final PyString PY_REMOTE_HOST = Py.newString(REMOTE_HOST);
     private static final String REMOTE_PORT = "REMOTE_PORT";
-    private static final PyString PY_REMOTE_PORT = Py.newString(REMOTE_PORT);
     private static final String SERVER_NAME = "SERVER_NAME";
-    private static final PyString PY_SERVER_NAME = Py.newString(SERVER_NAME);
     private static final String SERVER_PORT = "SERVER_PORT";
-    private static final PyString PY_SERVER_PORT = Py.newString(SERVER_PORT);
     private static final String SERVER_PROTOCOL = "SERVER_PROTOCOL";
-    private static final PyString PY_SERVER_PROTOCOL = Py.newString(SERVER_PROTOCOL);
     private static final String CONTENT_LENGTH = "CONTENT_LENGTH";
-    private static final PyString PY_CONTENT_LENGTH = Py.newString(CONTENT_LENGTH);
+
+    // key ids, which index KEYS
+    static final int ID_WSGI_VERSION = 0;
+    static final int ID_WSGI_MULTITHREAD = 1;
+    static final int ID_WSGI_MULTIPROCESS = 2;
+    static final int ID_WSGI_RUN_ONCE = 3;
+    static final int ID_WSGI_ERRORS = 4;
+    static final int ID_WSGI_INPUT = 5;
+    static final int ID_WSGI_FILE_WRAPPER = 6;
+    static final int ID_WSGI_URL_SCHEME = 7;
+    static final int ID_REQUEST_METHOD = 8;
+    static final int ID_SCRIPT_NAME = 9;
+    static final int ID_PATH_INFO = 10;
+    static final int ID_QUERY_STRING = 11;
+    static final int ID_CONTENT_TYPE = 12;
+    static final int ID_REMOTE_ADDR = 13;
+    static final int ID_REMOTE_HOST = 14;
+    static final int ID_REMOTE_PORT = 15;
+    static final int ID_SERVER_NAME = 16;
+    static final int ID_SERVER_PORT = 17;
+    static final int ID_SERVER_PROTOCOL = 18;
+    static final int ID_CONTENT_LENGTH = 19;
+
+    private static final String[] KEYS = {
+            WSGI_VERSION, WSGI_MULTITHREAD, WSGI_MULTIPROCESS, WSGI_RUN_ONCE,
+            WSGI_ERRORS, WSGI_INPUT, WSGI_FILE_WRAPPER, WSGI_URL_SCHEME,
+            REQUEST_METHOD, SCRIPT_NAME, PATH_INFO, QUERY_STRING, CONTENT_TYPE,
+            REMOTE_ADDR, REMOTE_HOST, REMOTE_PORT,
+            SERVER_NAME, SERVER_PORT, SERVER_PROTOCOL, CONTENT_LENGTH};
+    private static final PyString[] PY_KEYS = new PyString[KEYS.length];
+
+    // Immutable values shared by all requests
+    private static final PyTuple PY_WSGI_VERSION = new PyTuple(Py.One, Py.Zero);
+
+    // Perfect hash of KEYS: the slot for a key is
+    // (h ^ (h >>> HASH_SHIFT)) & HASH_MASK, where h is its String hash code,
+    // and HASH_TABLE maps slots to key ids, or -1 for no key. The shift and
+    // table size are found when this class is initialized, by searching for
+    // the smallest table without collisions.
+    private static final int HASH_SHIFT;
+    private static final int HASH_MASK;
+    private static final int[] HASH_TABLE;
+
+    static {
+        for (int i = 0; i < KEYS.length; i++) {
+            PY_KEYS[i] = Py.newString(KEYS[i]);
+        }
+        int shift = -1;
+        int bits = 5;
+        search:
+        for (; bits <= 16; bits++) {
+            int mask = (1 << bits) - 1;
+            for (shift = 0; shift < 32; shift++) {
+                boolean[] used = new boolean[mask + 1];
+                boolean collision = false;
+                for (String key : KEYS) {
+                    int h = key.hashCode();
+                    int slot = (h ^ (h >>> shift)) & mask;
+                    if (used[slot]) {
+                        collision = true;
+                        break;
+                    }
+                    used[slot] = true;
+                }
+                if (!collision) {
+                    break search;
+                }
+            }
+        }
+        if (bits > 16) {
+            throw new ExceptionInInitializerError("No perfect hash found for environ keys");
+        }
+        HASH_SHIFT = shift;
+        HASH_MASK = (1 << bits) - 1;
+        HASH_TABLE = new int[HASH_MASK + 1];
+        Arrays.fill(HASH_TABLE, -1);
+        for (int i = 0; i < KEYS.length; i++) {
+            int h = KEYS[i].hashCode();
+            HASH_TABLE[(h ^ (h >>> HASH_SHIFT)) & HASH_MASK] = i;
+        }
+    }
+
+    // Translations of header names to CGI names, shared by all requests. The
+    // set of header names seen in practice is small and nearly fixed, so this
+    // avoids building the CGI names again for every request; it is bounded so
+    // that clients sending arbitrary header names cannot grow it without limit.
+    static final int MAX_HEADER_NAMES = 1024;
+    private static final Cache<String, HeaderName> HEADER_NAMES = CacheBuilder.newBuilder()
+            .maximumSize(MAX_HEADER_NAMES)
+            .build();
+
+    static final class HeaderName {
+        final String name;
+        final String cgiName;
+        final PyString key;
+
+        HeaderName(String name) {
+            this.name = name;
+            // It is possible that this mapping is not bijective, but that's just a basic
+            // problem with CGI/WSGI naming. Also I would assume that real usage of HTTP headers
+            // are not going to do that.
+            this.cgiName = ("HTTP_" + name.replace('-', '_').toUpperCase(Locale.ROOT)).intern();
+            this.key = Py.newString(cgiName);
+        }
+    }
+
+    static HeaderName headerName(String name) {
+        HeaderName headerName = HEADER_NAMES.getIfPresent(name);
+        if (headerName == null) {
+            // racing puts are harmless, since they are equivalent
+            headerName = new HeaderName(name);
+            HEADER_NAMES.put(name, headerName);
+        }
+        return headerName;
+    }
+
+    // Returns the id of key if it is one of the fixed keys, otherwise -1
+    static int keyId(Object key) {
+        if (!(key instanceof PyString)) {
+            return -1;
+        }
+        String k = key.toString();
+        int h = k.hashCode();
+        int id = HASH_TABLE[(h ^ (h >>> HASH_SHIFT)) & HASH_MASK];
+        if (id >= 0 && KEYS[id].equals(k)) {
+            return id;
+        }
+        return -1;
+    }
 
     public RequestBridge(final HttpServletRequest request, final PyObject errLog, final PyObject wsgiInputStream) {
+        this(request, errLog, wsgiInputStream, null);
+    }
+
+    public RequestBridge(final HttpServletRequest request, final PyObject errLog, final PyObject wsgiInputStream,
+                         final PyObject fileWrapper) {
         this.request = request;
-        mapCGI = getMappingForCGI(request);
-        // Cache all keys for a request - we are effectively building up the environ lazily,
-        // while using updates to track for the request wrapper.
-        //
-        // This reduces overhead if not all keys are used, because of rewrites to/from latin1
-        // encoding and other conversions and especially if not all keys are rewritten
-        // in a servlet filter.
-        cache = CacheBuilder.newBuilder().build(
-                new CacheLoader<PyObject, PyObject>() {
-                    public PyObject load(PyObject key) throws ExecutionException {
-                        if (changed.contains(key)) {
-//                            System.err.println("Do not load key=" + key);
-                            throw new ExecutionException(null);
-                        }
-//                        System.err.println("Loading key=" + key);
-                        // Unwrap so we can take advantage of Java 7's support for
-                        // efficient string switch, via hashing. Effectively the below switch
-                        // is a hash table.
-                        String k = key.toString();
-                        switch (k) {
-                            case WSGI_VERSION:
-                                return new PyTuple(Py.One, Py.Zero);
-                            case WSGI_MULTITHREAD:
-                                return Py.True;
-                            case WSGI_MULTIPROCESS:
-                                return Py.False;
-                            case WSGI_RUN_ONCE:
-                                return Py.False;
-                            case WSGI_ERRORS:
-                                return errLog;
-                            case WSGI_INPUT:
-                                return wsgiInputStream;
-                            case WSGI_URL_SCHEME:
-                                return latin1(request.getScheme());
-                            case REQUEST_METHOD:
-                                return latin1(request.getMethod());
-                            case SCRIPT_NAME:
-                                return latin1(request.getServletPath());
-                            case PATH_INFO:
-                                return emptyIfNull(request.getPathInfo());
-                            case QUERY_STRING:
-                                return emptyIfNull(request.getQueryString());
-                            case CONTENT_TYPE:
-                                return emptyIfNull(request.getContentType());
-                            case REMOTE_ADDR:
-                                return latin1(request.getRemoteAddr());
-                            case REMOTE_HOST:
-                                return latin1(request.getRemoteHost());
-                            case REMOTE_PORT:
-                                return Py.newString(String.valueOf(request.getRemotePort()));
-                            case SERVER_NAME:
-                                return latin1(request.getLocalName());
-                            case SERVER_PORT:
-                                return Py.newString(String.valueOf(request.getLocalPort()));
-                            case SERVER_PROTOCOL:
-                                return latin1(request.getProtocol());
-                            case CONTENT_LENGTH:
-                                return getContentLength();
-                            default:
-                                return getHeader(k);
-                        }
-                    }
-                });
+        this.errLog = errLog;
+        this.wsgiInputStream = wsgiInputStream;
+        this.fileWrapper = fileWrapper;
+    }
+
+    // Whether the application may be called concurrently by other
+    // threads, as reported by wsgi.multithread; only meaningful if set
+    // before the environ is used
+    public void setMultithread(boolean multithread) {
+        this.multithread = multithread;
+    }
+
+    public boolean isMultithread() {
+        return multithread;
+    }
+
+    // Returns the value for key id, or ABSENT
+    private PyObject load(int id) {
+//        System.err.println("Loading key=" + KEYS[id]);
+        switch (id) {
+            case ID_WSGI_VERSION:
+                return PY_WSGI_VERSION;
+            case ID_WSGI_MULTITHREAD:
+                return multithread ? Py.True : Py.False;
+            case ID_WSGI_MULTIPROCESS:
+                return Py.False;
+            case ID_WSGI_RUN_ONCE:
+                return Py.False;
+            case ID_WSGI_ERRORS:
+                return errLog;
+            case ID_WSGI_INPUT:
+                return wsgiInputStream;
+            case ID_WSGI_FILE_WRAPPER:
+                return fileWrapper == null ? ABSENT : fileWrapper;
+            case ID_WSGI_URL_SCHEME:
+                return latin1(request.getScheme());
+            case ID_REQUEST_METHOD:
+                return latin1(request.getMethod());
+            case ID_SCRIPT_NAME:
+                return latin1(request.getServletPath());
+            case ID_PATH_INFO:
+                return emptyIfNull(request.getPathInfo());
+            case ID_QUERY_STRING:
+                return emptyIfNull(request.getQueryString());
+            case ID_CONTENT_TYPE:
+                return emptyIfNull(request.getContentType());
+            case ID_REMOTE_ADDR:
+                return latin1(request.getRemoteAddr());
+            case ID_REMOTE_HOST:
+                return latin1(request.getRemoteHost());
+            case ID_REMOTE_PORT:
+                return Py.newString(String.valueOf(request.getRemotePort()));
+            case ID_SERVER_NAME:
+                return latin1(request.getLocalName());
+            case ID_SERVER_PORT:
+                return Py.newString(String.valueOf(request.getLocalPort()));
+            case ID_SERVER_PROTOCOL:
+                return latin1(request.getProtocol());
+            case ID_CONTENT_LENGTH:
+                return getContentLength();
+            default:
+                throw new IllegalArgumentException("No such key id: " + id);
+        }
+    }
+
+    // Returns the value for key id, or null if absent
+    PyObject get(int id) {
+        PyObject value = values.get(id);
+        if (value == null) {
+            // unless the other thread has since loaded or changed it
+            PyObject loaded = load(id);
+            value = values.compareAndSet(id, null, loaded) ? loaded : values.get(id);
+        }
+        return value == ABSENT ? null : value;
+    }
+
+    boolean isChanged(int id) {
+        return (changed.get() & (1 << id)) != 0;
+    }
+
+    // The value is set before it is marked as changed, so that the request
+    // wrapper never sees a change without its value
+    private void markChanged(int id) {
+        int bits;
+        do {
+            bits = changed.get();
+        } while (!changed.compareAndSet(bits, bits | (1 << id)));
+    }
+
+    private PyObject put(int id, PyObject value) {
+        PyObject old = get(id);
+        values.set(id, value);
+        markChanged(id);
+        return old;
+    }
+
+    private PyObject remove(int id) {
+        PyObject old = get(id);
+        values.set(id, ABSENT);
+        markChanged(id);
+        return old;
+    }
+
+    private PyObject getExtra(PyObject key) {
+        PyObject value = extras.get(key);
+        if (value != null || changedExtras.contains(key) || !key.toString().startsWith("HTTP_")) {
+            return value;
+        }
+        // FIXME does this handle HTTP_COOKIE, or do we need to dispatch through on that as well?
+        value = getHeader(key.toString());
+        if (value != null) {
+            PyObject existing = extras.putIfAbsent(key, value);
+            return existing != null ? existing : value;
+        }
+        return null;
     }
 
     static private PyString latin1(String s) {
@@ -158,43 +355,47 @@ public class RequestBridge {
         }
     }
 
-    private PyString getContentLength() throws ExecutionException {
+    private PyObject getContentLength() {
         int length = request.getContentLength();
         if (length != -1) {
             return Py.newString(String.valueOf(length));
         } else {
-            throw new ExecutionException(null);
+            return ABSENT;
         }
     }
 
-    private static Map<String, String> getMappingForCGI(HttpServletRequest request) {
-        Enumeration<String> names = request.getHeaderNames();
-        Map<String, String> mapping = new LinkedHashMap();
-        while (names.hasMoreElements()) {
-            String name = names.nextElement();
-            // It is possible that this mapping is not bijective, but that's just a basic
-            // problem with CGI/WSGI naming. Also I would assume that real usage of HTTP headers
-            // are not going to do that.
-            //
-            // Regardless, we preserve the ordering of entries via the LinkedHashMap.
-            String cgiName = "HTTP_" + name.replace('-', '_').toUpperCase();
-            mapping.put(cgiName, name);
+    // Headers are only enumerated once a header key is looked up, or all of the
+    // environ is needed
+    private Map<String, HeaderName> getMappingForCGI() {
+        Map<String, HeaderName> mapping = mapCGI;
+        if (mapping == null) {
+            mapping = new LinkedHashMap<>();
+            Enumeration<String> names = request.getHeaderNames();
+            if (names != null) {
+                while (names.hasMoreElements()) {
+                    // Regardless, we preserve the ordering of entries via the LinkedHashMap.
+                    HeaderName headerName = headerName(names.nextElement());
+                    mapping.put(headerName.cgiName, headerName);
+                }
+            }
+            mapping = Collections.unmodifiableMap(mapping);
+            mapCGI = mapping;
         }
-        return Collections.unmodifiableMap(mapping);
+        return mapping;
     }
 
-    private PyString getHeader(String wsgiName) throws ExecutionException {
-        // FIXME does this handle HTTP_COOKIE, or do we need to dispatch through on that as well?
+    private PyString getHeader(String wsgiName) {
 //        System.err.println("mapCGI=" + mapCGI + ", wsgiName=" + wsgiName);
-        String name = mapCGI.get(wsgiName);
-        if (name != null) {
+        HeaderName headerName = getMappingForCGI().get(wsgiName);
+        if (headerName != null) {
+            String name = headerName.name;
             // Referenced CGI specs are not directly available (FIXME add wayback archive URLs?)
             // One source is https://www.ietf.org/rfc/rfc3875, but does not specify actual concatenation!
             // but this seems reasonable:
             // http://stackoverflow.com/questions/1801124/how-does-wsgi-handle-multiple-request-headers-with-the-same-name
             Enumeration<String> values = request.getHeaders(name);
             if (values == null) {
-                throw new ExecutionException(null);
+                return null;
             }
             StringBuilder builder = new StringBuilder();
             boolean firstThru = true;
@@ -208,14 +409,14 @@ public class RequestBridge {
             }
             if (firstThru) {
                 // no header at all
-                throw new ExecutionException(null);
+                return null;
             }
             return Py.newString(builder.toString());
         }
         // FIXME support THE_REQUEST, which also needs query params
         // FIXME support SSL_ prefixed headers by parsing req.getAttribute("javax.servlet.request.X509Certificate")
-        // FIXME need to add both types of headers to getSettings()
-        throw new ExecutionException(null);
+        // FIXME need to add both types of headers to loadAll()
+        return null;
     }
 
     // to be wrapped using jythonlib so it looks like a dict
@@ -223,40 +424,88 @@ public class RequestBridge {
         return new BridgeMap(this);
     }
 
+    // As asMap(), but as the environ of one of several calls sharing this
+    // bridge: wsgi.multithread is reported as given, and changes to it are
+    // only seen through this map
+    public ConcurrentMap asMap(boolean multithread) {
+        return new BridgeMap(this, multithread ? Py.True : Py.False);
+    }
+
     public HttpServletRequest asWrapper() {
         return new BridgeWrapper(this);
     }
 
-    public LoadingCache cache() {
-        return cache;
+    // Builds all of the environ in one pass as a plain dict, for apps that use
+    // all of it anyway; changes to the dict are not seen by asWrapper()
+    public PyDict asDict() {
+        PyDict dict = new PyDict();
+        Map<PyObject, PyObject> map = dict.getMap();
+        for (int id = 0; id < KEYS.length; id++) {
+            PyObject value = get(id);
+            if (value != null) {
+                map.put(PY_KEYS[id], value);
+            }
+        }
+        for (HeaderName headerName : getMappingForCGI().values()) {
+            PyString value = getHeader(headerName.cgiName);
+            if (value != null) {
+                map.put(headerName.key, value);
+            }
+        }
+        return dict;
     }
 
-    private Iterable<String> getSettings() {
-        final List<String> settings = new ArrayList<>(
-                Arrays.asList(WSGI_VERSION, WSGI_MULTITHREAD, WSGI_MULTIPROCESS, WSGI_RUN_ONCE,
-                        WSGI_ERRORS, WSGI_INPUT, WSGI_URL_SCHEME,
-                        REQUEST_METHOD, SCRIPT_NAME, PATH_INFO, QUERY_STRING, CONTENT_TYPE,
-                        REMOTE_ADDR, REMOTE_HOST, REMOTE_PORT,
-                        SERVER_NAME, SERVER_PORT, SERVER_PROTOCOL));
-        if (request.getContentLength() != -1) {
-            settings.add(CONTENT_LENGTH);
-        }
-        settings.addAll(mapCGI.keySet());
-        return settings;
+    public boolean isLoadedAll() {
+        return loadedAll;
+    }
+
+    // The number of entries in the environ. Unlike loadAll(), this only
+    // enumerates the header names, not their values, and does not count as
+    // all of the environ being needed, so len(environ) does not push an
+    // adaptive EnvironPolicy towards eager
+    public int size() {
+        int size = 0;
+        for (int id = 0; id < KEYS.length; id++) {
+            if (get(id) != null) {
+                size++;
+            }
+        }
+        Set<PyObject> headerKeys = new HashSet<>();
+        for (HeaderName headerName : getMappingForCGI().values()) {
+            if (!changedExtras.contains(headerName.key)) {
+                headerKeys.add(headerName.key);
+                size++;
+            }
+        }
+        for (PyObject key : extras.keySet()) {
+            if (!headerKeys.contains(key)) {
+                size++;
+            }
+        }
+        return size;
     }
 
-    public void loadAll() {
+    // Loads all values, returning the entries of the environ
+    public List<Map.Entry<PyObject, PyObject>> loadAll() {
 //        System.err.println("loadAll changed=" + changed);
-        for (String k : getSettings()) {
-            try {
-                if (!changed.contains(Py.newString(k))) {
-//                    System.err.println("getting key=" + k);
-                    cache.get(Py.newString(k));
-                }
-            } catch (ExecutionException e) {
-                e.printStackTrace();
+        loadedAll = true;
+        Map<String, HeaderName> mapping = getMappingForCGI();
+        List<Map.Entry<PyObject, PyObject>> entries = new ArrayList<>(KEYS.length + mapping.size() + extras.size());
+        for (int id = 0; id < KEYS.length; id++) {
+            PyObject value = get(id);
+            if (value != null) {
+                entries.add(new AbstractMap.SimpleImmutableEntry<PyObject, PyObject>(PY_KEYS[id], value));
+            }
+        }
+        for (HeaderName headerName : mapping.values()) {
+            if (!changedExtras.contains(headerName.key)) {
+                getExtra(headerName.key);
             }
         }
+        for (Map.Entry<PyObject, PyObject> entry : extras.entrySet()) {
+            entries.add(new AbstractMap.SimpleImmutableEntry<>(entry.getKey(), entry.getValue()));
+        }
+        return entries;
     }
 
     static class BridgeWrapper extends HttpServletRequestWrapper {
@@ -267,134 +516,126 @@ public class RequestBridge {
             this.bridge = bridge;
         }
 
-        public String intercept(PyString key) {
-            try {
-                PyObject value = (PyObject) bridge.cache().get(key);
-                if (value == Py.None) {
-                    return null;
-                } else {
-                    String s = value.toString();
-                    return codecs.PyUnicode_DecodeLatin1(s, s.length(), null);
-                }
-            } catch (ExecutionException e) {
+        public String intercept(int id) {
+            PyObject value = bridge.get(id);
+            if (value == null || value == Py.None) {
                 return null;
+            } else {
+                String s = value.toString();
+                return codecs.PyUnicode_DecodeLatin1(s, s.length(), null);
             }
         }
 
-        public int intercept_int(PyString key) {
-            try {
-                PyObject value = (PyObject) bridge.cache().get(key);
-                if (value == Py.None) {
-                    return -1;
-                } else {
-                    return value.asInt();
-                }
-            } catch (ExecutionException e) {
+        public int intercept_int(int id) {
+            PyObject value = bridge.get(id);
+            if (value == null || value == Py.None) {
                 return -1;
+            } else {
+                return value.asInt();
             }
         }
 
         public String getScheme() {
-            if (!bridge.changed.contains(PY_WSGI_URL_SCHEME)) {
+            if (!bridge.isChanged(ID_WSGI_URL_SCHEME)) {
                 return bridge.request.getScheme();
             } else {
-                return intercept(PY_WSGI_URL_SCHEME);
+                return intercept(ID_WSGI_URL_SCHEME);
             }
         }
 
         public String getMethod() {
-            if (!bridge.changed.contains(PY_REQUEST_METHOD)) {
+            if (!bridge.isChanged(ID_REQUEST_METHOD)) {
                 return bridge.request.getMethod();
             } else {
-                return intercept(PY_REQUEST_METHOD);
+                return intercept(ID_REQUEST_METHOD);
             }
         }
 
         public String getServletPath() {
-            if (!bridge.changed.contains(PY_SCRIPT_NAME)) {
+            if (!bridge.isChanged(ID_SCRIPT_NAME)) {
                 return bridge.request.getServletPath();
             } else {
-                return intercept(PY_SCRIPT_NAME);
+                return intercept(ID_SCRIPT_NAME);
             }
         }
 
         public String getPathInfo() {
-            if (!bridge.changed.contains(PY_PATH_INFO)) {
+            if (!bridge.isChanged(ID_PATH_INFO)) {
                 return bridge.request.getPathInfo();
             } else {
-                return intercept(PY_PATH_INFO);
+                return intercept(ID_PATH_INFO);
             }
         }
 
         public String getQueryString() {
-            if (!bridge.changed.contains(PY_QUERY_STRING)) {
+            if (!bridge.isChanged(ID_QUERY_STRING)) {
                 return bridge.request.getQueryString();
             } else {
-                return intercept(PY_QUERY_STRING);
+                return intercept(ID_QUERY_STRING);
             }
         }
 
         public String getContentType() {
-            if (!bridge.changed.contains(PY_CONTENT_TYPE)) {
+            if (!bridge.isChanged(ID_CONTENT_TYPE)) {
                 return bridge.request.getContentType();
             } else {
-                return intercept(PY_CONTENT_TYPE);
+                return intercept(ID_CONTENT_TYPE);
             }
         }
 
         public String getRemoteAddr() {
-            if (!bridge.changed.contains(PY_REMOTE_ADDR)) {
+            if (!bridge.isChanged(ID_REMOTE_ADDR)) {
                 return bridge.request.getRemoteAddr();
             } else {
-                return intercept(PY_REMOTE_ADDR);
+                return intercept(ID_REMOTE_ADDR);
             }
         }
 
         public String getRemoteHost() {
-            if (!bridge.changed.contains(PY_REMOTE_HOST)) {
+            if (!bridge.isChanged(ID_REMOTE_HOST)) {
                 return bridge.request.getRemoteHost();
             } else {
-                return intercept(PY_REMOTE_HOST);
+                return intercept(ID_REMOTE_HOST);
             }
         }
 
         public int getRemotePort() {
-            if (!bridge.changed.contains(PY_REMOTE_PORT)) {
+            if (!bridge.isChanged(ID_REMOTE_PORT)) {
                 return bridge.request.getRemotePort();
             } else {
-                return intercept_int(PY_REMOTE_PORT);
+                return intercept_int(ID_REMOTE_PORT);
             }
         }
 
         public String getLocalName() {
-            if (!bridge.changed.contains(PY_SERVER_NAME)) {
+            if (!bridge.isChanged(ID_SERVER_NAME)) {
                 return bridge.request.getLocalName();
             } else {
-                return intercept(PY_SERVER_NAME);
+                return intercept(ID_SERVER_NAME);
             }
         }
 
         public int getLocalPort() {
-            if (!bridge.changed.contains(PY_SERVER_PORT)) {
+            if (!bridge.isChanged(ID_SERVER_PORT)) {
                 return bridge.request.getLocalPort();
             } else {
-                return intercept_int(PY_SERVER_PORT);
+                return intercept_int(ID_SERVER_PORT);
             }
         }
 
         public String getProtocol() {
-            if (!bridge.changed.contains(PY_SERVER_PROTOCOL)) {
+            if (!bridge.isChanged(ID_SERVER_PROTOCOL)) {
                 return bridge.request.getProtocol();
             } else {
-                return intercept(PY_SERVER_PROTOCOL);
+                return intercept(ID_SERVER_PROTOCOL);
             }
         }
 
         public int getContentLength() {
-            if (!bridge.changed.contains(PY_CONTENT_LENGTH)) {
+            if (!bridge.isChanged(ID_CONTENT_LENGTH)) {
                 return bridge.request.getContentLength();
             } else {
-                return intercept_int(PY_CONTENT_LENGTH);
+                return intercept_int(ID_CONTENT_LENGTH);
             }
         }
 
@@ -408,66 +649,181 @@ public class RequestBridge {
 
     }
 
-    static class BridgeMap extends ForwardingConcurrentMap {
+    static class BridgeMap extends AbstractMap<Object, Object> implements ConcurrentMap<Object, Object> {
 
         private final RequestBridge bridge;
+        private PyObject multithread;   // overlays the bridge's value, unless null
 
         public BridgeMap(RequestBridge bridge) {
+            this(bridge, null);
+        }
+
+        BridgeMap(RequestBridge bridge, PyObject multithread) {
             this.bridge = bridge;
+            this.multithread = multithread;
+        }
+
+        private boolean overlays(int id) {
+            return id == ID_WSGI_MULTITHREAD && multithread != null;
+        }
+
+        private List<Map.Entry<PyObject, PyObject>> entries() {
+            List<Map.Entry<PyObject, PyObject>> entries = bridge.loadAll();
+            if (multithread != null) {
+                PyObject key = PY_KEYS[ID_WSGI_MULTITHREAD];
+                for (Iterator<Map.Entry<PyObject, PyObject>> it = entries.iterator(); it.hasNext();) {
+                    if (it.next().getKey() == key) {
+                        it.remove();
+                    }
+                }
+                if (multithread != ABSENT) {
+                    entries.add(new AbstractMap.SimpleImmutableEntry<>(key, multithread));
+                }
+            }
+            return entries;
         }
 
         public Object get(Object key) {
 //            System.err.println("Getting key=" + key);
-            try {
-                return bridge.cache().get(key);
-            } catch (ExecutionException e) {
-                return null; // throw Py.KeyError((PyObject) key);
+            int id = keyId(key);
+            if (overlays(id)) {
+                return multithread == ABSENT ? null : multithread;
+            } else if (id >= 0) {
+                return bridge.get(id);
+            } else {
+                return bridge.getExtra((PyObject) key);
             }
         }
 
+        public boolean containsKey(Object key) {
+            return get(key) != null;
+        }
+
         public Object put(Object key, Object value) {
 //            System.err.println("Updating key=" + key + ", value=" + value);
-            bridge.changed.add((PyObject) key);
-            return super.put(key, value);
+            int id = keyId(key);
+            if (overlays(id)) {
+                Object old = get(key);
+                multithread = (PyObject) value;
+                return old;
+            } else if (id >= 0) {
+                return bridge.put(id, (PyObject) value);
+            }
+            PyObject pyKey = (PyObject) key;
+            PyObject old = bridge.getExtra(pyKey);
+            bridge.changedExtras.add(pyKey);
+            bridge.extras.put(pyKey, (PyObject) value);
+            return old;
+        }
+
+        public Object remove(Object key) {
+//            System.err.println("Removing key=" + key);
+            int id = keyId(key);
+            if (overlays(id)) {
+                Object old = get(key);
+                multithread = ABSENT;
+                return old;
+            } else if (id >= 0) {
+                return bridge.remove(id);
+            }
+            PyObject pyKey = (PyObject) key;
+            PyObject old = bridge.getExtra(pyKey);
+            bridge.changedExtras.add(pyKey);
+            bridge.extras.remove(pyKey);
+            return old;
         }
 
         public void clear() {
 //            System.err.println("Clearing changes");
-            for (Object key : bridge.cache().asMap().keySet()) {
-                bridge.changed.add((PyObject) key);
+            for (int id = 0; id < KEYS.length; id++) {
+                bridge.values.set(id, ABSENT);
+            }
+            bridge.changed.set(~0);
+            for (HeaderName headerName : bridge.getMappingForCGI().values()) {
+                bridge.changedExtras.add(headerName.key);
+            }
+            bridge.changedExtras.addAll(bridge.extras.keySet());
+            bridge.extras.clear();
+            if (multithread != null) {
+                multithread = ABSENT;
             }
-            super.clear();
         }
 
-        public Object remove(Object key) {
-            PyObject pyKey = (PyObject) key;
-//            System.err.println("Removing key=" + (pyKey.__repr__()));
-            bridge.changed.add(pyKey);
-            // what if we remove a key that we haven't lazily loaded FIXME
-            return bridge.cache().asMap().remove(key);
+        public Object putIfAbsent(Object key, Object value) {
+            Object old = get(key);
+            if (old == null) {
+                put(key, value);
+            }
+            return old;
         }
 
-        // FIXME override putAll... any others?
+        public boolean remove(Object key, Object value) {
+            Object old = get(key);
+            if (old != null && old.equals(value)) {
+                remove(key);
+                return true;
+            }
+            return false;
+        }
 
-        protected ConcurrentMap delegate() {
-            return bridge.cache().asMap();
+        public boolean replace(Object key, Object oldValue, Object newValue) {
+            Object old = get(key);
+            if (old != null && old.equals(oldValue)) {
+                put(key, newValue);
+                return true;
+            }
+            return false;
         }
 
-        // FIXME
-        // probably do not have to override iterator remove, although I suppose if passed into Java this could cause issues;
-        // presumably we can just override the Iterator in this case
+        public Object replace(Object key, Object value) {
+            Object old = get(key);
+            if (old != null) {
+                put(key, value);
+            }
+            return old;
+        }
 
-        public Set keySet() {
-//            System.err.println("keySet");
-            // NB does not imply loadAll!
-            return new StandardKeySet() {
-            };
+        public int size() {
+            int size = bridge.size();
+            if (multithread != null) {
+                if (bridge.get(ID_WSGI_MULTITHREAD) != null) {
+                    size--;
+                }
+                if (multithread != ABSENT) {
+                    size++;
+                }
+            }
+            return size;
         }
 
-        public Set<Map.Entry> entrySet() {
-//            System.err.println("entrySet" + bridge.cache().asMap());
-            bridge.loadAll();
-            return bridge.cache().asMap().entrySet();
+        public Set<Map.Entry<Object, Object>> entrySet() {
+//            System.err.println("entrySet");
+            final List<Map.Entry<PyObject, PyObject>> entries = entries();
+            return new AbstractSet<Map.Entry<Object, Object>>() {
+                public Iterator<Map.Entry<Object, Object>> iterator() {
+                    final Iterator<Map.Entry<PyObject, PyObject>> it = entries.iterator();
+                    return new Iterator<Map.Entry<Object, Object>>() {
+                        private Map.Entry<PyObject, PyObject> last;
+
+                        public boolean hasNext() {
+                            return it.hasNext();
+                        }
+
+                        public Map.Entry<Object, Object> next() {
+                            last = it.next();
+                            return (Map.Entry) last;
+                        }
+
+                        public void remove() {
+                            BridgeMap.this.remove(last.getKey());
+                        }
+                    };
+                }
+
+                public int size() {
+                    return entries.size();
+                }
+            };
         }
 
     }
@@ -0,0 +1,186 @@
+package org.python.tools.fireside;
+
+import java.io.File;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.RandomAccessFile;
+import java.nio.ByteBuffer;
+import java.nio.channels.FileChannel;
+
+
+// Spools a request body as it is read, so that it can be read again from any
+// position - wsgi.input then supports seek/tell.
+//
+// Bodies up to the threshold are kept in memory. Larger ones are spilled to a
+// temporary file, which is deleted once it is open where the platform allows,
+// and otherwise on close. Spooled data can also be accessed without copying
+// through map().
+
+public class RequestSpool extends InputStream {
+    private final InputStream source;
+    private final int threshold;
+    private final File directory;
+    private byte[] memory;
+    private File tempFile;
+    private FileChannel file;
+    private long spooled = 0;   // bytes read from source so far
+    private long position = 0;
+    private boolean exhausted = false;
+
+    public RequestSpool(InputStream source, int threshold, File directory) {
+        this.source = source;
+        this.threshold = threshold;
+        this.directory = directory;
+        this.memory = new byte[Math.min(threshold, 8192)];
+    }
+
+    public long position() {
+        return position;
+    }
+
+    // Seeking past what has been spooled reads ahead from the request;
+    // as with files, seeking past the end is allowed
+    public void seek(long target) throws IOException {
+        if (target < 0) {
+            throw new IOException("Invalid seek position: " + target);
+        }
+        if (target > spooled) {
+            spoolUntil(target);
+        }
+        position = target;
+    }
+
+    // The size of the whole body, which requires reading all of it
+    public long size() throws IOException {
+        spoolUntil(Long.MAX_VALUE);
+        return spooled;
+    }
+
+    public boolean isSpilled() {
+        return file != null;
+    }
+
+    // Returns all of the body as a read-only buffer, memory-mapped if spilled
+    public ByteBuffer map() throws IOException {
+        spoolUntil(Long.MAX_VALUE);
+        if (file != null) {
+            return file.map(FileChannel.MapMode.READ_ONLY, 0, spooled);
+        } else {
+            return ByteBuffer.wrap(memory, 0, (int) spooled).asReadOnlyBuffer();
+        }
+    }
+
+    @Override
+    public int read() throws IOException {
+        byte[] b = new byte[1];
+        int n = read(b, 0, 1);
+        return n == 1 ? (b[0] & 0xff) : -1;
+    }
+
+    @Override
+    public int read(byte b[], int off, int len) throws IOException {
+        if (len == 0) {
+            return 0;
+        }
+        if (position < spooled) {
+            int n = (int) Math.min(len, spooled - position);
+            readSpooled(position, b, off, n);
+            position += n;
+            return n;
+        }
+        if (exhausted || position > spooled) {
+            return -1;
+        }
+        // Read straight into the caller's array, then spool a copy
+        int n = source.read(b, off, len);
+        if (n <= 0) {
+            exhausted = true;
+            return -1;
+        }
+        append(b, off, n);
+        position += n;
+        return n;
+    }
+
+    @Override
+    public int available() throws IOException {
+        if (position < spooled) {
+            return (int) Math.min(Integer.MAX_VALUE, spooled - position);
+        }
+        return exhausted ? 0 : source.available();
+    }
+
+    private void spoolUntil(long target) throws IOException {
+        byte[] scratch = new byte[8192];
+        while (!exhausted && spooled < target) {
+            int n = source.read(scratch, 0, (int) Math.min(scratch.length, target - spooled));
+            if (n <= 0) {
+                exhausted = true;
+            } else {
+                append(scratch, 0, n);
+            }
+        }
+    }
+
+    private void append(byte[] b, int off, int len) throws IOException {
+        if (file == null && spooled + len <= threshold) {
+            if (spooled + len > memory.length) {
+                byte[] grown = new byte[(int) Math.min(threshold, Math.max(2 * memory.length, spooled + len))];
+                System.arraycopy(memory, 0, grown, 0, (int) spooled);
+                memory = grown;
+            }
+            System.arraycopy(b, off, memory, (int) spooled, len);
+        } else {
+            if (file == null) {
+                spill();
+            }
+            writeFully(ByteBuffer.wrap(b, off, len), spooled);
+        }
+        spooled += len;
+    }
+
+    private void spill() throws IOException {
+        tempFile = File.createTempFile("fireside-upload", ".tmp", directory);
+        file = new RandomAccessFile(tempFile, "rw").getChannel();
+        if (tempFile.delete()) {
+            tempFile = null;
+        }
+        writeFully(ByteBuffer.wrap(memory, 0, (int) spooled), 0);
+        memory = null;
+    }
+
+    private void writeFully(ByteBuffer buffer, long at) throws IOException {
+        while (buffer.hasRemaining()) {
+            at += file.write(buffer, at);
+        }
+    }
+
+    private void readSpooled(long at, byte[] b, int off, int len) throws IOException {
+        if (file == null) {
+            System.arraycopy(memory, (int) at, b, off, len);
+            return;
+        }
+        ByteBuffer buffer = ByteBuffer.wrap(b, off, len);
+        while (buffer.hasRemaining()) {
+            int n = file.read(buffer, at);
+            if (n <= 0) {
+                throw new IOException("Request spool was truncated");
+            }
+            at += n;
+        }
+    }
+
+    @Override
+    public void close() throws IOException {
+        memory = null;
+        try {
+            if (file != null) {
+                file.close();
+            }
+        } finally {
+            if (tempFile != null) {
+                tempFile.delete();
+            }
+        }
+    }
+}
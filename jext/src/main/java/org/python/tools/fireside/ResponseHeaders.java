@@ -0,0 +1,156 @@
+package org.python.tools.fireside;
+
+import com.google.common.base.CharMatcher;
+import org.python.core.Py;
+import org.python.core.PyList;
+import org.python.core.PyObject;
+import org.python.core.PyString;
+import org.python.core.PyTuple;
+import org.python.core.codecs;
+
+import java.util.ArrayList;
+import java.util.Collection;
+import java.util.LinkedHashMap;
+import java.util.List;
+import java.util.Locale;
+import java.util.Map;
+
+import javax.servlet.http.HttpServletResponse;
+
+
+// The headers a filter chain has set on a response, as seen by the WSGI
+// middleware wrapping that chain.
+//
+// The headers stay on the response. Middleware gets them as a
+// response_headers list - PEP 3333 requires an actual list - and whatever
+// list it finally passes to start_response is compared with them, so that
+// only the headers it added or changed are written back, much as
+// RequestBridge only intercepts the request values the app changed.
+// Unlike RequestBridge, this is not a lazy view: since the middleware
+// needs a list, the headers are copied once, when it is given them.
+//
+// Containers such as Tomcat keep the content type and length apart from
+// the other headers. The content type is included here from
+// getContentType(); the content length cannot be read back, so unless the
+// body is passed through unchanged, any length the chain set is cleared,
+// and only a Content-Length in the middleware's headers is sent.
+
+public class ResponseHeaders {
+    private final HttpServletResponse response;
+    private final Map<String, Header> original;
+    private final boolean bodyReplaced;
+
+    private static final class Header {
+        final String name;
+        final List<String> values = new ArrayList<>(1);
+
+        Header(String name) {
+            this.name = name;
+        }
+    }
+
+    public ResponseHeaders(HttpServletResponse response) {
+        this(response, true);
+    }
+
+    // Unless bodyReplaced is false, the middleware may change the body, so
+    // the chain's content length no longer applies
+    public ResponseHeaders(HttpServletResponse response, boolean bodyReplaced) {
+        this.response = response;
+        this.original = new LinkedHashMap<>();
+        this.bodyReplaced = bodyReplaced;
+        Collection<String> names = response.getHeaderNames();
+        if (names != null) {
+            for (String name : names) {
+                Collection<String> values = response.getHeaders(name);
+                if (values != null) {
+                    for (String value : values) {
+                        add(original, name, value);
+                    }
+                }
+            }
+        }
+        String contentType = response.getContentType();
+        if (contentType != null && !original.containsKey(CONTENT_TYPE)) {
+            add(original, "Content-Type", contentType);
+        }
+    }
+
+    private static final String CONTENT_TYPE = "content-type";
+    private static final String CONTENT_LENGTH = "content-length";
+
+    private static void add(Map<String, Header> headers, String name, String value) {
+        String key = name.toLowerCase(Locale.ROOT);
+        Header header = headers.get(key);
+        if (header == null) {
+            header = new Header(name);
+            headers.put(key, header);
+        }
+        header.values.add(value);
+    }
+
+    private static PyString latin1(String s) {
+        if (CharMatcher.ASCII.matchesAllOf(s)) {
+            return Py.newString(s);
+        } else {
+            return Py.newString(codecs.PyUnicode_EncodeLatin1(s, s.length(), null));
+        }
+    }
+
+    // A new response_headers list
+    public PyList asList() {
+        PyList list = new PyList();
+        for (Header header : original.values()) {
+            PyString name = Py.newString(header.name);
+            for (String value : header.values) {
+                list.append(new PyTuple(name, latin1(value)));
+            }
+        }
+        return list;
+    }
+
+    // Updates the response to have the headers in responseHeaders, setting
+    // only those that differ, and removing those that are no longer there.
+    // Unlike resetting the response, this leaves alone whatever else is set
+    // on it, such as its status, character encoding and locale.
+    public void update(PyObject responseHeaders) {
+        Map<String, Header> changed = new LinkedHashMap<>();
+        for (PyObject item : responseHeaders.asIterable()) {
+            // as with PyString, each char is one byte, so this is latin1
+            add(changed, item.__getitem__(0).toString(), item.__getitem__(1).toString());
+        }
+        if (bodyReplaced && !changed.containsKey(CONTENT_LENGTH)) {
+            response.setContentLengthLong(-1);
+        }
+        for (Map.Entry<String, Header> entry : original.entrySet()) {
+            if (!changed.containsKey(entry.getKey())) {
+                remove(entry.getKey(), entry.getValue().name);
+            }
+        }
+        for (Map.Entry<String, Header> entry : changed.entrySet()) {
+            Header header = entry.getValue();
+            Header before = original.get(entry.getKey());
+            if (before == null || !before.values.equals(header.values)) {
+                response.setHeader(header.name, header.values.get(0));
+                for (String value : header.values.subList(1, header.values.size())) {
+                    response.addHeader(header.name, value);
+                }
+            }
+        }
+    }
+
+    private void remove(String key, String name) {
+        if (key.equals(CONTENT_TYPE)) {
+            response.setContentType(null);
+        } else if (key.equals(CONTENT_LENGTH)) {
+            response.setContentLengthLong(-1);
+        } else {
+            // Servlet 6 and Jetty remove a header set to null; containers
+            // that ignore that can at least send it empty
+            response.setHeader(name, null);
+            if (response.containsHeader(name)) {
+                response.setHeader(name, "");
+            }
+        }
+    }
+}
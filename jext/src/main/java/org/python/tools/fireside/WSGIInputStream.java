@@ -0,0 +1,235 @@
+package org.python.tools.fireside;
+
+import org.python.core.Py;
+import org.python.core.PyList;
+import org.python.core.PyString;
+
+import java.io.IOException;
+import java.io.InputStream;
+import java.nio.ByteBuffer;
+import java.util.Iterator;
+
+
+// wsgi.input, as a file-like wrapper of the request's input stream.
+//
+// Reads go through one reusable buffer per request. Lines are found by
+// scanning that buffer in bulk, and PyStrings are built directly from it,
+// so read/readline/readlines/iteration make no per-call Python allocations
+// beyond their results. If the request body is spooled, seek and tell are
+// also supported.
+
+public class WSGIInputStream implements Iterator<PyString> {
+    private final InputStream in;
+    private final RequestSpool spool;
+    private final byte[] buf;
+    private int pos = 0;
+    private int limit = 0;
+    private boolean eof = false;
+
+    public WSGIInputStream(InputStream in) {
+        this(in, 8192);
+    }
+
+    public WSGIInputStream(InputStream in, int bufferSize) {
+        this.in = in;
+        this.spool = (in instanceof RequestSpool) ? (RequestSpool) in : null;
+        this.buf = new byte[bufferSize];
+    }
+
+    // Refills the buffer, once it has been consumed
+    private boolean fill() throws IOException {
+        if (eof) {
+            return false;
+        }
+        pos = 0;
+        limit = 0;
+        int n = in.read(buf, 0, buf.length);
+        if (n <= 0) {
+            eof = true;
+            return false;
+        }
+        limit = n;
+        return true;
+    }
+
+    private boolean available() throws IOException {
+        return pos < limit || fill();
+    }
+
+    @SuppressWarnings("deprecation")
+    private static String chars(byte[] b, int off, int len) {
+        // Deliberately the deprecated constructor: it makes each byte
+        // the low byte of a char, which is exactly how PyString
+        // represents bytes
+        return new String(b, 0, off, len);
+    }
+
+    private void append(StringBuilder builder, int len) {
+        builder.append(chars(buf, pos, len));
+        pos += len;
+    }
+
+    public PyString read() throws IOException {
+        return read(-1);
+    }
+
+    public PyString read(int size) throws IOException {
+        if (size == 0 || !available()) {
+            return Py.EmptyString;
+        }
+        if (size > 0 && size <= limit - pos) {
+            PyString chunk = Py.newString(chars(buf, pos, size));
+            pos += size;
+            return chunk;
+        }
+        int remaining = size > 0 ? size : Integer.MAX_VALUE;
+        // avoid presizing to some arbitrarily large requested size
+        StringBuilder builder = new StringBuilder(
+                Math.min(remaining, Math.max((limit - pos) + in.available(), buf.length)));
+        while (remaining > 0 && available()) {
+            int n = Math.min(remaining, limit - pos);
+            append(builder, n);
+            remaining -= n;
+        }
+        return Py.newString(builder.toString());
+    }
+
+    public PyString readline() throws IOException {
+        return readline(-1);
+    }
+
+    public PyString readline(int size) throws IOException {
+        if (size == 0 || !available()) {
+            return Py.EmptyString;
+        }
+        int remaining = size > 0 ? size : Integer.MAX_VALUE;
+        StringBuilder builder = null;
+        while (available()) {
+            int end = pos + Math.min(remaining, limit - pos);
+            int i = pos;
+            while (i < end && buf[i] != '\n') {
+                i++;
+            }
+            boolean found = i < end;
+            int n = (found ? i + 1 : end) - pos;
+            if (builder == null && (found || n == remaining)) {
+                // common case: the whole line is in the buffer
+                PyString line = Py.newString(chars(buf, pos, n));
+                pos += n;
+                return line;
+            }
+            if (builder == null) {
+                builder = new StringBuilder(2 * n);
+            }
+            append(builder, n);
+            remaining -= n;
+            if (found || remaining == 0) {
+                break;
+            }
+        }
+        return Py.newString(builder.toString());
+    }
+
+    public PyList readlines() throws IOException {
+        return readlines(-1);
+    }
+
+    // Reads lines until at least hint bytes are read, or all of them if hint <= 0
+    public PyList readlines(int hint) throws IOException {
+        PyList lines = new PyList();
+        int total = 0;
+        while (true) {
+            PyString line = readline();
+            int len = line.__len__();
+            if (len == 0) {
+                break;
+            }
+            lines.append(line);
+            total += len;
+            if (hint > 0 && total >= hint) {
+                break;
+            }
+        }
+        return lines;
+    }
+
+    public boolean seekable() {
+        return spool != null;
+    }
+
+    private RequestSpool getSpool() throws IOException {
+        if (spool == null) {
+            throw new IOException("wsgi.input is not seekable unless spooled");
+        }
+        return spool;
+    }
+
+    public long tell() throws IOException {
+        // account for what is buffered but not yet read
+        return getSpool().position() - (limit - pos);
+    }
+
+    public void seek(long offset) throws IOException {
+        seek(offset, 0);
+    }
+
+    public void seek(long offset, int whence) throws IOException {
+        RequestSpool spool = getSpool();
+        long target;
+        switch (whence) {
+            case 0:
+                target = offset;
+                break;
+            case 1:
+                target = tell() + offset;
+                break;
+            case 2:
+                target = spool.size() + offset;
+                break;
+            default:
+                throw Py.ValueError("invalid whence (" + whence + ", should be 0, 1 or 2)");
+        }
+        spool.seek(target);
+        pos = 0;
+        limit = 0;
+        eof = false;
+    }
+
+    // All of the body, without copying; memory-mapped if it was spilled to disk
+    public ByteBuffer map() throws IOException {
+        return getSpool().map();
+    }
+
+    public void close() throws IOException {
+        if (spool != null) {
+            spool.close();
+        }
+    }
+
+    @Override
+    public boolean hasNext() {
+        try {
+            return available();
+        } catch (IOException e) {
+            throw Py.IOError(e);
+        }
+    }
+
+    @Override
+    public PyString next() {
+        try {
+            PyString line = readline();
+            if (line.__len__() == 0) {
+                throw Py.StopIteration("");
+            }
+            return line;
+        } catch (IOException e) {
+            throw Py.IOError(e);
+        }
+    }
+
+    @Override
+    public void remove() {
+        throw new UnsupportedOperationException();
+    }
+}
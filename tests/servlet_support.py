@@ -8,7 +8,7 @@ from jythonlib import dict_builder
 from nose.tools import assert_equal, assert_in, assert_is_instance, assert_not_in, assert_raises
 from mock import Mock
 
-from javax.servlet import ServletConfig, ServletInputStream
+from javax.servlet import DispatcherType, ServletConfig, ServletInputStream
 from javax.servlet.http import HttpServletResponse, HttpServletRequest
 from org.python.tools.fireside import RequestBridge, CaptureServletOutputStream
 from org.python.google.common.collect import Iterators
@@ -19,7 +19,7 @@ class ServletConfigMock(ServletConfig):
         self.params = params   
 
     def getInitParameter(self, name):
-        return self.params[name]
+        return self.params.get(name)
 
 
 class RequestMock(HttpServletRequest):
@@ -28,6 +28,18 @@ class RequestMock(HttpServletRequest):
 
     # note that we should be able to record that loadAll in fact touches each of these methods! FIXME
 
+    def __init__(self):
+        self.attributes = {}
+
+    def getAttribute(self, name):
+        return self.attributes.get(name)
+
+    def setAttribute(self, name, value):
+        self.attributes[name] = value
+
+    def removeAttribute(self, name):
+        self.attributes.pop(name, None)
+
     def getInputStream(self):
         class OnlyXsInputStream(ServletInputStream):
             def read(self):
@@ -73,6 +85,9 @@ class RequestMock(HttpServletRequest):
     def getServletPath(self):
         return "/foobar"
 
+    def getDispatcherType(self):
+        return DispatcherType.REQUEST
+
     def getHeaderNames(self):
         return Iterators.asEnumeration(Iterators.forArray([])) # Iterators.asEnumeration(Iterators.forArray(["Set-Baz", "Read-Foo", "BAR"]))
 
@@ -114,6 +129,29 @@ class ResponseMock(HttpServletResponse):
     def addHeader(self, name, header):
         self.headers[name].append(header)
 
+    def setHeader(self, name, header):
+        if header is None:
+            self.headers.pop(name, None)
+        else:
+            self.headers[name] = [header]
+
+    def containsHeader(self, name):
+        return bool(self.headers.get(name))
+
+    def sendError(self, code, msg=None):
+        self.my_status = code, msg
+
+    def getContentType(self):
+        return self.getHeader("Content-Type")
+
+    def setContentType(self, content_type):
+        self.setHeader("Content-Type", content_type)
+
+    def setContentLengthLong(self, length):
+        self.setHeader("Content-Length", str(length) if length >= 0 else None)
+
+    setContentLength = setContentLengthLong
+
     def getHeaderNames(self):
         return self.headers.keys()
 
@@ -166,6 +204,41 @@ def incremental_app(environ, start_response):
         yield chunk
 
 
+def write_app(environ, start_response):
+    """Mixes the write callable with a result, which must stay in order"""
+    status = '200 OK'
+    response_headers = [('Content-Type', 'text/plain')]
+    write = start_response(status, response_headers)
+    write(b"Hello")
+    for chunk in [b" ", b"world"]:
+        yield chunk
+        write(b"!")
+    yield b"\n"
+
+
+calls = 0
+
+
+def counting_app(environ, start_response):
+    """Keeps module-level state, so is not thread safe"""
+    global calls
+    calls += 1
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b"%d %s" % (calls, environ["wsgi.multithread"])]
+
+
+def list_app(environ, start_response):
+    """Unvalidated, so the server sees the list result and can use its length"""
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b"Hello", b" ", b"world!", b"\n"]
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [body]
+
+
 # FIXME also need simple apps that consume input stream (via POST);
 # supplied headers; what else?
 
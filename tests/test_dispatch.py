@@ -0,0 +1,163 @@
+from java.io import IOException
+from java.util.concurrent import CountDownLatch, TimeUnit
+from javax.servlet import AsyncContext, ServletOutputStream
+
+from fireside import WSGIServlet
+from org.python.tools.fireside import ByteArrayServletInputStream
+from servlet_support import RequestMock, ResponseMock, ServletConfigMock
+
+
+class AsyncContextMock(AsyncContext):
+
+    def __init__(self):
+        self.completed = CountDownLatch(1)
+        self.timeout = None
+        self.listeners = []
+
+    def addListener(self, listener, req=None, resp=None):
+        self.listeners.append(listener)
+
+    def setTimeout(self, timeout):
+        self.timeout = timeout
+
+    def complete(self):
+        for listener in self.listeners:
+            listener.onComplete(None)
+        self.completed.countDown()
+
+
+class AsyncRequestMock(RequestMock):
+
+    def isAsyncSupported(self):
+        return True
+
+    def startAsync(self, req=None, resp=None):
+        self.context = AsyncContextMock()
+        return self.context
+
+    def isAsyncStarted(self):
+        return hasattr(self, "context")
+
+    def getAsyncContext(self):
+        return self.context
+
+
+def test_async_servlet():
+    req_mock = AsyncRequestMock()
+    resp_mock = ResponseMock()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.incremental_app",
+          "fireside.async": "true",
+          "fireside.async_threads": "2" }))
+    try:
+        servlet.service(req_mock, resp_mock)
+        assert req_mock.context.completed.await(5, TimeUnit.SECONDS)
+        assert req_mock.context.timeout == 0
+        assert next(resp_mock.outputStream) == b"Hello"
+        assert resp_mock.getStatus() == 200
+    finally:
+        servlet.destroy()
+
+
+def test_nonblocking_output():
+    req_mock = AsyncRequestMock()
+    resp_mock = ResponseMock()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.incremental_app",
+          "fireside.async": "true",
+          "fireside.nonblocking_output": "true" }))
+    try:
+        servlet.service(req_mock, resp_mock)
+        assert req_mock.context.completed.await(5, TimeUnit.SECONDS)
+        assert next(resp_mock.outputStream) == b"Hello"
+        assert next(resp_mock.outputStream) == b" "
+        assert resp_mock.getHeader('Content-Type') == 'text/plain'
+    finally:
+        servlet.destroy()
+
+
+def test_nonblocking_output_admission():
+    # Non-blocking output is still writing after call_wsgi returns, so
+    # the request stays admitted until the async context completes
+    req_mock = AsyncRequestMock()
+    resp_mock = ResponseMock()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.incremental_app",
+          "fireside.async": "true",
+          "fireside.nonblocking_output": "true",
+          "fireside.max_concurrency": "1" }))
+    try:
+        servlet.service(req_mock, resp_mock)
+        assert req_mock.context.completed.await(5, TimeUnit.SECONDS)
+        assert next(resp_mock.outputStream) == b"Hello"
+        assert servlet.admission.in_flight == 0
+        assert len(req_mock.context.listeners) == 1
+        assert req_mock.context.listeners[0].released.get()
+    finally:
+        servlet.destroy()
+
+
+def test_nonblocking_output_disconnect():
+
+    class BrokenPipe(ServletOutputStream):
+        def isReady(self):
+            return True
+
+        def setWriteListener(self, listener):
+            listener.onWritePossible()
+
+        def write(self, *args):
+            raise IOException("Broken pipe")
+
+    class DisconnectedResponseMock(ResponseMock):
+        broken = BrokenPipe()
+
+        def getOutputStream(self):
+            return self.broken
+
+    req_mock = AsyncRequestMock()
+    resp_mock = DisconnectedResponseMock()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.incremental_app",
+          "fireside.async": "true",
+          "fireside.nonblocking_output": "true" }))
+    try:
+        servlet.service(req_mock, resp_mock)
+        assert req_mock.context.completed.await(5, TimeUnit.SECONDS)
+        # counted, and not failed with a 500
+        assert servlet.aborts.get() == 1
+        assert resp_mock.getStatus() == 200
+    finally:
+        servlet.destroy()
+
+
+def test_nonblocking_input():
+
+    class UploadRequestMock(AsyncRequestMock):
+
+        def getMethod(self):
+            return "POST"
+
+        def getContentLength(self):
+            return 7
+
+        def getInputStream(self):
+            return ByteArrayServletInputStream(bytearray("a=1&b=2"))
+
+    req_mock = UploadRequestMock()
+    resp_mock = ResponseMock()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.echo_app",
+          "fireside.async": "true",
+          "fireside.nonblocking_input": "1024" }))
+    try:
+        servlet.service(req_mock, resp_mock)
+        assert req_mock.context.completed.await(5, TimeUnit.SECONDS)
+        assert next(resp_mock.outputStream) == b"a=1&b=2"
+    finally:
+        servlet.destroy()
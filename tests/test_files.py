@@ -0,0 +1,39 @@
+from nose.tools import assert_equal
+
+from fireside.files import ByteRanges, if_range_matches, parse_ranges
+
+
+def test_parse_ranges():
+    assert_equal(parse_ranges(None, 100), None)
+    assert_equal(parse_ranges("bytes=0-9", 100), [(0, 9)])
+    assert_equal(parse_ranges("bytes=90-", 100), [(90, 99)])
+    assert_equal(parse_ranges("bytes=-10", 100), [(90, 99)])
+    assert_equal(parse_ranges("bytes=95-200", 100), [(95, 99)])
+    assert_equal(parse_ranges("bytes=50-59, 0-9", 100), [(50, 59), (0, 9)])
+    assert_equal(parse_ranges("bytes=0-9,5-19,20-29", 100), [(0, 29)])
+    assert_equal(parse_ranges("bytes=100-", 100), [])
+    assert_equal(parse_ranges("bytes=9-0", 100), None)
+    assert_equal(parse_ranges("bytes=a-b", 100), None)
+    assert_equal(parse_ranges("items=0-9", 100), None)
+    assert_equal(parse_ranges("bytes=" + ",".join(["%d-%d" % (i, i) for i in range(0, 40, 2)]), 100), None)
+
+
+def test_if_range():
+    headers = {"etag": '"abc"', "last-modified": "Sat, 17 Oct 2026 12:00:00 GMT"}
+    assert if_range_matches(None, headers)
+    assert if_range_matches('"abc"', headers)
+    assert not if_range_matches('"xyz"', headers)
+    assert not if_range_matches('W/"abc"', headers)
+    assert if_range_matches("Sat, 17 Oct 2026 12:00:00 GMT", headers)
+    assert not if_range_matches("Fri, 16 Oct 2026 12:00:00 GMT", headers)
+
+
+def test_multipart_byte_ranges():
+    byte_ranges = ByteRanges([(0, 4), (10, 14)], 100, "text/plain")
+    parts = list(byte_ranges.parts())
+    assert_equal(len(parts), 3)
+    assert "Content-Range: bytes 10-14/100" in parts[1][0]
+    assert_equal(parts[2][1:], (None, None))
+    assert_equal(byte_ranges.content_length(), sum(len(prefix) for prefix, first, last in parts) + 10)
+    assert_equal(byte_ranges.headers(),
+                 [("Content-Type", "multipart/byteranges; boundary=%s" % (byte_ranges.boundary,))])
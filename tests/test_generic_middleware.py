@@ -1,7 +1,8 @@
-from fireside import WSGIFilter
+from fireside import WSGIFilter, WSGIServlet
+from fireside.servlet import BRIDGE_ATTRIBUTE
 from webob.dec import wsgify
 from servlet_support import *  # FIXME be explicit
-from javax.servlet import FilterChain
+from javax.servlet import DispatcherType, FilterChain
 
 
 # Derived from the Latinator example in PEP3333, but without requiring
@@ -129,5 +130,215 @@ def test_generic_filter():
     assert resp_mock.getStatus() == 200
 
 
+def tag_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [environ.get("fireside.tag", "untagged")]
 
 
+def multithread_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(environ["wsgi.multithread"])]
+
+
+def test_shared_bridge():
+    req_mock = RequestMock()
+    resp_mock = ResponseMock()
+    filter = WSGIFilter()
+    filter.init(ServletConfigMock({ "wsgi.handler": "test_generic_middleware.Uppercaser" }))
+    shared = []
+    class SharingChain(FilterChain):
+        def doFilter(self, req, resp):
+            shared.append(req.getAttribute(BRIDGE_ATTRIBUTE))
+            resp.outputStream.close()
+
+    filter.doFilter(req_mock, resp_mock, SharingChain())
+    assert_is_instance(shared[0], RequestBridge)
+    assert_not_in(BRIDGE_ATTRIBUTE, req_mock.attributes)
+
+    # A servlet behind the filter uses its environ, with any changes made
+    bridge = RequestBridge(req_mock, AdaptedInputStream(), AdaptedErrLog())
+    dict_builder(bridge.asMap)()["fireside.tag"] = "tagged"
+    req_mock.setAttribute(BRIDGE_ATTRIBUTE, bridge)
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock({ "wsgi.handler": "test_generic_middleware.tag_app" }))
+    servlet.service(req_mock, resp_mock)
+    assert next(resp_mock.outputStream) == b"tagged"
+
+    # but not once the request is forwarded elsewhere
+    class ForwardedRequestMock(RequestMock):
+        def getDispatcherType(self):
+            return DispatcherType.FORWARD
+
+    forwarded = ForwardedRequestMock()
+    forwarded.setAttribute(BRIDGE_ATTRIBUTE, bridge)
+    resp_mock = ResponseMock()
+    servlet.service(forwarded, resp_mock)
+    assert next(resp_mock.outputStream) == b"untagged"
+
+    # a pooled servlet overlays wsgi.multithread, leaving the shared environ as is
+    pooled = WSGIServlet()
+    pooled.init(ServletConfigMock({ "wsgi.handler": "test_generic_middleware.multithread_app",
+                                    "fireside.app_pool": "1" }))
+    try:
+        resp_mock = ResponseMock()
+        pooled.service(req_mock, resp_mock)
+        assert next(resp_mock.outputStream) == b"False"
+        assert dict_builder(bridge.asMap)()["wsgi.multithread"] is True
+    finally:
+        pooled.destroy()
+
+
+class Passthrough(object):
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        for chunk in self.application(environ, start_response):
+            yield chunk
+
+
+def test_streaming_filter():
+    req_mock = RequestMock()
+    resp_mock = ResponseMock()
+    filter = WSGIFilter()
+    filter.init(ServletConfigMock({ "wsgi.handler": "test_generic_middleware.Passthrough" }))
+
+    class StreamingChain(FilterChain):
+        def doFilter(self, req, resp):
+            resp.addHeader("Content-Type", "text/plain")
+            for i in xrange(500):
+                resp.outputStream.write("chunk %d\n" % i)
+                # each chunk has passed through the middleware before
+                # the next is written
+                assert next(resp_mock.outputStream) == "chunk %d\n" % i
+
+    filter.doFilter(req_mock, resp_mock, StreamingChain())
+    assert resp_mock.getHeaders("Content-Type") == ["text/plain"]
+
+
+class Collector(object):
+
+    # Unlike PEP 3333 middleware, consumes all of the application's
+    # output before yielding
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        chunks = list(self.application(environ, start_response))
+        yield "".join(chunks).upper()
+
+
+def drain(stream):
+    chunks = []
+    while True:
+        chunk = next(stream)
+        if not chunk:
+            return chunks
+        chunks.append(chunk)
+
+
+def test_collecting_filter():
+    # Without a worker thread, the chain's output is held for middleware
+    # that takes more than one chunk before yielding
+    class WritingChain(FilterChain):
+        def doFilter(self, req, resp):
+            resp.addHeader("Content-Type", "text/plain")
+            for i in xrange(100):
+                resp.outputStream.write("chunk %d\n" % i)
+                resp.outputStream.flush()
+
+    filter = WSGIFilter()
+    filter.init(ServletConfigMock({ "wsgi.handler": "test_generic_middleware.Collector" }))
+    resp_mock = ResponseMock()
+    filter.doFilter(RequestMock(), resp_mock, WritingChain())
+    assert "".join(drain(resp_mock.outputStream)) == "".join(
+        "CHUNK %d\n" % i for i in xrange(100))
+    assert resp_mock.getHeaders("Content-Type") == ["text/plain"]
+
+
+def test_piped_filter():
+    expected = "".join("chunk %d\n" % i for i in xrange(100))
+
+    class WritingChain(FilterChain):
+        def doFilter(self, req, resp):
+            resp.addHeader("Content-Type", "text/plain")
+            for i in xrange(100):
+                resp.outputStream.write("chunk %d\n" % i)
+
+    for handler, body in (("Passthrough", expected), ("Collector", expected.upper())):
+        filter = WSGIFilter()
+        filter.init(ServletConfigMock({
+            "wsgi.handler": "test_generic_middleware." + handler,
+            "fireside.filter_threads": "2",
+            "fireside.filter_pipe": "4" }))
+        resp_mock = ResponseMock()
+        filter.doFilter(RequestMock(), resp_mock, WritingChain())
+        assert "".join(drain(resp_mock.outputStream)) == body
+        assert resp_mock.getHeaders("Content-Type") == ["text/plain"]
+        filter.destroy()
+
+
+class Ignorer(object):
+
+    # Calls the application, but never iterates over its result
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        self.application(environ, start_response)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["ignored"]
+
+
+def test_piped_filter_failure():
+    # The chain's failure is raised even though the middleware never
+    # reached the end of its output
+    class FailingChain(FilterChain):
+        def doFilter(self, req, resp):
+            raise ValueError("failed downstream")
+
+    filter = WSGIFilter()
+    filter.init(ServletConfigMock({
+        "wsgi.handler": "test_generic_middleware.Ignorer",
+        "fireside.filter_threads": "1" }))
+    try:
+        assert_raises(ValueError, filter.doFilter, RequestMock(), ResponseMock(), FailingChain())
+    finally:
+        filter.destroy()
+
+
+class RequestIdentifier(object):
+
+    # Only changes headers, returning the application's iterable as is
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        def identified_start_response(status, response_headers, exc_info=None):
+            return start_response(status, response_headers + [("X-Request-Id", "42")], exc_info)
+        return self.application(environ, identified_start_response)
+
+
+def test_passthrough_filter():
+    req_mock = RequestMock()
+    resp_mock = ResponseMock()
+    filter = WSGIFilter()
+    filter.init(ServletConfigMock({ "wsgi.handler": "test_generic_middleware.RequestIdentifier" }))
+
+    class DirectChain(FilterChain):
+        def doFilter(self, req, resp):
+            resp.addHeader("Content-Type", "text/plain")
+            resp.outputStream.write("hi, ")
+            # written straight to the response, with the header added
+            assert next(resp_mock.outputStream) == "hi, "
+            assert resp_mock.getHeaders("X-Request-Id") == ["42"]
+            resp.outputStream.write("there!\n")
+
+    filter.doFilter(req_mock, resp_mock, DirectChain())
+    assert next(resp_mock.outputStream) == "there!\n"
+    assert resp_mock.getHeaders("Content-Type") == ["text/plain"]
+    assert resp_mock.getStatus() == 200
@@ -1,4 +1,8 @@
 from servlet_support import *
+from threading import Thread
+from java.io import ByteArrayInputStream, IOException
+from org.python.tools.fireside import (
+    BufferPool, ChunkPipe, ChunkWriter, RequestSpool, ResponseHeaders, WSGIInputStream)
 
 # Change into a true test of the wrapper/map bridge code
 # verify cases like read-after-delete - DONE
@@ -65,6 +69,48 @@ def check_request_bridge(method, key, value):
     # that bridge_map should support, including views
 
 
+def test_request_bridge_other_keys():
+    req_mock = RequestMock()
+    bridge = RequestBridge(req_mock, AdaptedInputStream(), AdaptedErrLog())
+    bridge_map = dict_builder(bridge.asMap)()
+
+    assert_equal(bridge_map["wsgi.version"], (1, 0))
+    assert_not_in("fireside.custom", bridge_map)
+    bridge_map["fireside.custom"] = "value"
+    assert_equal(bridge_map["fireside.custom"], "value")
+    bridge_map["REQUEST_METHOD"] = "POST"
+    assert_equal(bridge_map["REQUEST_METHOD"], "POST")
+    items = dict(bridge_map.items())
+    assert_equal(items["fireside.custom"], "value")
+    assert_equal(items["REQUEST_METHOD"], "POST")
+    assert_equal(len(bridge_map), len(items))
+    del bridge_map["fireside.custom"]
+    assert_not_in("fireside.custom", bridge_map)
+    bridge_map.clear()
+    assert_equal(len(bridge_map), 0)
+
+
+def test_request_bridge_headers():
+    req_mock = RequestMock()
+    req_mock.getHeaderNames = Mock(
+        side_effect=lambda: Iterators.asEnumeration(Iterators.forArray(["User-Agent", "X-Forwarded-For"])))
+    req_mock.getHeaders = Mock(
+        side_effect=lambda name: Iterators.asEnumeration(Iterators.forArray(["%s-value" % name])))
+    bridge = RequestBridge(req_mock, AdaptedInputStream(), AdaptedErrLog())
+    bridge_map = dict_builder(bridge.asMap)()
+
+    # headers are not enumerated unless a header key is needed
+    assert_equal(bridge_map["REQUEST_METHOD"], "GET")
+    assert_not_in("fireside.custom", bridge_map)
+    assert_equal(req_mock.getHeaderNames.call_count, 0)
+
+    assert_equal(bridge_map["HTTP_USER_AGENT"], "User-Agent-value")
+    assert_not_in("HTTP_ACCEPT", bridge_map)
+    items = dict(bridge_map.items())
+    assert_equal(items["HTTP_X_FORWARDED_FOR"], "X-Forwarded-For-value")
+    assert_equal(req_mock.getHeaderNames.call_count, 1)
+
+
 def test_capture_output_stream():
 
     def assert_chunk_is_str(chunk):
@@ -81,3 +127,163 @@ def test_capture_output_stream():
     assert next(stream) == ""
     stream.close()
     assert_raises(StopIteration, next, stream)
+
+
+def test_coalescing_capture_output_stream():
+    chunks = []
+    stream = CaptureServletOutputStream(chunks.append, False, 8)
+    stream.write(bytearray("xxabcyy"), 2, 3)
+    stream.write(ord("d"))
+    stream.write(bytearray("\xff\x80"))
+    assert chunks == []
+    stream.write(bytearray("efgh"))
+    assert chunks == ["abcd\xff\x80ef"]
+    stream.write(bytearray("0123456789"))   # larger than a chunk
+    assert chunks == ["abcd\xff\x80ef", "gh", "0123456789"]
+    stream.write(bytearray("z"))
+    stream.close()
+    assert chunks[-1] == "z"
+    assert_raises(IOException, stream.write, bytearray("after"))
+
+
+def test_pooled_capture_output_stream():
+    pool = BufferPool(6)
+    chunks = []
+    stream = CaptureServletOutputStream(chunks.append, False, pool)
+    stream.write(bytearray("abc"))
+    stream.write(bytearray("defgh"))
+    assert chunks == ["abcdef"]
+    stream.close()
+    assert chunks == ["abcdef", "gh"]
+    # the buffer is returned to the pool, for the next response
+    assert pool.getPooled() == 1
+    stream = CaptureServletOutputStream(chunks.append, False, pool)
+    stream.write(bytearray("ij"))
+    assert pool.getPooled() == 0
+    stream.close()
+    assert pool.getPooled() == 1
+
+
+def test_chunk_writer():
+    stream = CaptureServletOutputStream(lambda chunk: None)
+    writer = ChunkWriter(stream, 16)
+    assert writer.write("foo") == 3
+    assert writer.write(bytearray("bar")) == 3
+    assert writer.write(buffer("bazzle", 0, 3)) == 3
+    assert writer.write(memoryview("xyz")) == 3
+    assert next(stream) == ""
+    writer.flush()
+    assert next(stream) == "foobarbazxyz"
+    # larger chunks spill the buffer, then are written directly
+    writer.write("0123456789")
+    writer.write(bytearray("abcdefghijklmnopqrstuvwxyz"))
+    assert next(stream) == "0123456789"
+    assert next(stream) == "abcdefghijklmnopqrstuvwxyz"
+    assert_raises(TypeError, writer.write, u"unicode")
+
+
+def test_wsgi_input_stream():
+
+    def input_stream(data):
+        # small buffer, so lines span refills
+        return WSGIInputStream(ByteArrayInputStream(bytearray(data)), 4)
+
+    stream = input_stream("first line\nsecond\n\nlast")
+    assert stream.readline() == "first line\n"
+    assert stream.readline(3) == "sec"
+    assert stream.readline() == "ond\n"
+    assert stream.readline() == "\n"
+    assert stream.readline() == "last"
+    assert stream.readline() == ""
+
+    stream = input_stream("abcdefghij")
+    assert stream.read(2) == "ab"
+    assert stream.read(5) == "cdefg"
+    assert stream.read() == "hij"
+    assert stream.read() == ""
+
+    assert list(input_stream("a\nbb\nccc")) == ["a\n", "bb\n", "ccc"]
+    assert list(input_stream("a\nbb\nccc").readlines()) == ["a\n", "bb\n", "ccc"]
+    assert list(input_stream("a\nbb\nccc").readlines(3)) == ["a\n", "bb\n"]
+
+
+def test_spooled_wsgi_input_stream():
+    for threshold in (4, 1024):   # spilled to disk, and in memory
+        spool = RequestSpool(ByteArrayInputStream(bytearray("line one\nline two\n")), threshold, None)
+        stream = WSGIInputStream(spool, 4)
+        try:
+            assert stream.seekable()
+            assert stream.readline() == "line one\n"
+            assert stream.tell() == 9
+            assert stream.read() == "line two\n"
+            stream.seek(5)
+            assert stream.read(3) == "one"
+            stream.seek(-4, 2)
+            assert stream.read() == "two\n"
+            stream.seek(0)
+            assert list(stream) == ["line one\n", "line two\n"]
+            assert spool.isSpilled() == (threshold == 4)
+            assert stream.map().remaining() == 18
+        finally:
+            stream.close()
+
+    assert not WSGIInputStream(ByteArrayInputStream(bytearray("abc"))).seekable()
+
+
+def test_chunk_pipe():
+    pipe = ChunkPipe(3)
+    assert pipe.capacity() == 4
+
+    def write():
+        for i in xrange(50):
+            pipe.put("%d," % i)
+        pipe.close()
+
+    writer = Thread(target=write)
+    writer.start()
+    assert "".join(pipe) == "".join("%d," % i for i in xrange(50))
+    writer.join()
+
+    # cancelling fails a writer waiting on a full pipe
+    pipe = ChunkPipe(1)
+    pipe.put("a")
+    failures = []
+
+    def blocked_write():
+        try:
+            pipe.put("b")
+        except IOException as e:
+            failures.append(e)
+
+    writer = Thread(target=blocked_write)
+    writer.start()
+    pipe.cancel()
+    writer.join()
+    assert len(failures) == 1
+
+
+def test_response_headers():
+    resp_mock = ResponseMock()
+    resp_mock.addHeader("Content-Type", "text/plain")
+    resp_mock.addHeader("Set-Cookie", "a=1")
+    resp_mock.addHeader("Set-Cookie", "b=2")
+    headers = ResponseHeaders(resp_mock)
+    response_headers = headers.asList()
+    assert type(response_headers) is list
+    assert sorted(response_headers) == [
+        ("Content-Type", "text/plain"), ("Set-Cookie", "a=1"), ("Set-Cookie", "b=2")]
+
+    # only changes are written back
+    resp_mock.setHeader = Mock(side_effect=resp_mock.setHeader)
+    headers.update(response_headers + [("X-Request-Id", "42")])
+    resp_mock.setHeader.assert_called_once_with("X-Request-Id", "42")
+    assert resp_mock.getHeaders("Set-Cookie") == ["a=1", "b=2"]
+
+    # removed headers are removed individually, leaving the rest of the response
+    resp_mock.setStatus(404, "Not Found")
+    resp_mock.addHeader("X-Container", "1")   # not seen by the middleware
+    headers.update([("Content-Type", "text/html")])
+    assert resp_mock.getHeaders("Content-Type") == ["text/html"]
+    assert resp_mock.getHeaders("Set-Cookie") is None
+    assert resp_mock.getHeaders("X-Container") == ["1"]
+    assert resp_mock.getStatus() == 404
@@ -1,7 +1,17 @@
+import os
+import sys
+import tempfile
+import threading
+from StringIO import StringIO
+
 from fireside import WSGIServlet
+from fireside.servlet import FLUSHES_ATTRIBUTE, EnvironPolicy, FlushPolicy, ResponseWriter, WSGICall
+from fireside.warmup import Warmup, WarmupRequest
 from jythonlib import dict_builder
 from nose.tools import assert_equal, assert_in, assert_is_instance, assert_not_in, assert_raises
 
+from java.io import IOException, RandomAccessFile
+from javax.servlet import ServletException, ServletOutputStream
 from org.python.tools.fireside import RequestBridge
 from servlet_support import AdaptedErrLog, AdaptedInputStream, ResponseMock, RequestMock, ServletConfigMock
 
@@ -39,5 +49,420 @@ def test_incremental_servlet():
     assert resp_mock.getStatus() == 200
 
 
+def test_coalescing_servlet():
+    req_mock = RequestMock()
+    resp_mock = ResponseMock()
+    bridge = RequestBridge(req_mock, AdaptedInputStream(), AdaptedErrLog())
+    req_wrapper = bridge.asWrapper()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.incremental_app",
+          "fireside.flush_policy": "threshold",
+          "fireside.flush_threshold": "1024" }))
+    servlet.service(req_wrapper, resp_mock)
+    assert next(resp_mock.outputStream) == b"Hello world!\n"
+    assert next(resp_mock.outputStream) == b""
+    assert req_mock.getAttribute(FLUSHES_ATTRIBUTE) == 1
+
+
+def test_content_length_from_list():
+    req_mock = RequestMock()
+    resp_mock = ResponseMock()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.list_app" }))
+    servlet.service(req_mock, resp_mock)
+    assert next(resp_mock.outputStream) == b"Hello"
+    assert resp_mock.getHeader('Content-Length') == '13'
+
+
+def test_prebuffered_content_length():
+    req_mock = RequestMock()
+    resp_mock = ResponseMock()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.incremental_app",
+          "fireside.prebuffer": "1024" }))
+    servlet.service(req_mock, resp_mock)
+    assert next(resp_mock.outputStream) == b"Hello"
+    assert resp_mock.getHeader('Content-Length') == '13'
+
+    # bodies larger than the prebuffer are streamed without a length
+    resp_mock = ResponseMock()
+    servlet.prebuffer = 8
+    servlet.service(req_mock, resp_mock)
+    assert next(resp_mock.outputStream) == b"Hello"
+    assert resp_mock.getHeader('Content-Length') is None
+
+
+def test_prefetch():
+    req_mock = RequestMock()
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.write_app",
+          "fireside.prefetch": "2" }))
+    try:
+        for i in xrange(20):
+            resp_mock = ResponseMock()
+            servlet.service(req_mock, resp_mock)
+            assert_equal(list(resp_mock.outputStream.getChunks()),
+                         [b"Hello", b" ", b"!", b"world", b"!", b"\n"])
+            assert resp_mock.getHeader('Content-Type') == 'text/plain'
+    finally:
+        servlet.destroy()
+
+
+def test_client_disconnect():
+
+    class BrokenPipe(ServletOutputStream):
+        def write(self, *args):
+            raise IOException("Broken pipe")
+
+    class DisconnectedResponseMock(ResponseMock):
+        def getOutputStream(self):
+            return BrokenPipe()
+
+    pulled = []
+    closed = []
+
+    def endless_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        try:
+            while True:
+                pulled.append(b"x")
+                yield b"x"
+        finally:
+            closed.append(True)
+
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.simple_app" }))
+    servlet.application = endless_app
+    servlet.service(RequestMock(), DisconnectedResponseMock())
+    assert_equal(pulled, [b"x"])
+    assert_equal(closed, [True])
+    assert_equal(servlet.aborts.get(), 1)
+
+
+def test_admission_control():
+
+    class OtherRequestMock(RequestMock):
+        # not under /foobar, as prefixes match whole segments
+        def getServletPath(self):
+            return "/foobarbaz"
+
+        def getPathInfo(self):
+            return "/other"
+
+    entered = threading.Event()
+    proceed = threading.Event()
+
+    def blocking_app(environ, start_response):
+        if environ["PATH_INFO"] == "/other":
+            entered.set()
+            proceed.wait(5)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.simple_app",
+          "fireside.max_concurrency": "1",
+          "fireside.retry_after": "3",
+          "fireside.admission_bypass": "/health, /foobar/" }))
+    servlet.application = blocking_app
+    held = ResponseMock()
+    first = threading.Thread(target=servlet.service, args=(OtherRequestMock(), held))
+    first.start()
+    try:
+        assert entered.wait(5)
+        rejected = ResponseMock()
+        servlet.service(OtherRequestMock(), rejected)
+        assert_equal(rejected.getStatus(), 503)
+        assert_equal(rejected.getHeader("Retry-After"), "3")
+        assert_equal(servlet.admission.rejected.get(), 1)
+
+        # while the health check path is never limited
+        bypassed = ResponseMock()
+        servlet.service(RequestMock(), bypassed)
+        assert_equal(bypassed.getStatus(), 200)
+        assert next(bypassed.outputStream) == b"done"
+    finally:
+        proceed.set()
+        first.join()
+    assert_equal(held.getStatus(), 200)
+    assert_equal(servlet.admission.in_flight, 0)
+
+
+def test_app_pool():
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.counting_app",
+          "fireside.app_pool": "2" }))
+    try:
+        bodies = []
+        for i in xrange(4):
+            resp_mock = ResponseMock()
+            servlet.service(RequestMock(), resp_mock)
+            bodies.append(next(resp_mock.outputStream))
+        # each instance has its own module globals
+        assert_equal(bodies, [b"1 False", b"1 False", b"2 False", b"2 False"])
+    finally:
+        servlet.destroy()
+
+
+def test_app_pool_timeout():
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.counting_app",
+          "fireside.app_pool": "1",
+          "fireside.app_pool_timeout": "10" }))
+    try:
+        # with its only instance stuck, requests are shed
+        instance = servlet.app_pool.checkout()
+        resp_mock = ResponseMock()
+        servlet.service(RequestMock(), resp_mock)
+        assert_equal(resp_mock.getStatus(), 503)
+        assert_equal(resp_mock.getHeader("Retry-After"), "1")
+        assert_equal(servlet.app_pool.rejected.get(), 1)
+        servlet.app_pool.checkin(instance)
+    finally:
+        servlet.destroy()
+
+    # a malformed wsgi.handler is reported as such, not from the interpreter
+    with assert_raises(Exception) as cm:
+        WSGIServlet().init(ServletConfigMock(
+            { "wsgi.handler": "counting_app", "fireside.app_pool": "1" }))
+    assert_in("wsgi.handler not configured properly", cm.exception.args)
+
+
+def environ_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(len(dict(environ.items())))]
+
+
+def test_warmup():
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.simple_app",
+          "fireside.warmup_imports": "json",
+          "fireside.warmup_paths": "/, /items?page=2",
+          "fireside.warmup_iterations": "3",
+          "fireside.warmup_tolerance": "0" }))
+    assert_equal(len(servlet.warmup.timings), 3)
+    assert_in("json", sys.modules)
+
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.simple_app" }))
+    assert servlet.warmup is None
+
+    # through the real call, with all of the environ used
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "test_servlet.environ_app",
+          "fireside.warmup_paths": "/items?page=2",
+          "fireside.warmup_iterations": "1" }))
+    assert servlet.warmup.run(servlet.call_wsgi)
+
+    # and complete enough for applications and frameworks
+    req = WarmupRequest("/items?page=2&q=a+b")
+    assert_equal(req.getParameter("q"), "a b")
+    assert_equal(list(req.getParameterValues("page")), ["2"])
+    assert_equal(req.getHeaders("host").nextElement(), "localhost")
+    assert req.getCharacterEncoding() is None
+    assert_equal(req.getContextPath(), "")
+    assert_equal(req.getRequestURI(), "/items")
+    assert req.getSession() is None
+    assert_equal(req.getInputStream().read(), -1)
+
+    # a 5xx status fails the warm-up, as does a failed import
+    def unavailable(req, resp):
+        resp.sendError(503)
+
+    assert not Warmup(StringIO(), ["/"], iterations=2).run(unavailable)
+    assert not Warmup(StringIO(), imports=["no_such_module"]).run(unavailable)
+
+    # by default the servlet then serves cold, unless warm-up is required
+    config = { "wsgi.handler": "servlet_support.simple_app",
+               "fireside.warmup_imports": "no_such_module" }
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(config))
+    config["fireside.warmup_required"] = "true"
+    assert_raises(ServletException, WSGIServlet().init, ServletConfigMock(config))
+
+
+def test_hot_swap():
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.counting_app",
+          "fireside.hot_swap": "true",
+          "fireside.swap_jmx": "false",
+          "fireside.warmup_paths": "/",
+          "fireside.warmup_iterations": "2",
+          "fireside.warmup_tolerance": "0" }))
+
+    def request():
+        resp_mock = ResponseMock()
+        servlet.service(RequestMock(), resp_mock)
+        return next(resp_mock.outputStream)
+
+    try:
+        assert_equal(servlet.hot_swap.current.number, 0)
+        before = servlet.hot_swap.current
+        request()
+        servlet.hot_swap.swap()
+        # a fresh instance of the module, which only its warm-up used
+        assert_equal(request(), b"3 True")
+        assert_equal(servlet.hot_swap.current.number, 1)
+        assert before.closed.get()
+        assert_equal(servlet.hot_swap.draining(), 0)
+    finally:
+        servlet.destroy()
+
+
+def test_error_after_held_output():
+
+    def failing_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        yield b"partial"
+        try:
+            raise ValueError("failed while rendering")
+        except ValueError:
+            start_response("500 Internal Server Error", [("Content-Type", "text/plain")], sys.exc_info())
+        yield b"failed"
+
+    servlet = WSGIServlet()
+    servlet.init(ServletConfigMock(
+        { "wsgi.handler": "servlet_support.simple_app",
+          "fireside.prebuffer": "1024" }))
+    servlet.application = failing_app
+    resp_mock = ResponseMock()
+    servlet.service(RequestMock(), resp_mock)
+    # the held output was not yet sent, so it is replaced
+    assert_equal(resp_mock.getStatus(), 500)
+    assert_equal(next(resp_mock.outputStream), b"failed")
+    assert_equal(resp_mock.getHeader("Content-Length"), "6")
+
+
+def test_adaptive_environ():
+    policy = EnvironPolicy(window=2, probe_interval=4)
+
+    def request(copy_all):
+        bridge = RequestBridge(RequestMock(), AdaptedInputStream(), AdaptedErrLog())
+        environ, lazy = policy.build(bridge)
+        assert_equal(environ["REQUEST_METHOD"], "GET")
+        if copy_all:
+            dict(environ.items())
+        if lazy:
+            policy.observe(bridge)
+        return lazy
+
+    assert request(True)
+    assert not policy.eager
+    assert request(True)
+    assert policy.eager
+    # eager environs are plain dicts; every fourth request is still observed
+    assert_equal([request(False) for i in range(4)], [False, False, False, True])
+
+    # taking the length of a lazy environ does not count as using all of it
+    policy = EnvironPolicy(window=2, probe_interval=4)
+    for i in range(3):
+        bridge = RequestBridge(RequestMock(), AdaptedInputStream(), AdaptedErrLog())
+        environ, lazy = policy.build(bridge)
+        assert lazy
+        assert_equal(len(environ), len(dict(bridge.asDict())))
+        assert not bridge.isLoadedAll()
+        policy.observe(bridge)
+    assert not policy.eager
+    assert policy.eager
+    assert_equal([request(False) for i in range(4)], [False, False, False, True])
+    assert not policy.eager
+
+    pinned = EnvironPolicy(EnvironPolicy.LAZY)
+    for i in range(4):
+        bridge = RequestBridge(RequestMock(), AdaptedInputStream(), AdaptedErrLog())
+        environ, lazy = pinned.build(bridge)
+        assert lazy
+        environ.items()
+        pinned.observe(bridge)
+    assert not pinned.eager
+    environ, lazy = EnvironPolicy(EnvironPolicy.EAGER).build(
+        RequestBridge(RequestMock(), AdaptedInputStream(), AdaptedErrLog()))
+    assert not lazy
+    assert type(environ) is dict
+
+
+def file_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    f = open(environ["test.path"], "rb")
+    f.seek(6)
+    return environ['wsgi.file_wrapper'](f, 4096)
+
+
+def call_file_app(req_mock, resp_mock):
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write("Hello world!\n")
+        servlet = WSGIServlet()
+        servlet.init(ServletConfigMock(
+            { "wsgi.handler": "test_servlet.file_app" }))
+        bridge = servlet.get_bridge(req_mock)
+        environ = dict_builder(bridge.asMap)()
+        environ["test.path"] = path
+        servlet.do_wsgi_call(WSGICall(environ, req_mock, resp_mock))
+        return "".join(iter(lambda: next(resp_mock.outputStream), ""))
+    finally:
+        os.remove(path)
+
+
+def test_file_wrapper():
+    resp_mock = ResponseMock()
+    assert call_file_app(RequestMock(), resp_mock) == b"world!\n"
+    assert resp_mock.getHeader('Content-Length') == '7'
+    assert resp_mock.getHeader('Accept-Ranges') == 'bytes'
+
+
+def test_file_wrapper_range():
+    req_mock = RequestMock()
+    req_mock.getHeader = lambda name: {"Range": "bytes=1-3"}.get(name)
+    resp_mock = ResponseMock()
+    assert call_file_app(req_mock, resp_mock) == b"orl"
+    assert resp_mock.getStatus() == 206
+    assert resp_mock.getHeader('Content-Range') == 'bytes 1-3/7'
+    assert resp_mock.getHeader('Content-Length') == '3'
+
+    req_mock.getHeader = lambda name: {"Range": "bytes=7-"}.get(name)
+    resp_mock = ResponseMock()
+    assert call_file_app(req_mock, resp_mock) == b""
+    assert resp_mock.getStatus() == 416
+    assert resp_mock.getHeader('Content-Range') == 'bytes */7'
+
+
+def test_truncated_file_transfer():
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write("Hello")
+        channel = RandomAccessFile(path, "r").getChannel()
+        try:
+            writer = ResponseWriter(ResponseMock().getOutputStream(), FlushPolicy())
+            assert_raises(IOError, writer.transfer, channel, 0, 10, 4096)
+        finally:
+            channel.close()
+    finally:
+        os.remove(path)
+
+
+def test_may_sendfile():
+    call = WSGICall({}, RequestMock(), ResponseMock())
+    assert call.may_sendfile("200 OK", [("Content-Type", "text/plain")], 7)
+    # a length set by the application only rules out sendfile if it differs
+    assert call.may_sendfile("200 OK", [("Content-Length", "7")], 7)
+    assert not call.may_sendfile("200 OK", [("Content-Length", "13")], 7)
+    assert not call.may_sendfile("200 OK", [("Transfer-Encoding", "chunked")], 7)
+
+
 # write other tests - need to send in headers, etc
 